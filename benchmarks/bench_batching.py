@@ -0,0 +1,55 @@
+# Throughput of batched Whisper decoding across jobs against one job at a
+# time, in the current process with the model size the bot would pick.
+#
+#   PYTHONPATH=src python benchmarks/bench_batching.py --jobs 1 4 8 --seconds 90
+import argparse
+import time
+
+import numpy as np
+
+from transcribai.models import registry
+from transcribai.transcriber import current_model, transcribe_batch
+
+
+def make_audio(seconds, seed, sr=16000):
+    # tone bursts over noise, enough for the decoder to produce segments
+    rng = np.random.default_rng(seed)
+    t = np.arange(int(seconds * sr)) / sr
+    tone = np.sin(2 * np.pi * rng.uniform(150, 400) * t) * (np.sin(t * 0.7) > 0)
+    return (0.3 * tone + 0.02 * rng.standard_normal(len(t))).astype(np.float32)
+
+
+def timed(fn):
+    start = time.perf_counter()
+    result = fn()
+    return time.perf_counter() - start, result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--jobs", type=int, nargs="+", default=[1, 4, 8])
+    parser.add_argument("--seconds", type=float, default=90)
+    parser.add_argument("--language", default="en")
+    args = parser.parse_args()
+
+    registry.preload(*current_model())
+    print(f"model {current_model()[0]}, {args.seconds:.0f} s of audio per job")
+    print(f"{'jobs':>6}{'mode':>10}{'s':>9}{'segments':>10}{'seg/s':>8}{'audio x':>9}")
+    for jobs in args.jobs:
+        items = [(make_audio(args.seconds, i), args.language) for i in range(jobs)]
+        for mode in ("serial", "batched"):
+            if mode == "serial":
+                elapsed, results = timed(
+                    lambda: [transcribe_batch([item])[0] for item in items]
+                )
+            else:
+                elapsed, results = timed(lambda: transcribe_batch(items))
+            segments = sum(len(r["segments"]) for r in results)
+            print(
+                f"{jobs:>6}{mode:>10}{elapsed:>9.1f}{segments:>10}"
+                f"{segments / elapsed:>8.2f}{jobs * args.seconds / elapsed:>9.1f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
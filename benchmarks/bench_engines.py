@@ -0,0 +1,96 @@
+# Real-time factor and accuracy of the inference engines on a fixed local test
+# set: a directory of recordings, each optionally with a reference transcript
+# next to it (lecture1.mp3 + lecture1.txt). WER is against the references;
+# drift is the WER of each engine against the first one, so quantization
+# error shows even without references.
+#
+#   PYTHONPATH=src python benchmarks/bench_engines.py --testset ~/testset --engines whisper whisper-int8
+import argparse
+import glob
+import os
+import time
+
+from transcribai import engines
+from transcribai.models import registry
+from transcribai.transcriber import current_model, load_audio
+
+AUDIO_EXTENSIONS = (".mp3", ".m4a", ".wav", ".ogg", ".opus", ".flac", ".mp4", ".webm")
+
+
+def words(text):
+    from whisper.normalizers import BasicTextNormalizer
+
+    return BasicTextNormalizer()(text).split()
+
+
+def wer(reference, hypothesis):
+    # word-level edit distance over the reference length
+    ref, hyp = words(reference), words(hypothesis)
+    row = list(range(len(hyp) + 1))
+    for i, r in enumerate(ref, 1):
+        prev, row[0] = row[0], i
+        for j, h in enumerate(hyp, 1):
+            prev, row[j] = row[j], min(row[j] + 1, row[j - 1] + 1, prev + (r != h))
+    return row[-1] / max(len(ref), 1)
+
+
+def load_testset(path):
+    items = []
+    for file in sorted(glob.glob(os.path.join(path, "*"))):
+        stem, ext = os.path.splitext(file)
+        if ext.lower() not in AUDIO_EXTENSIONS:
+            continue
+        reference = None
+        if os.path.exists(stem + ".txt"):
+            with open(stem + ".txt", encoding="utf8") as f:
+                reference = f.read()
+        items.append((os.path.basename(file), load_audio(file), reference))
+    return items
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--testset", required=True)
+    parser.add_argument("--engines", nargs="+", default=["whisper", "whisper-int8"])
+    parser.add_argument("--model", help="model size, the deployment default if omitted")
+    parser.add_argument("--language")
+    args = parser.parse_args()
+
+    items = load_testset(args.testset)
+    if not items:
+        parser.error(f"no recordings in {args.testset}")
+    audio_seconds = sum(len(audio) for _, audio, _ in items) / 16000
+    print(f"{len(items)} recordings, {audio_seconds / 60:.1f} min of audio")
+    print(f"{'engine':<16}{'load s':>8}{'RTF':>8}{'speedup':>9}{'WER':>8}{'drift':>8}")
+
+    baseline = None
+    for name in args.engines:
+        model_size, device, _ = current_model(name)
+        engine = engines.get(name)
+        start = time.perf_counter()
+        registry.preload(args.model or model_size, device, name)
+        load_seconds = time.perf_counter() - start
+        texts, elapsed = [], 0.0
+        with registry.use(args.model or model_size, device, name) as model:
+            for _, audio, _ in items:
+                start = time.perf_counter()
+                texts.append(engine.transcribe(model, audio, args.language)["text"])
+                elapsed += time.perf_counter() - start
+        rtf = elapsed / audio_seconds
+        if baseline is None:
+            baseline = (rtf, texts)
+        scored = [(ref, text) for (_, _, ref), text in zip(items, texts) if ref is not None]
+        error = (
+            f"{sum(wer(ref, text) for ref, text in scored) / len(scored):.3f}" if scored else "-"
+        )
+        drift = sum(wer(base, text) for base, text in zip(baseline[1], texts)) / len(texts)
+        print(
+            f"{name:<16}{load_seconds:>8.1f}{rtf:>8.3f}{baseline[0] / rtf:>8.2f}x"
+            f"{error:>8}{drift:>8.3f}"
+        )
+        # one model resident at a time, like a worker
+        registry._entries.clear()
+
+
+if __name__ == "__main__":
+    main()
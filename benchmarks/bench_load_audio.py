@@ -0,0 +1,94 @@
+# Peak RSS of load_audio against the old capture_output decode on long inputs.
+#
+#   PYTHONPATH=src python benchmarks/bench_load_audio.py --minutes 180
+import argparse
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from transcribai.transcriber import (
+    FFMPEG_BINARY,
+    ffmpeg_decode_cmd,
+    iter_audio,
+    load_audio,
+)
+
+
+def legacy_load_audio(file, sr=16000):
+    out = subprocess.run(ffmpeg_decode_cmd(file, sr), capture_output=True, check=True).stdout
+    return np.frombuffer(out, np.int16).flatten().astype(np.float32) / 32768.0
+
+
+def streamed_peak(file):
+    # consumer only keeps one window at a time
+    return sum(float(np.abs(w).max()) for w in iter_audio(file))
+
+
+MODES = {
+    "legacy": legacy_load_audio,
+    "load_audio": load_audio,
+    "iter_audio": streamed_peak,
+}
+
+
+def make_audio(path, minutes):
+    subprocess.run(
+        [
+            FFMPEG_BINARY,
+            "-loglevel",
+            "error",
+            "-y",
+            "-f",
+            "lavfi",
+            "-i",
+            f"sine=frequency=440:duration={minutes * 60}",
+            "-ar",
+            "16000",
+            "-b:a",
+            "32k",
+            path,
+        ],
+        check=True,
+    )
+
+
+def child(mode, file):
+    start = time.perf_counter()
+    MODES[mode](file)
+    elapsed = time.perf_counter() - start
+    peak_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(f"{elapsed:.3f} {peak_mb:.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--minutes", type=float, default=180)
+    parser.add_argument("--child", nargs=2, metavar=("MODE", "FILE"))
+    args = parser.parse_args()
+    if args.child:
+        return child(*args.child)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        file = os.path.join(tmp, "long.mp3")
+        make_audio(file, args.minutes)
+        decoded_mb = args.minutes * 60 * 16000 * 4 / 2**20
+        print(f"{args.minutes:g} min input, {decoded_mb:.0f} MB as float32")
+        print(f"{'mode':<12}{'seconds':>10}{'peak RSS MB':>14}")
+        for mode in MODES:
+            # fresh interpreter per mode so peaks don't mix
+            out = subprocess.run(
+                [sys.executable, __file__, "--child", mode, file],
+                capture_output=True,
+                check=True,
+                text=True,
+            ).stdout.split()
+            print(f"{mode:<12}{float(out[0]):>10.2f}{float(out[1]):>14.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+# Cold start of the bot process: time and memory to import transcribai.main,
+# which is everything that happens before polling starts. Fails when the
+# whisper/torch stack or the LLM SDK gets imported by the front end again, or
+# when a budget is exceeded, so CI catches regressions.
+#
+#   PYTHONPATH=src python benchmarks/bench_startup.py --runs 5 --max-seconds 10 --max-mb 250
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+# only the inference workers and the summarizer backend may load these
+HEAVY_MODULES = ("torch", "whisper", "yandex_cloud_ml_sdk")
+
+CHILD = """
+import json, resource, sys, time
+start = time.perf_counter()
+import transcribai.main
+print(json.dumps({
+    "seconds": time.perf_counter() - start,
+    "peak_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    "heavy": [m for m in %r if m in sys.modules],
+}))
+""" % (HEAVY_MODULES,)
+
+
+def measure():
+    src = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+    # the bot creates its database and upload directories under DATA_DIR,
+    # which defaults to the checkout's data/
+    with tempfile.TemporaryDirectory() as tmp:
+        env = dict(os.environ, PYTHONPATH=os.path.abspath(src), DATA_DIR=tmp)
+        out = subprocess.run(
+            [sys.executable, "-W", "ignore", "-c", CHILD],
+            cwd=tmp,
+            env=env,
+            capture_output=True,
+            check=True,
+            text=True,
+        ).stdout
+    return json.loads(out.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--max-seconds", type=float, help="budget for the best run")
+    parser.add_argument("--max-mb", type=float, help="budget for peak RSS")
+    args = parser.parse_args()
+
+    runs = [measure() for _ in range(args.runs)]
+    seconds = sorted(run["seconds"] for run in runs)
+    peak_mb = max(run["peak_mb"] for run in runs)
+    heavy = sorted({m for run in runs for m in run["heavy"]})
+    print(f"import time: best {seconds[0]:.2f} s, median {seconds[len(seconds) // 2]:.2f} s")
+    print(f"peak RSS: {peak_mb:.0f} MB")
+    print(f"heavy modules loaded: {', '.join(heavy) or 'none'}")
+
+    failures = []
+    if heavy:
+        failures.append(f"imported at startup: {', '.join(heavy)}")
+    if args.max_seconds and seconds[0] > args.max_seconds:
+        failures.append(f"startup {seconds[0]:.2f} s > {args.max_seconds} s")
+    if args.max_mb and peak_mb > args.max_mb:
+        failures.append(f"peak RSS {peak_mb:.0f} MB > {args.max_mb} MB")
+    for failure in failures:
+        print("FAIL", failure)
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+# Chunking throughput of the single-pass chunker against the old
+# quadratic process_transcript on large synthetic transcripts.
+#
+#   PYTHONPATH=src python benchmarks/bench_transcript_chunks.py --lines 10000 50000
+#   PYTHONPATH=src python benchmarks/bench_transcript_chunks.py --lines 50000 --limit 30000
+import argparse
+import random
+import time
+
+from transcribai.transcript_chunks import chunk_transcript, tokenizer
+from transcribai.transcriber import srt_time
+
+WORDS = (
+    "лекция психология восприятие память эксперимент результат внимание "
+    "теория модель данные когнитивный процесс the model memory test"
+).split()
+
+
+def legacy_process_transcript(text, limit_user_prompt):
+    lines = text.split("\n")
+    splits = []
+    curr_chunk = "Входные данные:\n"
+    for line in lines:
+        if len(curr_chunk + line) / 4 < limit_user_prompt:
+            curr_chunk += line
+        else:
+            splits.append(curr_chunk)
+            curr_chunk = "Входные данные:\n" + line
+    if curr_chunk != "Входные данные:\n":
+        splits.append(curr_chunk)
+    return splits
+
+
+def make_transcript(lines, seed=0):
+    rng = random.Random(seed)
+    out = []
+    t = 0.0
+    for _ in range(lines):
+        dur = rng.uniform(2, 7)
+        text = " ".join(rng.choice(WORDS) for _ in range(rng.randint(5, 16)))
+        out.append(f"[{srt_time(t)} --> {srt_time(t + dur)}]  {text}")
+        t += dur
+    return "\n".join(out)
+
+
+def best_of(fn, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        times.append(time.perf_counter() - start)
+    return min(times), result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--lines", type=int, nargs="+", default=[10000, 50000])
+    parser.add_argument("--limit", type=int, default=1500)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    print(f"{'lines':>8}{'impl':>10}{'ms':>10}{'chunks':>8}{'est. max tok':>14}")
+    for lines in args.lines:
+        text = make_transcript(lines)
+        legacy_s, legacy = best_of(
+            lambda: legacy_process_transcript(text, args.limit), args.repeat
+        )
+        new_s, (chunks, stats) = best_of(
+            lambda: chunk_transcript(text, args.limit, overlap=1), args.repeat
+        )
+        legacy_max = max(tokenizer.count(c) for c in legacy)
+        print(f"{lines:>8}{'legacy':>10}{legacy_s * 1e3:>10.1f}{len(legacy):>8}{legacy_max:>14.0f}")
+        print(f"{lines:>8}{'chunker':>10}{new_s * 1e3:>10.1f}{len(chunks):>8}{stats.max_tokens:>14.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,419 @@
+# Offline benchmark suite for the transcription and summarization hot paths.
+# Every case runs in a fresh interpreter on synthetic inputs: ffmpeg generated
+# audio, a seeded random-weight Whisper with tiny dimensions, a stub LLM
+# backend and a seeded SQLite database. Peak memory is how far the process's
+# RSS rose above what it held after the case was set up: the kernel's
+# high-water mark is reset once setup is done. Results are compared with
+# benchmarks/baseline.json and slower or heavier cases are flagged.
+#
+#   PYTHONPATH=src python benchmarks/run.py
+#   PYTHONPATH=src python benchmarks/run.py --only db summarize --repeat 20
+#   PYTHONPATH=src python benchmarks/run.py --save-baseline
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+AUDIO_MINUTES = 10
+SEGMENTS = 20000
+TRANSCRIPT_LINES = 5000
+DB_USERS = 1000
+DB_FILES_PER_USER = 20
+DB_OPS = 200
+SEARCH_LECTURES = 500
+SEARCH_QUERIES = 50
+SUMMARY_LINES = 5000
+
+CASES = {}
+
+
+def case(unit):
+    # setup(tmp) returns (fn, units of work per call)
+    def register(setup):
+        CASES[setup.__name__] = (setup, unit)
+        return setup
+
+    return register
+
+
+def make_audio(path, seconds):
+    from transcribai.transcriber import FFMPEG_BINARY
+
+    subprocess.run(
+        [
+            FFMPEG_BINARY,
+            "-loglevel",
+            "error",
+            "-y",
+            "-f",
+            "lavfi",
+            "-i",
+            f"sine=frequency=440:duration={seconds}",
+            "-f",
+            "lavfi",
+            "-i",
+            f"anoisesrc=amplitude=0.05:duration={seconds}:seed=1",
+            "-filter_complex",
+            "amix=inputs=2",
+            "-ar",
+            "16000",
+            "-b:a",
+            "32k",
+            path,
+        ],
+        check=True,
+    )
+
+
+def make_segments(n, seed=0):
+    rng = random.Random(seed)
+    words = "лекция память внимание модель данные the model memory test".split()
+    segments, t = [], 0.0
+    for i in range(n):
+        dur = rng.uniform(2, 7)
+        text = " " + " ".join(rng.choice(words) for _ in range(rng.randint(5, 16)))
+        segments.append({"id": i, "start": t, "end": t + dur, "text": text})
+        t += dur
+    return segments
+
+
+def tiny_whisper():
+    # tiny dimensions, seeded random weights: no download, same work every run
+    import torch
+    from whisper.model import ModelDimensions, Whisper
+
+    torch.manual_seed(0)
+    dims = ModelDimensions(
+        n_mels=80,
+        n_audio_ctx=1500,
+        n_audio_state=384,
+        n_audio_head=6,
+        n_audio_layer=4,
+        n_vocab=51865,
+        n_text_ctx=448,
+        n_text_state=384,
+        n_text_head=6,
+        n_text_layer=4,
+    )
+    return Whisper(dims).eval()
+
+
+@case("audio s")
+def load_audio(tmp):
+    from transcribai.transcriber import load_audio
+
+    path = os.path.join(tmp, "audio.mp3")
+    make_audio(path, AUDIO_MINUTES * 60)
+    return lambda: load_audio(path), AUDIO_MINUTES * 60
+
+
+@case("audio s")
+def pipeline_stream(tmp):
+    # decoding bytes fed as they would arrive from a download
+    from transcribai.pipeline import AudioPipeline
+
+    path = os.path.join(tmp, "audio.mp3")
+    make_audio(path, AUDIO_MINUTES * 60)
+    data = open(path, "rb").read()
+
+    async def run():
+        pipeline = AudioPipeline.streaming()
+        for i in range(0, len(data), 1 << 16):
+            pipeline.feed(data[i : i + (1 << 16)])
+        pipeline.finish_input(path)
+        return await pipeline.audio()
+
+    return lambda: asyncio.run(run()), AUDIO_MINUTES * 60
+
+
+@case("audio s")
+def vad(tmp):
+    # silence detection and removal on a recording that is half pauses
+    import numpy as np
+    from transcribai.vad import skip_silence
+
+    rng = np.random.default_rng(0)
+    seconds = AUDIO_MINUTES * 60
+    audio = rng.standard_normal(seconds * 16000, np.float32) * 0.003
+    # a 220 Hz tone for the first half of every minute
+    tone = 0.3 * np.sin(2 * np.pi * 220 * np.arange(30 * 16000, dtype=np.float32) / 16000)
+    for start in range(0, seconds, 60):
+        audio[start * 16000 : (start + 30) * 16000] += tone
+    return lambda: skip_silence(audio), seconds
+
+
+@case("segments")
+def write_transcripts(tmp):
+    from transcribai.transcriber import save_transcripts
+
+    result = {"segments": make_segments(SEGMENTS)}
+    return lambda: save_transcripts(result, tmp), SEGMENTS
+
+
+@case("lines")
+def chunk_transcript(tmp):
+    from transcribai.summarizer import CHUNK_TOKEN_LIMIT, cut_ms, process_transcript
+    from transcribai.transcriber import txt_line
+
+    text = "".join(txt_line(seg) for seg in make_segments(TRANSCRIPT_LINES))
+    return lambda: process_transcript(cut_ms(text), CHUNK_TOKEN_LIMIT, 1), TRANSCRIPT_LINES
+
+
+@case("lines")
+def extract_timecodes(tmp):
+    # timecode repair on a summary-shaped list, short timecodes padded
+    from transcribai.summarizer import extract_timecodes
+
+    rng = random.Random(0)
+    text = "".join(
+        f"- Ключевой момент номер {i}. - {rng.randint(0, 59):02}:{rng.randint(0, 59):02}\n"
+        if i % 2
+        else f"- Ключевой момент номер {i}. - {rng.randint(0, 3):02}:{rng.randint(0, 59):02}:{rng.randint(0, 59):02}\n"
+        for i in range(SUMMARY_LINES)
+    )
+    return lambda: extract_timecodes(text), SUMMARY_LINES
+
+
+class StubBackend:
+    # answers instantly with a summary-shaped reply
+    async def complete(self, messages):
+        await asyncio.sleep(0)
+        return "- Ключевой момент лекции. - 00:10:15\n" * 5
+
+    async def count_tokens(self, text):
+        return len(text) // 3
+
+    async def close(self):
+        pass
+
+
+@case("lines")
+def summarize(tmp):
+    from transcribai.summarizer import SummaryEngine
+    from transcribai.transcriber import txt_line
+
+    text = "".join(txt_line(seg) for seg in make_segments(TRANSCRIPT_LINES))
+
+    def run():
+        engine = SummaryEngine(StubBackend(), concurrency=8, retries=0, cache=False)
+        return asyncio.run(engine.full_process(text))
+
+    return run, TRANSCRIPT_LINES
+
+
+@case("ops")
+def db(tmp):
+    from transcribai import db
+
+    db.DATA_DB_PATH = os.path.join(tmp, "bench.db")
+    db.init_db()
+    rng = random.Random(0)
+    with db.transaction() as c:
+        c.executemany(
+            "INSERT INTO files (user_telegram_id, idx, video_id, video_file_path, language, status) VALUES (?, ?, ?, ?, ?, 'scheduled')",
+            (
+                (user, idx, db.make_video_id(user, idx), f"/data/{user}/{idx}.mp4", "ru")
+                for user in range(DB_USERS)
+                for idx in range(1, DB_FILES_PER_USER + 1)
+            ),
+        )
+
+    def run():
+        # the per-message mix: new upload, schedule it, list files, look one up
+        for _ in range(DB_OPS // 4):
+            user = rng.randrange(DB_USERS)
+            idx, _ = db.allocate_file(user)
+            db.schedule_file(user, idx, "ru", (user, user, idx, "/tmp/x", "/tmp", "ru", None))
+            db.get_user_files(user)
+            db.get_file_by_id(user, rng.randint(1, DB_FILES_PER_USER))
+
+    return run, DB_OPS
+
+
+@case("queries")
+def search(tmp):
+    # /search over 500 indexed lectures of 50 users, 300 segments each
+    from transcribai import db
+    from transcribai.search import search
+
+    db.DATA_DB_PATH = os.path.join(tmp, "bench.db")
+    db.init_db()
+    segments = make_segments(300)
+    for n in range(SEARCH_LECTURES):
+        user = n % 50
+        db.get_connection().execute(
+            "INSERT INTO files (user_telegram_id, idx, video_id, status) VALUES (?, ?, ?, 'scheduled')",
+            (user, n, db.make_video_id(user, n)),
+        )
+        rows = [(int(s["start"] * 1000), int(s["end"] * 1000), s["text"]) for s in segments]
+        db.replace_transcript_segments(user, n, f"/data/{n}/transcriptions", rows, 0)
+    rng = random.Random(0)
+    queries = ["модель данные", "память", "the model", "внимание test", "лекц"]
+
+    def run():
+        for _ in range(SEARCH_QUERIES):
+            search(rng.randrange(50), rng.choice(queries))
+
+    return run, SEARCH_QUERIES
+
+
+@case("windows")
+def whisper_encoder(tmp):
+    import numpy as np
+    import torch
+    import whisper
+
+    model = tiny_whisper()
+    audio = np.random.default_rng(0).standard_normal(30 * 16000).astype(np.float32) * 0.1
+    mel = whisper.log_mel_spectrogram(audio)[None]
+
+    def run():
+        with torch.no_grad():
+            return model.embed_audio(mel)
+
+    return run, 1
+
+
+@case("windows")
+def whisper_decode(tmp):
+    # encoder plus 32 greedy tokens, the decoding loop without the fallbacks
+    import numpy as np
+    import whisper
+
+    model = tiny_whisper()
+    audio = np.random.default_rng(0).standard_normal(30 * 16000).astype(np.float32) * 0.1
+    mel = whisper.log_mel_spectrogram(audio)
+    options = whisper.DecodingOptions(language="en", sample_len=32, fp16=False)
+    return lambda: whisper.decode(model, mel, options), 1
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def status_mb(field):
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith(field + ":"):
+                return int(line.split()[1]) / 1024
+    return 0.0
+
+
+def reset_peak_rss():
+    # VmHWM restarts from the current RSS (Linux 4.0+)
+    with open("/proc/self/clear_refs", "w") as f:
+        f.write("5")
+
+
+def child(name, repeat):
+    setup, _ = CASES[name]
+    with tempfile.TemporaryDirectory() as tmp:
+        fn, units = setup(tmp)
+        # imports and inputs are not part of the measured memory
+        reset_peak_rss()
+        setup_mb = status_mb("VmRSS")
+        fn()  # warm up
+        times = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            fn()
+            times.append(time.perf_counter() - start)
+        peak_mb = status_mb("VmHWM") - setup_mb
+    print(json.dumps({"times": times, "units": units, "peak_mb": max(0.0, peak_mb)}))
+
+
+def run_case(name, repeat):
+    # None if the case can't run, e.g. against an older tree without its module
+    proc = subprocess.run(
+        [sys.executable, __file__, "--child", name, "--repeat", str(repeat)],
+        capture_output=True,
+        text=True,
+    )
+    if proc.returncode:
+        error = (proc.stderr.strip().splitlines() or ["failed"])[-1]
+        print(f"{name:<20}skipped: {error}")
+        return None
+    data = json.loads(proc.stdout.strip().splitlines()[-1])
+    times = data["times"]
+    return {
+        "min_ms": min(times) * 1e3,
+        "p50_ms": percentile(times, 0.5) * 1e3,
+        "p95_ms": percentile(times, 0.95) * 1e3,
+        "throughput": data["units"] / percentile(times, 0.5),
+        "peak_mb": data["peak_mb"],
+    }
+
+
+def compare(name, result, baseline, threshold):
+    # regressions against the baseline: slower best run or higher peak memory;
+    # the best of several runs is much less noisy than the median
+    base = baseline.get(name)
+    if not base:
+        return "new"
+    flags = []
+    if result["min_ms"] > base["min_ms"] * (1 + threshold):
+        flags.append(f"time +{result['min_ms'] / base['min_ms'] * 100 - 100:.0f}%")
+    # small peaks are noise, a few MB more is not a regression
+    if result["peak_mb"] > max(base["peak_mb"], 8) * (1 + threshold):
+        flags.append(f"memory +{result['peak_mb'] - base['peak_mb']:.0f} MB")
+    return "REGRESSION " + ", ".join(flags) if flags else "ok"
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--only", nargs="+", choices=sorted(CASES), default=list(CASES))
+    parser.add_argument("--repeat", type=int, default=7)
+    parser.add_argument("--threshold", type=float, default=0.25, help="allowed slowdown, 0.25 = 25%%")
+    parser.add_argument("--baseline", default=BASELINE)
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--child")
+    args = parser.parse_args()
+    if args.child:
+        return child(args.child, args.repeat)
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)["cases"]
+    results = {}
+    regressions = 0
+    print(f"{'case':<20}{'p50 ms':>10}{'p95 ms':>10}{'throughput':>20}{'peak MB':>9}  vs baseline")
+    skipped = 0
+    for name in args.only:
+        result = run_case(name, args.repeat)
+        if result is None:
+            skipped += 1
+            continue
+        results[name] = result
+        verdict = compare(name, result, baseline, args.threshold)
+        regressions += verdict.startswith("REGRESSION")
+        throughput = f"{result['throughput']:.1f} {CASES[name][1]}/s"
+        print(
+            f"{name:<20}{result['p50_ms']:>10.1f}{result['p95_ms']:>10.1f}"
+            f"{throughput:>20}{result['peak_mb']:>9.0f}  {verdict}"
+        )
+    if args.save_baseline:
+        cases = dict(baseline, **results)
+        with open(args.baseline, "w") as f:
+            json.dump(
+                {"machine": f"{platform.machine()} {os.cpu_count()} cpu", "cases": cases},
+                f,
+                indent=2,
+                sort_keys=True,
+            )
+            f.write("\n")
+        print(f"Baseline saved to {args.baseline}")
+    elif regressions or skipped:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,148 @@
+import os
+import time
+import asyncio
+import logging
+from collections import deque
+
+from . import engines
+from . import metrics
+from .models import current_size
+from .transcriber import current_model, transcribe_audio, transcribe_batch
+from .workers import inference_pool
+
+logger = logging.getLogger(__name__)
+
+# transcription requests of concurrent jobs are grouped into one batch
+BATCH_INFERENCE = os.getenv("BATCH_INFERENCE", "0") == "1"
+BATCH_MAX_SIZE = int(os.getenv("BATCH_MAX_SIZE", "8"))
+# how long an idle engine waits for other jobs before starting a batch
+BATCH_MAX_WAIT = float(os.getenv("BATCH_MAX_WAIT_MS", "50")) / 1000
+
+
+class BatchingEngine:
+    # queues transcription requests and sends them to the inference pool in
+    # batches of one language; a batch starts when it is full, when it waited
+    # max_wait, and only when a worker is free, so batches grow under load
+    def __init__(self, pool, max_batch=BATCH_MAX_SIZE, max_wait=BATCH_MAX_WAIT):
+        self.pool = pool
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.batches = 0
+        self.items = 0
+        self._queue = deque()
+        self._changed = None
+        self._slots = None
+        self._task = None
+
+    async def transcribe(self, audio, language=None):
+        if self._task is None or self._task.done():
+            self._changed = asyncio.Event()
+            self._slots = asyncio.Semaphore(self.pool.workers)
+            self._task = asyncio.create_task(self._run())
+        future = asyncio.get_running_loop().create_future()
+        self._queue.append((audio, language, future, time.monotonic()))
+        self._changed.set()
+        return await future
+
+    def _take_batch(self):
+        # the oldest request and the next ones in the same language
+        language = self._queue[0][1]
+        batch, rest = [], deque()
+        while self._queue:
+            item = self._queue.popleft()
+            if item[2].done():
+                continue  # cancelled by its job
+            if item[1] == language and len(batch) < self.max_batch:
+                batch.append(item)
+            else:
+                rest.append(item)
+        self._queue = rest
+        return batch
+
+    async def _run(self):
+        while True:
+            while not self._queue:
+                self._changed.clear()
+                await self._changed.wait()
+            await self._slots.acquire()
+            deadline = self._queue[0][3] + self.max_wait if self._queue else 0
+            while len(self._queue) < self.max_batch and time.monotonic() < deadline:
+                self._changed.clear()
+                try:
+                    await asyncio.wait_for(
+                        self._changed.wait(), deadline - time.monotonic()
+                    )
+                except asyncio.TimeoutError:
+                    break
+            batch = self._take_batch() if self._queue else []
+            if not batch:
+                self._slots.release()
+                continue
+            self.batches += 1
+            self.items += len(batch)
+            asyncio.create_task(self._execute(batch))
+
+    async def _execute(self, batch):
+        try:
+            results = await self.pool.run(
+                transcribe_batch, [(audio, language) for audio, language, _, _ in batch]
+            )
+        except Exception as ex:
+            for _, _, future, _ in batch:
+                if not future.done():
+                    future.set_exception(ex)
+        else:
+            for (_, _, future, _), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+        finally:
+            self._slots.release()
+
+    def stats(self):
+        return {
+            "batches": self.batches,
+            "items": self.items,
+            "mean_batch": self.items / self.batches if self.batches else 0,
+        }
+
+
+batching_engine = BatchingEngine(inference_pool)
+_worker_model = None  # (default model size, device)
+
+
+async def default_model():
+    # (model size, device) the workers pick; asked from a worker once,
+    # finding the device would load torch into the bot process
+    global _worker_model
+    if _worker_model is None:
+        model_size, device, _ = await inference_pool.run(
+            current_model, engines.WHISPER_ENGINE
+        )
+        _worker_model = model_size, device
+    return _worker_model
+
+
+async def worker_model():
+    # (model, device) the workers transcribe this job with, the model named
+    # with its engine for cache keys
+    model_size, device = await default_model()
+    model = engines.model_label(current_size() or model_size, engines.WHISPER_ENGINE)
+    return model, device
+
+
+async def transcribe(audio, language=None):
+    # entry point for transcribing decoded audio, batched across jobs if enabled;
+    # batches run the default model, jobs that picked another one don't join
+    model_size = current_size()
+    if (
+        BATCH_INFERENCE
+        and engines.get().batched
+        and model_size in (None, (await default_model())[0])
+    ):
+        result = await batching_engine.transcribe(audio, language)
+    else:
+        result = await inference_pool.run(
+            transcribe_audio, audio, language, engines.WHISPER_ENGINE, model_size
+        )
+    metrics.record_worker_stats(result.pop("stats", {}))
+    return result
@@ -0,0 +1,141 @@
+import os
+import hmac
+import asyncio
+import logging
+import ipaddress
+
+import aiohttp
+from aiohttp import web
+
+from . import cache
+from .db import (
+    DATA_DIR,
+    run_db,
+    claim_job,
+    renew_lease,
+    complete_job,
+    release_job,
+    record_model_speed,
+)
+
+logger = logging.getLogger(__name__)
+
+# job broker for workers on other hosts: SQLite in WAL mode needs shared
+# memory on one host and breaks over NFS/SMB, so the bot serves the few
+# database operations a worker needs over HTTP; media and transcripts still
+# go through DATA_DIR on shared storage
+JOB_BROKER_HOST = os.getenv("JOB_BROKER_HOST", "127.0.0.1")
+JOB_BROKER_PORT = int(os.getenv("JOB_BROKER_PORT", "0"))  # bot side, 0 disables
+JOB_BROKER_URL = os.getenv("JOB_BROKER_URL", "")  # worker side, e.g. http://bot:9110
+JOB_BROKER_TOKEN = os.getenv("JOB_BROKER_TOKEN", "")  # required unless on loopback
+BROKER_RETRIES = 5
+BROKER_BACKOFF = 1.0  # seconds, doubled with every retry
+TOKEN_HEADER = "X-Broker-Token"
+
+
+def lookup_cache(key, dest_dir):
+    # cache.lookup for a remote worker, which may only have files copied to
+    # a job directory under DATA_DIR
+    data_dir = os.path.realpath(DATA_DIR)
+    if os.path.commonpath([os.path.realpath(dest_dir), data_dir]) != data_dir:
+        raise PermissionError(f"{dest_dir} is outside DATA_DIR")
+    return cache.lookup(key, dest_dir)
+
+
+OPERATIONS = {
+    "claim_job": claim_job,
+    "renew_lease": renew_lease,
+    "complete_job": complete_job,
+    "release_job": release_job,
+    "record_model_speed": record_model_speed,
+    "lookup_cache": lookup_cache,
+}
+_NAMES = {fn: name for name, fn in OPERATIONS.items()}
+_NAMES[cache.lookup] = "lookup_cache"  # what workers call, served checked
+
+
+def is_loopback(host):
+    if host == "localhost":
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+
+async def start_server(host=JOB_BROKER_HOST, port=JOB_BROKER_PORT, token=JOB_BROKER_TOKEN):
+    # POST /ops/<name> with {"args": [...]} answers {"result": ...}; None if disabled
+    if not port:
+        return None
+    if not token and not is_loopback(host):
+        raise ValueError(f"JOB_BROKER_TOKEN must be set for a broker on {host}")
+
+    async def handle(request):
+        if token and not hmac.compare_digest(request.headers.get(TOKEN_HEADER, ""), token):
+            return web.json_response({"error": "bad token"}, status=403)
+        fn = OPERATIONS.get(request.match_info["name"])
+        if fn is None:
+            return web.json_response({"error": "unknown operation"}, status=404)
+        args = (await request.json()).get("args", [])
+        try:
+            result = await run_db(fn, *args)
+        except Exception as ex:
+            logger.exception("Broker operation %s failed", fn.__name__)
+            return web.json_response({"error": str(ex)}, status=500)
+        return web.json_response({"result": result})
+
+    app = web.Application()
+    app.router.add_post("/ops/{name}", handle)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logger.info("Job broker on http://%s:%d", host, port)
+    return runner
+
+
+class BrokerError(RuntimeError):
+    pass
+
+
+class BrokerClient:
+    def __init__(self, url=JOB_BROKER_URL, token=JOB_BROKER_TOKEN):
+        self.url = url.rstrip("/")
+        self.token = token
+        self._session = None
+
+    async def call(self, name, *args):
+        # retries while the bot is unreachable, e.g. restarting
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                headers={TOKEN_HEADER: self.token},
+                timeout=aiohttp.ClientTimeout(total=60),
+            )
+        for attempt in range(BROKER_RETRIES + 1):
+            try:
+                async with self._session.post(
+                    f"{self.url}/ops/{name}", json={"args": list(args)}
+                ) as resp:
+                    data = await resp.json()
+                    if resp.status != 200:
+                        raise BrokerError(f"{name}: {data.get('error', resp.status)}")
+                    return data["result"]
+            except (aiohttp.ClientError, asyncio.TimeoutError) as ex:
+                if attempt == BROKER_RETRIES:
+                    raise BrokerError(f"{name}: broker unreachable: {ex}") from ex
+                delay = BROKER_BACKOFF * 2**attempt
+                logger.warning("Broker unreachable (%s), retrying in %.0f s", ex, delay)
+                await asyncio.sleep(delay)
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+
+
+client = BrokerClient() if JOB_BROKER_URL else None
+
+
+async def call(fn, *args):
+    # a worker's database operation, through the broker if one is configured
+    if client is None:
+        return await run_db(fn, *args)
+    return await client.call(_NAMES[fn], *args)
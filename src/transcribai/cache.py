@@ -0,0 +1,89 @@
+import os
+import time
+import shutil
+import hashlib
+import logging
+
+from .db import (
+    DATA_DIR,
+    get_cache_entry,
+    put_cache_entry,
+    touch_cache_entry,
+    delete_cache_entry,
+    get_cache_entries_lru,
+)
+
+logger = logging.getLogger(__name__)
+
+CACHE_DIR = os.path.join(DATA_DIR, "cache")
+TRANSCRIPT_CACHE_MAX_MB = int(os.getenv("TRANSCRIPT_CACHE_MAX_MB", "1024"))
+CACHE_FILES = ("transcript.srt", "transcript.txt", "summary.txt")
+
+
+class HashingWriter:
+    # file wrapper that hashes the media while it is being downloaded,
+    # optionally passing every block on to a decoding pipeline
+    def __init__(self, f, sink=None):
+        self.f = f
+        self.sha = hashlib.sha256()
+        self.sink = sink
+
+    def write(self, data):
+        self.sha.update(data)
+        if self.sink:
+            self.sink.feed(data)
+        return self.f.write(data)
+
+    def flush(self):
+        # aiogram's download_file flushes the destination after every chunk
+        self.f.flush()
+
+    def hexdigest(self):
+        return self.sha.hexdigest()
+
+
+def cache_key(media_hash, model_size, language):
+    raw = f"{media_hash}:{model_size}:{language or 'auto'}"
+    return hashlib.sha256(raw.encode()).hexdigest()
+
+
+def lookup(key, dest_dir):
+    # copies cached transcripts and summary into dest_dir, False on a miss
+    entry = get_cache_entry(key)
+    if entry is None:
+        return False
+    path = entry[0]
+    if not all(os.path.exists(os.path.join(path, name)) for name in CACHE_FILES):
+        delete_cache_entry(key)
+        return False
+    os.makedirs(dest_dir, exist_ok=True)
+    for name in CACHE_FILES:
+        shutil.copyfile(os.path.join(path, name), os.path.join(dest_dir, name))
+    touch_cache_entry(key, time.time())
+    return True
+
+
+def store(key, media_hash, model_size, language, src_dir):
+    path = os.path.join(CACHE_DIR, key)
+    os.makedirs(path, exist_ok=True)
+    size = 0
+    for name in CACHE_FILES:
+        dst = os.path.join(path, name)
+        shutil.copyfile(os.path.join(src_dir, name), dst)
+        size += os.path.getsize(dst)
+    put_cache_entry(key, media_hash, model_size, language, path, size, time.time())
+    evict()
+
+
+def evict(max_bytes=None):
+    # drops least recently used entries until the cache fits its budget
+    max_bytes = TRANSCRIPT_CACHE_MAX_MB * 1024 * 1024 if max_bytes is None else max_bytes
+    entries = get_cache_entries_lru()
+    total = sum(size for _, _, size in entries)
+    for key, path, size in entries:
+        if total <= max_bytes:
+            break
+        shutil.rmtree(path, ignore_errors=True)
+        delete_cache_entry(key)
+        total -= size
+        logger.info("Evicted cached transcript %s", key)
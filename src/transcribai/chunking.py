@@ -0,0 +1,238 @@
+import os
+import re
+import asyncio
+from collections import deque
+
+import numpy as np
+
+from . import engines
+from .pipeline import DecodeError, PcmBuffer
+from .batching import transcribe
+from .models import current_size
+from .transcriber import detect_language
+from .vad import as_float
+from .workers import inference_pool
+
+SAMPLE_RATE = 16000
+
+# recordings at least this long are split and transcribed in parallel
+LONG_AUDIO_MIN_SECONDS = float(os.getenv("LONG_AUDIO_MIN_SECONDS", "1200"))
+LONG_AUDIO_CHUNK_SECONDS = float(os.getenv("LONG_AUDIO_CHUNK_SECONDS", "600"))
+SPLIT_SEARCH_SECONDS = 30  # how far from the target point to look for silence
+CHUNK_OVERLAP_SECONDS = 1.0  # context each chunk gets from before its seam
+FRAME_SECONDS = 0.02
+SMOOTH_FRAMES = 15  # ~0.3 s, prefer the middle of a pause to a single quiet frame
+MAX_SEAM_WORDS = 8
+
+WORD_RE = re.compile(r"\w+")
+
+
+def frame_energy(audio, sr=SAMPLE_RATE, frame_seconds=FRAME_SECONDS):
+    frame = int(sr * frame_seconds)
+    n = len(audio) // frame
+    frames = as_float(audio[: n * frame]).reshape(n, frame)
+    return np.einsum("ij,ij->i", frames, frames) / frame
+
+
+def next_split_point(audio, last, sr=SAMPLE_RATE, chunk=None, search=None):
+    # the quietest spot within search samples of last + chunk
+    frame = int(sr * FRAME_SECONDS)
+    chunk = int(LONG_AUDIO_CHUNK_SECONDS * sr) if chunk is None else chunk
+    search = int(SPLIT_SEARCH_SECONDS * sr) if search is None else search
+    lo = max(last + chunk - search, last + frame)
+    hi = min(last + chunk + search, len(audio))
+    energy = frame_energy(audio[lo:hi], sr)
+    if len(energy) >= SMOOTH_FRAMES:
+        kernel = np.ones(SMOOTH_FRAMES, np.float32) / SMOOTH_FRAMES
+        energy = np.convolve(energy, kernel, mode="same")
+    return lo + int(np.argmin(energy)) * frame + frame // 2
+
+
+def find_split_points(
+    audio,
+    sr=SAMPLE_RATE,
+    chunk_seconds=LONG_AUDIO_CHUNK_SECONDS,
+    search_seconds=SPLIT_SEARCH_SECONDS,
+):
+    # sample positions of the quietest spot near every chunk_seconds mark
+    chunk = int(chunk_seconds * sr)
+    search = int(search_seconds * sr)
+    points = []
+    last = 0
+    # the tail is merged into the last chunk rather than left tiny
+    while last + chunk + chunk // 4 < len(audio):
+        last = next_split_point(audio, last, sr, chunk, search)
+        points.append(last)
+    return points
+
+
+def chunk_bounds(points, n_samples, sr=SAMPLE_RATE, overlap_seconds=CHUNK_OVERLAP_SECONDS):
+    # (start, seam, end) per chunk, audio before the seam is only context
+    overlap = int(overlap_seconds * sr)
+    seams = [0] + points
+    ends = points + [n_samples]
+    return [(max(0, seam - overlap), seam, end) for seam, end in zip(seams, ends)]
+
+
+def _words(text):
+    return [w.lower() for w in WORD_RE.findall(text)]
+
+
+def _strip_leading_words(text, count):
+    # drops the first count words of text, keeping the rest as written
+    matches = list(WORD_RE.finditer(text))
+    if count >= len(matches):
+        return ""
+    return " " + text[matches[count].start() :]
+
+
+def _seam_overlap(prev_text, next_text):
+    prev_words = _words(prev_text)
+    next_words = _words(next_text)
+    for k in range(min(MAX_SEAM_WORDS, len(prev_words), len(next_words)), 0, -1):
+        if prev_words[-k:] == next_words[:k]:
+            return k
+    return 0
+
+
+class SegmentMerger:
+    # shifts chunk segments to the global timeline and removes seam duplicates,
+    # one chunk at a time in timeline order
+    def __init__(self, sr=SAMPLE_RATE):
+        self.sr = sr
+        self.segments = []
+        self.language = None
+
+    def add(self, result, bounds):
+        # returns the segments this chunk added
+        start, seam, _ = bounds
+        offset = start / self.sr
+        seam_time = seam / self.sr
+        added = []
+        for seg in result["segments"]:
+            seg = dict(seg, start=seg["start"] + offset, end=seg["end"] + offset)
+            if self.segments and seg["end"] <= seam_time:
+                # said in the overlap, the previous chunk already has it
+                continue
+            if self.segments and seg["start"] < seam_time:
+                k = _seam_overlap(self.segments[-1]["text"], seg["text"])
+                if k:
+                    seg["text"] = _strip_leading_words(seg["text"], k)
+                seg["start"] = max(seg["start"], self.segments[-1]["end"])
+                if not seg["text"].strip():
+                    continue
+            seg["id"] = len(self.segments)
+            self.segments.append(seg)
+            added.append(seg)
+        if self.language is None:
+            self.language = result.get("language")
+        return added
+
+    def result(self):
+        return {
+            "text": "".join(seg["text"] for seg in self.segments),
+            "segments": self.segments,
+            "language": self.language,
+        }
+
+
+def merge_chunk_results(results, bounds, sr=SAMPLE_RATE):
+    merger = SegmentMerger(sr)
+    for args in zip(results, bounds):
+        merger.add(*args)
+    return merger.result()
+
+
+async def transcribe_chunked(audio, language=None, sr=SAMPLE_RATE):
+    # splits at silence, transcribes chunks in parallel on the inference pool
+    # and stitches the segments back together
+    if language is None:
+        # detect once so that all chunks are transcribed in the same language
+        language = await inference_pool.run(
+            detect_language, audio[: 30 * sr], engines.WHISPER_ENGINE, current_size()
+        )
+    bounds = chunk_bounds(find_split_points(audio, sr), len(audio), sr)
+    results = await asyncio.gather(
+        *(
+            transcribe(audio[start:end], language)
+            for start, _, end in bounds
+        )
+    )
+    return merge_chunk_results(results, bounds, sr)
+
+
+async def stream_chunks(pipeline, language=None, sr=SAMPLE_RATE, first_chunk_seconds=None):
+    # transcribes the pipeline's audio as it is decoded, every chunk goes to the
+    # inference pool as soon as it is complete, and yields (result, bounds) in
+    # timeline order as results arrive; with first_chunk_seconds chunks start
+    # that short and double up to LONG_AUDIO_CHUNK_SECONDS, so the first text
+    # is ready quickly
+    max_chunk = int(LONG_AUDIO_CHUNK_SECONDS * sr)
+    chunk = max_chunk
+    if first_chunk_seconds is not None:
+        chunk = min(int(first_chunk_seconds * sr), max_chunk)
+    overlap = int(CHUNK_OVERLAP_SECONDS * sr)
+    pcm = pipeline.pcm
+    pending = deque()
+    waiting = None
+    try:
+        last = 0
+        while True:
+            search = min(int(SPLIT_SEARCH_SECONDS * sr), chunk // 4)
+            # same split decisions as find_split_points on the whole recording
+            target = last + max(chunk + chunk // 4 + 1, chunk + search)
+            if language is None:
+                target = 30 * sr
+            waiting = asyncio.ensure_future(pcm.wait_for(target))
+            while not waiting.done():
+                # hand out finished chunks while waiting for more audio
+                tasks = {waiting, pending[0][0]} if pending else {waiting}
+                await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                while pending and pending[0][0].done():
+                    task, bounds = pending.popleft()
+                    yield task.result(), bounds
+            try:
+                available = waiting.result()
+            except DecodeError:
+                # the stream itself can't be decoded, go on with the downloaded
+                # file; chunks already sent were decoded fine
+                pcm = PcmBuffer.from_array(await pipeline.audio())
+                continue
+            if language is None:
+                # detect once so that all chunks are transcribed in the same language
+                audio = pcm.data[: min(available, 30 * sr)]
+                language = await inference_pool.run(
+                    detect_language, audio, engines.WHISPER_ENGINE, current_size()
+                )
+                continue
+            if last + chunk + chunk // 4 >= available:
+                break
+            point = next_split_point(pcm.data[:available], last, sr, chunk, search)
+            bounds = (max(0, last - overlap), last, point)
+            audio = pcm.data[bounds[0] : point]
+            task = asyncio.ensure_future(transcribe(audio, language))
+            pending.append((task, bounds))
+            last = point
+            chunk = min(2 * chunk, max_chunk)
+        bounds = (max(0, last - overlap), last, available)
+        audio = pcm.data[bounds[0] : available]
+        task = asyncio.ensure_future(transcribe(audio, language))
+        pending.append((task, bounds))
+        while pending:
+            task, bounds = pending[0]
+            result = await task
+            pending.popleft()
+            yield result, bounds
+    finally:
+        if waiting is not None:
+            waiting.cancel()
+        for task, _ in pending:
+            task.cancel()
+
+
+async def transcribe_stream(pipeline, language=None, sr=SAMPLE_RATE):
+    # like transcribe_chunked, while the rest of the audio is still arriving
+    merger = SegmentMerger(sr)
+    async for result, bounds in stream_chunks(pipeline, language, sr):
+        merger.add(result, bounds)
+    return merger.result()
@@ -1,20 +1,107 @@
 import os
+import time
+import queue
+import asyncio
 import sqlite3
+import logging
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 
-DATA_DB_PATH = os.path.abspath(
-    os.path.join(os.path.dirname(__file__), "../../data/database.db")
+logger = logging.getLogger(__name__)
+
+# media, transcripts and the database; with distributed workers it is shared
+# storage mounted at the same path on every host
+DATA_DIR = os.path.abspath(
+    os.getenv("DATA_DIR") or os.path.join(os.path.dirname(__file__), "../../data")
 )
+# SQLite in WAL mode is not safe on NFS/SMB, keep it on a local disk when
+# DATA_DIR is shared storage
+DATA_DB_PATH = os.path.abspath(os.getenv("DATABASE_PATH") or os.path.join(DATA_DIR, "database.db"))
+DB_THREADS = int(os.getenv("DB_THREADS", "2"))
+DB_BATCH_INTERVAL = 0.5  # seconds between flushes of deferred writes
+
+_local = threading.local()
 
 
 def get_connection():
-    conn = sqlite3.connect(DATA_DB_PATH)
+    # one connection per thread, reused for all queries of that thread
+    conn = getattr(_local, "conn", None)
+    if conn is None or getattr(_local, "path", None) != DATA_DB_PATH:
+        conn = sqlite3.connect(DATA_DB_PATH, isolation_level=None, timeout=30)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        _local.conn = conn
+        _local.path = DATA_DB_PATH
     return conn
 
 
-def init_db():
-    os.makedirs(os.path.dirname(DATA_DB_PATH), exist_ok=True)
+@contextmanager
+def transaction():
+    # BEGIN IMMEDIATE takes the write lock up front, so reads inside the
+    # transaction can't be invalidated by a concurrent writer
     conn = get_connection()
-    c = conn.cursor()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        yield conn.cursor()
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    conn.execute("COMMIT")
+
+
+_executor = ThreadPoolExecutor(max_workers=DB_THREADS, thread_name_prefix="db")
+
+
+async def run_db(fn, *args, **kwargs):
+    # runs a db function on the db threads so the event loop never waits on disk
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor, partial(fn, *args, **kwargs))
+
+
+class WriteBatcher:
+    # collects small non-critical writes (access times) and flushes them
+    # in one transaction instead of one fsync per statement
+    def __init__(self, interval=DB_BATCH_INTERVAL):
+        self.interval = interval
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def defer(self, sql, params):
+        self._queue.put((sql, params))
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            self.flush()
+
+    def flush(self):
+        ops = []
+        while True:
+            try:
+                ops.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        if not ops:
+            return
+        try:
+            with transaction() as c:
+                for sql, params in ops:
+                    c.execute(sql, params)
+        except sqlite3.Error:
+            logger.exception("Failed to flush %d deferred writes", len(ops))
+
+
+batcher = WriteBatcher()
+
+
+def _migration_1(c):
     c.execute(
         """
         CREATE TABLE IF NOT EXISTS files (
@@ -28,58 +115,803 @@ def init_db():
         )
     """
     )
-    conn.commit()
-    conn.close()
+    c.execute(
+        """
+        CREATE TABLE IF NOT EXISTS jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_telegram_id INTEGER,
+            chat_id INTEGER,
+            idx INTEGER,
+            file_path TEXT,
+            transcriptions_dir TEXT,
+            language TEXT,
+            state TEXT,
+            error TEXT,
+            created_at REAL,
+            updated_at REAL
+        )
+    """
+    )
+    # databases created before the schema was versioned may have these already
+    add_column(c, "jobs", "media_hash", "TEXT")
+    c.execute(
+        """
+        CREATE TABLE IF NOT EXISTS transcript_cache (
+            key TEXT PRIMARY KEY,
+            media_hash TEXT,
+            model_size TEXT,
+            language TEXT,
+            path TEXT,
+            size_bytes INTEGER,
+            created_at REAL,
+            last_used REAL
+        )
+    """
+    )
+    c.execute(
+        """
+        CREATE TABLE IF NOT EXISTS llm_cache (
+            key TEXT PRIMARY KEY,
+            response TEXT,
+            size_bytes INTEGER,
+            created_at REAL,
+            last_used REAL
+        )
+    """
+    )
 
 
-def get_next_index(user_telegram_id):
-    conn = get_connection()
-    c = conn.cursor()
+def _migration_2(c):
+    # rows are now created when the upload starts, before a language is chosen
+    add_column(c, "files", "status", "TEXT NOT NULL DEFAULT 'scheduled'")
+    c.execute("CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, id)")
+    c.execute("CREATE INDEX IF NOT EXISTS llm_cache_lru ON llm_cache (last_used)")
     c.execute(
-        "SELECT MAX(idx) FROM files WHERE user_telegram_id=?", (user_telegram_id,)
+        "CREATE INDEX IF NOT EXISTS transcript_cache_lru ON transcript_cache (last_used)"
     )
-    result = c.fetchone()
-    conn.close()
-    return (result[0] or 0) + 1
 
 
-def make_video_id(user_telegram_id, idx):
-    return f"{user_telegram_id}_{idx}"
+def _migration_3(c):
+    # jobs claimed by distributed workers hold a lease they keep renewing
+    add_column(c, "jobs", "worker_id", "TEXT")
+    add_column(c, "jobs", "lease_until", "REAL")
+    add_column(c, "jobs", "attempts", "INTEGER NOT NULL DEFAULT 0")
+    add_column(c, "jobs", "model", "TEXT")
 
 
-def insert_file(user_telegram_id, idx, video_id, video_link, video_file_path, language):
-    conn = get_connection()
-    c = conn.cursor()
+def _migration_4(c):
+    # uploads waiting for a language and the dispatcher's FSM survive restarts
     c.execute(
         """
-        INSERT INTO files (user_telegram_id, idx, video_id, video_link, video_file_path, language)
-        VALUES (?, ?, ?, ?, ?, ?)
-    """,
-        (user_telegram_id, idx, video_id, video_link, video_file_path, language),
+        CREATE TABLE IF NOT EXISTS pending_uploads (
+            user_telegram_id INTEGER,
+            idx INTEGER,
+            chat_id INTEGER,
+            file_path TEXT,
+            transcriptions_dir TEXT,
+            media_hash TEXT,
+            created_at REAL,
+            PRIMARY KEY(user_telegram_id, idx)
+        )
+    """
+    )
+    c.execute(
+        """
+        CREATE TABLE IF NOT EXISTS fsm_state (
+            key TEXT PRIMARY KEY,
+            state TEXT,
+            data TEXT
+        )
+    """
+    )
+
+
+def _migration_5(c):
+    # bytes each upload takes on disk besides its transcripts, and whether the
+    # media is still the original, compacted to audio or evicted
+    add_column(c, "files", "stored_bytes", "INTEGER NOT NULL DEFAULT 0")
+    add_column(c, "files", "storage", "TEXT NOT NULL DEFAULT 'original'")
+    add_column(c, "files", "last_used", "REAL")
+    c.execute("CREATE INDEX IF NOT EXISTS jobs_file ON jobs (user_telegram_id, idx, state)")
+
+
+def _migration_6(c):
+    # transcript segments and their full-text index; the index reads the text
+    # through a view that adds the owner as a token ("u<user id>"), so a
+    # search matches one user's segments inside the index, not after ranking
+    # everyone's; triggers keep it in sync
+    c.execute(
+        """
+        CREATE TABLE IF NOT EXISTS transcript_segments (
+            id INTEGER PRIMARY KEY,
+            user_telegram_id INTEGER,
+            idx INTEGER,
+            transcriptions_dir TEXT,
+            start_ms INTEGER,
+            end_ms INTEGER,
+            text TEXT
+        )
+    """
+    )
+    c.execute(
+        "CREATE INDEX IF NOT EXISTS transcript_segments_dir ON transcript_segments (transcriptions_dir)"
+    )
+    c.execute(
+        """
+        CREATE VIEW IF NOT EXISTS transcript_documents AS
+        SELECT id, text, 'u' || user_telegram_id AS owner FROM transcript_segments
+    """
+    )
+    c.execute(
+        """
+        CREATE VIRTUAL TABLE IF NOT EXISTS transcript_fts USING fts5(
+            text,
+            owner,
+            content='transcript_documents',
+            content_rowid='id',
+            tokenize='unicode61 remove_diacritics 2'
+        )
+    """
+    )
+    # the owner column doesn't count towards relevance
+    c.execute("INSERT INTO transcript_fts (transcript_fts, rank) VALUES ('rank', 'bm25(1.0, 0.0)')")
+    c.execute(
+        """
+        CREATE TRIGGER IF NOT EXISTS transcript_segments_insert AFTER INSERT ON transcript_segments BEGIN
+            INSERT INTO transcript_fts (rowid, text, owner)
+            VALUES (new.id, new.text, 'u' || new.user_telegram_id);
+        END
+    """
+    )
+    c.execute(
+        """
+        CREATE TRIGGER IF NOT EXISTS transcript_segments_delete AFTER DELETE ON transcript_segments BEGIN
+            INSERT INTO transcript_fts (transcript_fts, rowid, text, owner)
+            VALUES ('delete', old.id, old.text, 'u' || old.user_telegram_id);
+        END
+    """
+    )
+    # transcripts in the index, with the mtime of the file they were read from
+    c.execute(
+        """
+        CREATE TABLE IF NOT EXISTS transcript_index (
+            transcriptions_dir TEXT PRIMARY KEY,
+            user_telegram_id INTEGER,
+            idx INTEGER,
+            mtime REAL
+        )
+    """
+    )
+
+
+def _migration_7(c):
+    # the model size chosen for a job and its duration, for queue estimates;
+    # real-time factors measured per model
+    add_column(c, "jobs", "model_size", "TEXT")
+    add_column(c, "jobs", "audio_seconds", "REAL")
+    c.execute(
+        """
+        CREATE TABLE IF NOT EXISTS model_speed (
+            model TEXT PRIMARY KEY,
+            rtf REAL,
+            samples INTEGER,
+            updated_at REAL
+        )
+    """
     )
-    conn.commit()
-    conn.close()
+
+
+# append only, the schema version is the number of applied migrations
+MIGRATIONS = [
+    _migration_1,
+    _migration_2,
+    _migration_3,
+    _migration_4,
+    _migration_5,
+    _migration_6,
+    _migration_7,
+]
+
+
+def add_column(c, table, column, column_type):
+    c.execute(f"PRAGMA table_info({table})")
+    if column not in [row[1] for row in c.fetchall()]:
+        c.execute(f"ALTER TABLE {table} ADD COLUMN {column} {column_type}")
+
+
+def init_db():
+    os.makedirs(os.path.dirname(DATA_DB_PATH), exist_ok=True)
+    with transaction() as c:
+        version = c.execute("PRAGMA user_version").fetchone()[0]
+        for i, migration in enumerate(MIGRATIONS[version:], version + 1):
+            logger.info("Applying database migration %d", i)
+            migration(c)
+            c.execute(f"PRAGMA user_version={i}")
+
+
+def make_video_id(user_telegram_id, idx):
+    return f"{user_telegram_id}_{idx}"
+
+
+def allocate_file(user_telegram_id, video_link=None):
+    # reserves the next idx of the user and its row in one transaction
+    with transaction() as c:
+        c.execute(
+            "SELECT MAX(idx) FROM files WHERE user_telegram_id=?", (user_telegram_id,)
+        )
+        idx = (c.fetchone()[0] or 0) + 1
+        video_id = make_video_id(user_telegram_id, idx)
+        c.execute(
+            """
+            INSERT INTO files (user_telegram_id, idx, video_id, video_link, status)
+            VALUES (?, ?, ?, ?, 'new')
+        """,
+            (user_telegram_id, idx, video_id, video_link),
+        )
+    return idx, video_id
+
+
+def set_file_path(user_telegram_id, idx, video_file_path, media_hash=None):
+    # the language may have been chosen while the file was still downloading,
+    # then the job was queued without the path and gets it here
+    with transaction() as c:
+        c.execute(
+            "UPDATE files SET video_file_path=?, status=CASE WHEN status='new' THEN 'uploaded' ELSE status END, last_used=? WHERE user_telegram_id=? AND idx=?",
+            (video_file_path, time.time(), user_telegram_id, idx),
+        )
+        c.execute(
+            "UPDATE jobs SET file_path=?, media_hash=?, updated_at=? WHERE user_telegram_id=? AND idx=? AND file_path IS NULL",
+            (video_file_path, media_hash, time.time(), user_telegram_id, idx),
+        )
+        c.execute(
+            "UPDATE pending_uploads SET file_path=?, media_hash=? WHERE user_telegram_id=? AND idx=?",
+            (video_file_path, media_hash, user_telegram_id, idx),
+        )
+
+
+def set_file_status(user_telegram_id, idx, status):
+    with transaction() as c:
+        c.execute(
+            "UPDATE files SET status=? WHERE user_telegram_id=? AND idx=?",
+            (status, user_telegram_id, idx),
+        )
+
+
+def schedule_file(user_telegram_id, idx, language, job_args):
+    # sets the language and queues the job atomically, the upload stops pending
+    with transaction() as c:
+        c.execute(
+            "UPDATE files SET language=?, status='scheduled', last_used=? WHERE user_telegram_id=? AND idx=?",
+            (language, time.time(), user_telegram_id, idx),
+        )
+        c.execute(
+            "DELETE FROM pending_uploads WHERE user_telegram_id=? AND idx=?",
+            (user_telegram_id, idx),
+        )
+        return _insert_job(c, *job_args)
+
+
+PENDING_COLUMNS = "user_telegram_id, idx, chat_id, file_path, transcriptions_dir, media_hash"
+
+
+def add_pending_upload(
+    user_telegram_id, idx, chat_id, file_path, transcriptions_dir, media_hash=None
+):
+    # an upload waiting for its language; file_path is NULL while downloading
+    with transaction() as c:
+        c.execute(
+            f"INSERT OR REPLACE INTO pending_uploads ({PENDING_COLUMNS}, created_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (user_telegram_id, idx, chat_id, file_path, transcriptions_dir, media_hash, time.time()),
+        )
+
+
+def get_pending_uploads(user_telegram_id=None):
+    # oldest first, of one user or of everyone
+    c = get_connection().cursor()
+    if user_telegram_id is None:
+        c.execute(f"SELECT {PENDING_COLUMNS} FROM pending_uploads ORDER BY created_at, idx")
+    else:
+        c.execute(
+            f"SELECT {PENDING_COLUMNS} FROM pending_uploads WHERE user_telegram_id=? ORDER BY created_at, idx",
+            (user_telegram_id,),
+        )
+    return c.fetchall()
+
+
+def delete_pending_upload(user_telegram_id, idx):
+    with transaction() as c:
+        c.execute(
+            "DELETE FROM pending_uploads WHERE user_telegram_id=? AND idx=?",
+            (user_telegram_id, idx),
+        )
 
 
 def get_user_files(user_telegram_id):
-    conn = get_connection()
-    c = conn.cursor()
+    c = get_connection().cursor()
     c.execute(
-        "SELECT idx, video_id, video_link, video_file_path, language FROM files WHERE user_telegram_id=? ORDER BY idx",
+        "SELECT idx, video_id, video_link, video_file_path, language, status, storage FROM files WHERE user_telegram_id=? AND status!='failed' ORDER BY idx",
         (user_telegram_id,),
     )
-    files = c.fetchall()
-    conn.close()
-    return files
+    return c.fetchall()
 
 
 def get_file_by_id(user_telegram_id, idx):
-    conn = get_connection()
-    c = conn.cursor()
+    # with the media hash of its latest job, files don't keep one
+    c = get_connection().cursor()
     c.execute(
-        "SELECT video_id, video_link, video_file_path, language FROM files WHERE user_telegram_id=? AND idx=?",
+        """
+        SELECT video_id, video_link, video_file_path, language, status, storage,
+            (SELECT media_hash FROM jobs WHERE jobs.user_telegram_id=files.user_telegram_id
+                AND jobs.idx=files.idx AND media_hash IS NOT NULL ORDER BY id DESC LIMIT 1)
+        FROM files WHERE user_telegram_id=? AND idx=?
+    """,
         (user_telegram_id, idx),
     )
-    file = c.fetchone()
-    conn.close()
-    return file
+    return c.fetchone()
+
+
+JOB_COLUMNS = "id, user_telegram_id, chat_id, idx, file_path, transcriptions_dir, language, media_hash, state, model_size, audio_seconds, created_at"
+
+
+def _insert_job(
+    c,
+    user_telegram_id,
+    chat_id,
+    idx,
+    file_path,
+    transcriptions_dir,
+    language,
+    media_hash,
+    model_size=None,
+    audio_seconds=None,
+):
+    now = time.time()
+    c.execute(
+        """
+        INSERT INTO jobs (user_telegram_id, chat_id, idx, file_path, transcriptions_dir, language, media_hash, model_size, audio_seconds, state, created_at, updated_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, 'queued', ?, ?)
+    """,
+        (
+            user_telegram_id,
+            chat_id,
+            idx,
+            file_path,
+            transcriptions_dir,
+            language,
+            media_hash,
+            model_size,
+            audio_seconds,
+            now,
+            now,
+        ),
+    )
+    return c.lastrowid
+
+
+def set_job_state(job_id, state, error=None):
+    with transaction() as c:
+        c.execute(
+            "UPDATE jobs SET state=?, error=?, updated_at=? WHERE id=?",
+            (state, error, time.time(), job_id),
+        )
+
+
+def get_jobs_by_state(state):
+    c = get_connection().cursor()
+    c.execute(f"SELECT {JOB_COLUMNS} FROM jobs WHERE state=? ORDER BY id", (state,))
+    return c.fetchall()
+
+
+def requeue_running_jobs():
+    # jobs left 'running' by a previous process were interrupted
+    with transaction() as c:
+        c.execute(
+            "UPDATE jobs SET state='queued', updated_at=? WHERE state='running'",
+            (time.time(),),
+        )
+        return c.rowcount
+
+
+# job protocol of distributed workers: 'queued' -> 'running' under a worker's
+# lease -> 'transcribed', 'cached' or 'error', picked up by the bot, which
+# delivers the result and sets 'done' or 'failed'
+REMOTE_JOB_COLUMNS = JOB_COLUMNS + ", model, error"
+FINISHED_REMOTE_STATES = ("transcribed", "cached", "error")
+
+
+def _expire_leases(c, max_attempts, now):
+    # jobs of workers that stopped heartbeating go back to the queue, or fail
+    # once they were tried max_attempts times (e.g. the file kills workers)
+    c.execute(
+        "UPDATE jobs SET state='error', error='the worker transcribing it stopped responding', worker_id=NULL, lease_until=NULL, updated_at=? WHERE state='running' AND lease_until<? AND attempts>=?",
+        (now, now, max_attempts),
+    )
+    expired = c.rowcount
+    c.execute(
+        "UPDATE jobs SET state='queued', worker_id=NULL, lease_until=NULL, updated_at=? WHERE state='running' AND lease_until<?",
+        (now, now),
+    )
+    return expired + c.rowcount
+
+
+def expire_leases(max_attempts):
+    with transaction() as c:
+        return _expire_leases(c, max_attempts, time.time())
+
+
+def claim_job(worker_id, lease_seconds, max_attempts):
+    # oldest queued job of the user with the fewest running jobs; jobs still
+    # waiting for their download have no file yet
+    now = time.time()
+    with transaction() as c:
+        _expire_leases(c, max_attempts, now)
+        c.execute(
+            """
+            SELECT id FROM jobs AS j WHERE state='queued' AND file_path IS NOT NULL
+            ORDER BY (SELECT COUNT(*) FROM jobs WHERE user_telegram_id=j.user_telegram_id AND state='running'), id
+            LIMIT 1
+        """
+        )
+        row = c.fetchone()
+        if row is None:
+            return None
+        c.execute(
+            "UPDATE jobs SET state='running', worker_id=?, lease_until=?, attempts=attempts+1, updated_at=? WHERE id=?",
+            (worker_id, now + lease_seconds, now, row[0]),
+        )
+        c.execute(f"SELECT {JOB_COLUMNS} FROM jobs WHERE id=?", row)
+        return c.fetchone()
+
+
+def renew_lease(job_id, worker_id, lease_seconds):
+    # False once the lease expired and the job went back to the queue
+    with transaction() as c:
+        c.execute(
+            "UPDATE jobs SET lease_until=? WHERE id=? AND worker_id=? AND state='running'",
+            (time.time() + lease_seconds, job_id, worker_id),
+        )
+        return c.rowcount > 0
+
+
+def complete_job(job_id, worker_id, state, error=None, model=None):
+    with transaction() as c:
+        c.execute(
+            "UPDATE jobs SET state=?, error=?, model=?, lease_until=NULL, updated_at=? WHERE id=? AND worker_id=? AND state='running'",
+            (state, error, model, time.time(), job_id, worker_id),
+        )
+        return c.rowcount > 0
+
+
+def release_job(job_id, worker_id):
+    # a worker shutting down hands its job back without using up an attempt
+    with transaction() as c:
+        c.execute(
+            "UPDATE jobs SET state='queued', worker_id=NULL, lease_until=NULL, attempts=attempts-1, updated_at=? WHERE id=? AND worker_id=? AND state='running'",
+            (time.time(), job_id, worker_id),
+        )
+
+
+def get_finished_remote_jobs():
+    c = get_connection().cursor()
+    c.execute(
+        f"SELECT {REMOTE_JOB_COLUMNS} FROM jobs WHERE state IN (?, ?, ?) ORDER BY id",
+        FINISHED_REMOTE_STATES,
+    )
+    return c.fetchall()
+
+
+def get_queued_job_ids():
+    c = get_connection().cursor()
+    c.execute("SELECT id FROM jobs WHERE state='queued' ORDER BY id")
+    return [row[0] for row in c.fetchall()]
+
+
+def get_active_jobs():
+    # (state, model_size, audio_seconds, updated_at) of the work ahead of a new job
+    c = get_connection().cursor()
+    c.execute(
+        "SELECT state, model_size, audio_seconds, updated_at FROM jobs WHERE state IN ('queued', 'running')"
+    )
+    return c.fetchall()
+
+
+def count_busy_workers(now):
+    c = get_connection().cursor()
+    c.execute(
+        "SELECT COUNT(DISTINCT worker_id) FROM jobs WHERE state='running' AND lease_until>=?",
+        (now,),
+    )
+    return c.fetchone()[0]
+
+
+def get_latest_job(user_telegram_id, idx):
+    # (transcriptions_dir, language, model_size, media_hash) of the file's last job
+    c = get_connection().cursor()
+    c.execute(
+        "SELECT transcriptions_dir, language, model_size, media_hash FROM jobs WHERE user_telegram_id=? AND idx=? ORDER BY id DESC LIMIT 1",
+        (user_telegram_id, idx),
+    )
+    return c.fetchone()
+
+
+def record_model_speed(model, rtf, weight, now):
+    # moving average of the real-time factor, a plain mean over the first
+    # 1 / weight jobs
+    with transaction() as c:
+        c.execute(
+            """
+            INSERT INTO model_speed (model, rtf, samples, updated_at) VALUES (?, ?, 1, ?)
+            ON CONFLICT(model) DO UPDATE SET
+                rtf=rtf + MAX(1.0 / (samples + 1), ?) * (excluded.rtf - rtf),
+                samples=samples + 1,
+                updated_at=excluded.updated_at
+        """,
+            (model, rtf, now, weight),
+        )
+
+
+def get_model_speeds():
+    c = get_connection().cursor()
+    c.execute("SELECT model, rtf FROM model_speed")
+    return dict(c.fetchall())
+
+
+def fail_interrupted_downloads():
+    # at startup every file still downloading was cut off by the shutdown;
+    # returns (user, idx, chat_id of the pending upload or None)
+    with transaction() as c:
+        c.execute(
+            """
+            SELECT f.user_telegram_id, f.idx, p.chat_id FROM files AS f
+            LEFT JOIN pending_uploads AS p ON p.user_telegram_id=f.user_telegram_id AND p.idx=f.idx
+            WHERE f.status='new'
+        """
+        )
+        rows = c.fetchall()
+        c.execute("UPDATE files SET status='failed' WHERE status='new'")
+        c.execute("DELETE FROM pending_uploads WHERE file_path IS NULL")
+        return rows
+
+
+def get_fsm_state(key):
+    c = get_connection().cursor()
+    c.execute("SELECT state, data FROM fsm_state WHERE key=?", (key,))
+    return c.fetchone()
+
+
+def set_fsm_state(key, state, data):
+    with transaction() as c:
+        if state is None and data == "{}":
+            c.execute("DELETE FROM fsm_state WHERE key=?", (key,))
+        else:
+            c.execute(
+                "INSERT OR REPLACE INTO fsm_state (key, state, data) VALUES (?, ?, ?)",
+                (key, state, data),
+            )
+
+
+# jobs that still read the media of their file
+ACTIVE_JOB_STATES = ("queued", "running")
+
+
+def has_active_jobs(user_telegram_id, idx, exclude_job_id=None):
+    # exclude_job_id: the job being delivered, still running until it is done
+    c = get_connection().cursor()
+    c.execute(
+        "SELECT 1 FROM jobs WHERE user_telegram_id=? AND idx=? AND state IN (?, ?) AND id IS NOT ? LIMIT 1",
+        (user_telegram_id, idx, *ACTIVE_JOB_STATES, exclude_job_id),
+    )
+    return c.fetchone() is not None
+
+
+def get_uncompacted_files():
+    # transcribed uploads that still keep their original media, e.g. because
+    # compacting them after delivery failed
+    c = get_connection().cursor()
+    c.execute(
+        f"""
+        SELECT user_telegram_id, idx FROM files
+        WHERE storage='original' AND status='scheduled' AND video_file_path IS NOT NULL
+            AND EXISTS (SELECT 1 FROM jobs WHERE jobs.user_telegram_id=files.user_telegram_id
+                AND jobs.idx=files.idx AND jobs.state='done')
+            AND NOT EXISTS (SELECT 1 FROM jobs WHERE jobs.user_telegram_id=files.user_telegram_id
+                AND jobs.idx=files.idx AND jobs.state IN {ACTIVE_JOB_STATES})
+        ORDER BY user_telegram_id, idx
+    """
+    )
+    return c.fetchall()
+
+
+def set_file_storage(user_telegram_id, idx, storage, stored_bytes, video_file_path=None):
+    # a new path (the compacted media) also goes to jobs queued in the meantime
+    with transaction() as c:
+        c.execute(
+            "UPDATE files SET storage=?, stored_bytes=?, video_file_path=COALESCE(?, video_file_path) WHERE user_telegram_id=? AND idx=?",
+            (storage, stored_bytes, video_file_path, user_telegram_id, idx),
+        )
+        if video_file_path is not None:
+            c.execute(
+                "UPDATE jobs SET file_path=? WHERE user_telegram_id=? AND idx=? AND state='queued'",
+                (video_file_path, user_telegram_id, idx),
+            )
+
+
+def get_storage_usage(user_telegram_id=None):
+    c = get_connection().cursor()
+    if user_telegram_id is None:
+        c.execute("SELECT COALESCE(SUM(stored_bytes), 0) FROM files")
+    else:
+        c.execute(
+            "SELECT COALESCE(SUM(stored_bytes), 0) FROM files WHERE user_telegram_id=?",
+            (user_telegram_id,),
+        )
+    return c.fetchone()[0]
+
+
+def get_eviction_candidates(user_telegram_id=None):
+    # stored media no job or language prompt is waiting for, least recently used first
+    c = get_connection().cursor()
+    query = f"""
+        SELECT user_telegram_id, idx, video_file_path, storage, stored_bytes FROM files
+        WHERE stored_bytes>0 AND status NOT IN ('new', 'uploaded')
+            AND NOT EXISTS (SELECT 1 FROM jobs WHERE jobs.user_telegram_id=files.user_telegram_id
+                AND jobs.idx=files.idx AND jobs.state IN {ACTIVE_JOB_STATES})
+            {"AND user_telegram_id=?" if user_telegram_id is not None else ""}
+        ORDER BY COALESCE(last_used, 0), user_telegram_id, idx
+    """
+    c.execute(query, () if user_telegram_id is None else (user_telegram_id,))
+    return c.fetchall()
+
+
+def get_stored_files():
+    c = get_connection().cursor()
+    c.execute(
+        "SELECT user_telegram_id, idx, status, storage, stored_bytes FROM files"
+    )
+    return c.fetchall()
+
+
+def fail_abandoned_uploads(min_created_at):
+    # uploads nobody picked a language for since min_created_at stop pending;
+    # returns their (user, idx)
+    with transaction() as c:
+        c.execute(
+            "SELECT user_telegram_id, idx FROM pending_uploads WHERE created_at<?",
+            (min_created_at,),
+        )
+        rows = c.fetchall()
+        c.executemany(
+            "UPDATE files SET status='failed' WHERE user_telegram_id=? AND idx=?", rows
+        )
+        c.execute("DELETE FROM pending_uploads WHERE created_at<?", (min_created_at,))
+        return rows
+
+
+def replace_transcript_segments(user_telegram_id, idx, transcriptions_dir, segments, mtime):
+    # segments are (start_ms, end_ms, text); a transcript indexed before is replaced
+    with transaction() as c:
+        c.execute(
+            "DELETE FROM transcript_segments WHERE transcriptions_dir=?", (transcriptions_dir,)
+        )
+        c.executemany(
+            "INSERT INTO transcript_segments (user_telegram_id, idx, transcriptions_dir, start_ms, end_ms, text) VALUES (?, ?, ?, ?, ?, ?)",
+            [(user_telegram_id, idx, transcriptions_dir, *seg) for seg in segments],
+        )
+        c.execute(
+            "INSERT OR REPLACE INTO transcript_index (transcriptions_dir, user_telegram_id, idx, mtime) VALUES (?, ?, ?, ?)",
+            (transcriptions_dir, user_telegram_id, idx, mtime),
+        )
+
+
+def get_indexed_transcripts():
+    c = get_connection().cursor()
+    c.execute("SELECT transcriptions_dir, mtime FROM transcript_index")
+    return dict(c.fetchall())
+
+
+def get_finished_transcriptions():
+    # (user, idx, transcriptions_dir) of every delivered job
+    c = get_connection().cursor()
+    c.execute(
+        "SELECT DISTINCT user_telegram_id, idx, transcriptions_dir FROM jobs WHERE state='done'"
+    )
+    return c.fetchall()
+
+
+def get_file_paths():
+    # (user, idx, video_file_path or None) of every upload that didn't fail
+    c = get_connection().cursor()
+    c.execute(
+        "SELECT user_telegram_id, idx, video_file_path FROM files WHERE status!='failed'"
+    )
+    return c.fetchall()
+
+
+def search_segments(user_telegram_id, query, limit):
+    # best matches first; query is an FTS5 expression over the text, the
+    # snippet marks matched words with \x02 and \x03
+    c = get_connection().cursor()
+    c.execute(
+        """
+        SELECT f.video_id, s.transcriptions_dir, s.start_ms, s.end_ms,
+            snippet(transcript_fts, 0, char(2), char(3), '…', 16)
+        FROM transcript_fts
+        JOIN transcript_segments AS s ON s.id=transcript_fts.rowid
+        JOIN files AS f ON f.user_telegram_id=s.user_telegram_id AND f.idx=s.idx
+        WHERE transcript_fts MATCH ?
+        ORDER BY rank LIMIT ?
+    """,
+        (f'owner : "u{int(user_telegram_id)}" AND text : ({query})', limit),
+    )
+    return c.fetchall()
+
+
+def get_cache_entry(key):
+    c = get_connection().cursor()
+    c.execute("SELECT path, size_bytes FROM transcript_cache WHERE key=?", (key,))
+    return c.fetchone()
+
+
+def put_cache_entry(key, media_hash, model_size, language, path, size_bytes, now):
+    with transaction() as c:
+        c.execute(
+            """
+            INSERT OR REPLACE INTO transcript_cache (key, media_hash, model_size, language, path, size_bytes, created_at, last_used)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        """,
+            (key, media_hash, model_size, language, path, size_bytes, now, now),
+        )
+
+
+def touch_cache_entry(key, now):
+    batcher.defer("UPDATE transcript_cache SET last_used=? WHERE key=?", (now, key))
+
+
+def delete_cache_entry(key):
+    with transaction() as c:
+        c.execute("DELETE FROM transcript_cache WHERE key=?", (key,))
+
+
+def get_cache_entries_lru():
+    c = get_connection().cursor()
+    c.execute("SELECT key, path, size_bytes FROM transcript_cache ORDER BY last_used")
+    return c.fetchall()
+
+
+def get_llm_response(key, min_created_at, now):
+    c = get_connection().cursor()
+    c.execute(
+        "SELECT response FROM llm_cache WHERE key=? AND created_at>=?",
+        (key, min_created_at),
+    )
+    row = c.fetchone()
+    if row is not None:
+        batcher.defer("UPDATE llm_cache SET last_used=? WHERE key=?", (now, key))
+    return row[0] if row else None
+
+
+def put_llm_response(key, response, size_bytes, now):
+    with transaction() as c:
+        c.execute(
+            """
+            INSERT OR REPLACE INTO llm_cache (key, response, size_bytes, created_at, last_used)
+            VALUES (?, ?, ?, ?, ?)
+        """,
+            (key, response, size_bytes, now, now),
+        )
+
+
+def delete_expired_llm_responses(min_created_at):
+    with transaction() as c:
+        c.execute("DELETE FROM llm_cache WHERE created_at<?", (min_created_at,))
+
+
+def get_llm_cache_entries_lru():
+    c = get_connection().cursor()
+    c.execute("SELECT key, size_bytes FROM llm_cache ORDER BY last_used")
+    return c.fetchall()
+
+
+def delete_llm_responses(keys):
+    with transaction() as c:
+        c.executemany("DELETE FROM llm_cache WHERE key=?", [(key,) for key in keys])
@@ -0,0 +1,164 @@
+import os
+import re
+import asyncio
+import hashlib
+import logging
+from urllib.parse import unquote
+
+import aiofiles
+import aiohttp
+
+logger = logging.getLogger(__name__)
+
+MAX_CONCURRENT_DOWNLOADS = int(os.getenv("MAX_CONCURRENT_DOWNLOADS", "3"))
+DOWNLOAD_RETRIES = int(os.getenv("DOWNLOAD_RETRIES", "5"))
+DOWNLOAD_CHUNK_SIZE = 1 << 20
+DOWNLOAD_BACKOFF = 2.0  # seconds, doubled with every retry
+GDRIVE_DOWNLOAD_URL = os.getenv(
+    "GDRIVE_DOWNLOAD_URL", "https://drive.usercontent.google.com/download"
+)
+YADISK_API_URL = os.getenv(
+    "YADISK_API_URL", "https://cloud-api.yandex.net/v1/disk/public/resources"
+)
+
+GDRIVE_ID_RE = re.compile(r"(?:/d/|[?&]id=)([\w-]{10,})")
+FILENAME_STAR_RE = re.compile(r"filename\*=(?:UTF-8|utf-8)''([^;]+)")
+FILENAME_RE = re.compile(r'filename="?([^";]+)"?')
+
+_session = None
+_semaphore = None
+
+
+class DownloadError(RuntimeError):
+    pass
+
+
+def get_session():
+    # one pooled session for all downloads, keeps connections alive between them
+    global _session
+    if _session is None or _session.closed:
+        _session = aiohttp.ClientSession(
+            timeout=aiohttp.ClientTimeout(total=None, sock_connect=30, sock_read=120),
+            connector=aiohttp.TCPConnector(limit=MAX_CONCURRENT_DOWNLOADS * 2),
+        )
+    return _session
+
+
+def _get_semaphore():
+    global _semaphore
+    if _semaphore is None:
+        _semaphore = asyncio.Semaphore(MAX_CONCURRENT_DOWNLOADS)
+    return _semaphore
+
+
+async def close():
+    if _session is not None:
+        await _session.close()
+
+
+def filename_from_headers(headers):
+    disposition = headers.get("Content-Disposition", "")
+    match = FILENAME_STAR_RE.search(disposition) or FILENAME_RE.search(disposition)
+    if match:
+        return os.path.basename(unquote(match[1]).strip())
+    return None
+
+
+def _hash_existing(path, sha):
+    with open(path, "rb") as f:
+        while block := f.read(DOWNLOAD_CHUNK_SIZE):
+            sha.update(block)
+
+
+async def fetch(url, dest_dir, filename=None, progress=None, params=None, sink=None):
+    # streams url to dest_dir in chunks and returns (path, sha256 of the content);
+    # interrupted transfers continue from the partial file with a Range request.
+    # sink gets every chunk as it arrives and is reset when the bytes it was
+    # fed stop being the start of the file
+    session = get_session()
+    loop = asyncio.get_running_loop()
+    part_path = None
+    sha = hashlib.sha256()
+    done = total = 0
+    attempt = 0
+    async with _get_semaphore():
+        while True:
+            headers = {"Range": f"bytes={done}-"} if done else {}
+            try:
+                async with session.get(url, params=params, headers=headers) as resp:
+                    if resp.status == 429 or resp.status >= 500:
+                        # overloaded or flaky server, retried like a dropped connection
+                        resp.raise_for_status()
+                    if resp.status not in (200, 206):
+                        raise DownloadError(f"HTTP {resp.status} from {resp.url.host}")
+                    if resp.content_type == "text/html":
+                        raise DownloadError(
+                            "Got a web page instead of the file, is it shared publicly?"
+                        )
+                    if part_path is None:
+                        filename = filename or filename_from_headers(resp.headers) or "file"
+                        part_path = os.path.join(dest_dir, filename + ".part")
+                        if os.path.exists(part_path) and os.path.getsize(part_path):
+                            # left over from an earlier attempt, resume it
+                            await loop.run_in_executor(None, _hash_existing, part_path, sha)
+                            done = os.path.getsize(part_path)
+                            if sink:
+                                sink.reset()
+                            continue
+                    if resp.status == 200 and done:
+                        # server ignored the range, start over
+                        done = 0
+                        sha = hashlib.sha256()
+                        if sink:
+                            sink.reset()
+                    if resp.content_length:
+                        total = done + resp.content_length
+                    async with aiofiles.open(part_path, "ab" if done else "wb") as f:
+                        async for chunk in resp.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+                            await f.write(chunk)
+                            sha.update(chunk)
+                            if sink:
+                                sink.feed(chunk)
+                            done += len(chunk)
+                            if progress:
+                                await progress(done, total)
+                if total and done < total:
+                    raise aiohttp.ClientPayloadError(f"connection closed at {done} of {total} bytes")
+                break
+            except (aiohttp.ClientError, asyncio.TimeoutError) as ex:
+                attempt += 1
+                if attempt > DOWNLOAD_RETRIES:
+                    raise DownloadError(f"Download failed: {ex}") from ex
+                delay = DOWNLOAD_BACKOFF * 2 ** (attempt - 1)
+                logger.warning(
+                    "Download interrupted at %d bytes (%s), retrying in %.0f s", done, ex, delay
+                )
+                await asyncio.sleep(delay)
+    path = part_path[: -len(".part")]
+    os.replace(part_path, path)
+    return path, sha.hexdigest()
+
+
+async def gdrive_download(link, output_dir, progress=None, sink=None):
+    match = GDRIVE_ID_RE.search(link)
+    if not match:
+        raise DownloadError("Can't find the file id in the Google Drive link")
+    params = {"id": match[1], "export": "download", "confirm": "t"}
+    return await fetch(
+        GDRIVE_DOWNLOAD_URL, output_dir, progress=progress, params=params, sink=sink
+    )
+
+
+async def yandex_disk_download(link, output_dir, progress=None, sink=None):
+    session = get_session()
+    params = {"public_key": link}
+    try:
+        async with session.get(YADISK_API_URL, params=dict(params, fields="name")) as resp:
+            resp.raise_for_status()
+            filename = os.path.basename((await resp.json())["name"])
+        async with session.get(YADISK_API_URL + "/download", params=params) as resp:
+            resp.raise_for_status()
+            href = (await resp.json())["href"]
+    except (aiohttp.ClientError, KeyError) as ex:
+        raise DownloadError(f"Yandex Disk download failed: {ex}") from ex
+    return await fetch(href, output_dir, filename=filename, progress=progress, sink=sink)
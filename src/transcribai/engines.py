@@ -0,0 +1,154 @@
+import os
+import warnings
+
+# inference backend of the deployment
+WHISPER_ENGINE = os.getenv("WHISPER_ENGINE", "whisper")
+FASTER_WHISPER_COMPUTE_TYPE = os.getenv("FASTER_WHISPER_COMPUTE_TYPE", "int8")
+
+
+def _tensor_bytes(value):
+    import torch
+
+    if torch.is_tensor(value):
+        return value.numel() * value.element_size()
+    if isinstance(value, (tuple, list)):
+        return sum(_tensor_bytes(v) for v in value)
+    return 0
+
+
+class WhisperEngine:
+    # openai-whisper as is, fp32 on CPU
+    name = "whisper"
+    bytes_per_param = 4
+    # the model is a whisper.model.Whisper, batched decoding works on it
+    batched = True
+
+    def device(self, device):
+        return device
+
+    def load(self, model_size, device):
+        import whisper
+
+        return whisper.load_model(model_size, device=device)
+
+    def model_bytes(self, model):
+        # quantized layers keep their weights in packed params, not parameters
+        return sum(_tensor_bytes(v) for v in model.state_dict().values())
+
+    def transcribe(self, model, audio, language=None):
+        kwargs = {}
+        if language:
+            kwargs["language"] = language
+        return model.transcribe(audio, **kwargs)
+
+    def detect_language(self, model, audio):
+        import whisper
+
+        mel = whisper.log_mel_spectrogram(
+            whisper.pad_or_trim(audio), model.dims.n_mels
+        ).to(model.device)
+        _, probs = model.detect_language(mel)
+        return max(probs, key=probs.get)
+
+
+class QuantizedWhisperEngine(WhisperEngine):
+    # the same model with the weights of every linear layer dynamically
+    # quantized to int8, activations are quantized on the fly; CPU only
+    name = "whisper-int8"
+    bytes_per_param = 1.5  # embeddings and convolutions stay fp32
+
+    def device(self, device):
+        return "cpu"
+
+    def load(self, model_size, device):
+        import torch
+        import whisper.model
+
+        model = super().load(model_size, "cpu")
+        # whisper subclasses nn.Linear only to cast weights to the input
+        # dtype, the quantizer accepts nothing but plain nn.Linear
+        for module in model.modules():
+            if type(module) is whisper.model.Linear:
+                module.__class__ = torch.nn.Linear
+        with warnings.catch_warnings():
+            # torch.ao.quantization warns that it moves to torchao
+            warnings.simplefilter("ignore")
+            return torch.ao.quantization.quantize_dynamic(
+                model, {torch.nn.Linear}, dtype=torch.qint8
+            )
+
+
+class FasterWhisperEngine:
+    # CTranslate2 runtime (faster-whisper package, not installed by default),
+    # int8 on CPU unless FASTER_WHISPER_COMPUTE_TYPE says otherwise
+    name = "faster-whisper"
+    bytes_per_param = 1
+    batched = False
+
+    def device(self, device):
+        return device
+
+    def load(self, model_size, device):
+        try:
+            from faster_whisper import WhisperModel
+        except ImportError:
+            raise RuntimeError("the faster-whisper engine needs the faster-whisper package")
+        import torch
+
+        kind, _, index = device.partition(":")
+        return WhisperModel(
+            model_size,
+            device=kind,
+            device_index=int(index or 0),
+            compute_type=FASTER_WHISPER_COMPUTE_TYPE,
+            cpu_threads=torch.get_num_threads(),
+        )
+
+    def model_bytes(self, model):
+        return 0  # not visible from Python, the estimate is used instead
+
+    def transcribe(self, model, audio, language=None):
+        segments, info = model.transcribe(audio, language=language)
+        segments = [
+            {
+                "id": i,
+                "seek": 0,
+                "start": seg.start,
+                "end": seg.end,
+                "text": seg.text,
+                "tokens": list(seg.tokens),
+                "temperature": seg.temperature,
+                "avg_logprob": seg.avg_logprob,
+                "compression_ratio": seg.compression_ratio,
+                "no_speech_prob": seg.no_speech_prob,
+            }
+            for i, seg in enumerate(segments)
+        ]
+        return {
+            "text": "".join(seg["text"] for seg in segments),
+            "segments": segments,
+            "language": info.language,
+        }
+
+    def detect_language(self, model, audio):
+        # the language is detected before the lazy segment generator runs
+        _, info = model.transcribe(audio)
+        return info.language
+
+
+ENGINES = {
+    engine.name: engine
+    for engine in (WhisperEngine(), QuantizedWhisperEngine(), FasterWhisperEngine())
+}
+
+if WHISPER_ENGINE not in ENGINES:
+    raise ValueError(f"WHISPER_ENGINE must be one of {', '.join(ENGINES)}")
+
+
+def get(name=None):
+    return ENGINES[name or WHISPER_ENGINE]
+
+
+def model_label(model_size, name):
+    # model name in cache keys, engines other than whisper transcribe differently
+    return model_size if name == "whisper" else f"{model_size}-{name}"
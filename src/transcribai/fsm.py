@@ -0,0 +1,65 @@
+import os
+import json
+from collections import OrderedDict
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder
+
+from .db import run_db, get_fsm_state, set_fsm_state
+
+# conversations kept in memory, least recently used ones are read again from
+# the database
+FSM_CACHE_SIZE = int(os.getenv("FSM_CACHE_SIZE", "10000"))
+
+
+class SQLiteStorage(BaseStorage):
+    # FSM storage in the bot's database, so users keep their conversation
+    # state across restarts; reads are served from memory after the first
+    # one, writes go through to the database
+    def __init__(self, cache_size=FSM_CACHE_SIZE):
+        self.key_builder = DefaultKeyBuilder(with_destiny=True)
+        self.cache_size = cache_size
+        self._cache = OrderedDict()  # key -> (state, data), least recent first
+
+    def _remember(self, key, entry):
+        self._cache[key] = entry
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    async def _load(self, key):
+        key = self.key_builder.build(key)
+        entry = self._cache.get(key)
+        if entry is None:
+            row = await run_db(get_fsm_state, key)
+            entry = (row[0], json.loads(row[1] or "{}")) if row else (None, {})
+        self._remember(key, entry)
+        return key, entry
+
+    async def _store(self, key, state, data):
+        if state is None and not data:
+            # cleared, like its row; the next read finds nothing either way
+            self._cache.pop(key, None)
+        else:
+            self._remember(key, (state, data))
+        await run_db(set_fsm_state, key, state, json.dumps(data))
+
+    async def set_state(self, key, state=None):
+        key, (_, data) = await self._load(key)
+        state = state.state if isinstance(state, State) else state
+        await self._store(key, state, data)
+
+    async def get_state(self, key):
+        _, (state, _) = await self._load(key)
+        return state
+
+    async def set_data(self, key, data):
+        key, (state, _) = await self._load(key)
+        await self._store(key, state, dict(data))
+
+    async def get_data(self, key):
+        _, (_, data) = await self._load(key)
+        return dict(data)
+
+    async def close(self):
+        self._cache.clear()
@@ -1,12 +1,11 @@
 import os
 import re
+import time
 import asyncio
-import concurrent.futures
+import logging
 from dotenv import load_dotenv
-from subprocess import CalledProcessError, run
-import numpy as np
 
-from aiogram import Router, F
+from aiogram import Bot, Router, F
 from aiogram.types import (
     Message,
     FSInputFile,
@@ -14,40 +13,66 @@ from aiogram.types import (
     KeyboardButton,
     ReplyKeyboardRemove,
 )
-from aiogram.filters import Command
+from aiogram.filters import Command, CommandObject
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import StatesGroup, State
 
-from .db import insert_file, get_next_index, make_video_id, get_user_files
+from .db import (
+    run_db,
+    allocate_file,
+    make_video_id,
+    set_file_path,
+    set_file_status,
+    get_user_files,
+    get_file_by_id,
+    get_latest_job,
+    add_pending_upload,
+    get_pending_uploads,
+    delete_pending_upload,
+    fail_interrupted_downloads,
+)
+from .scheduler import DISTRIBUTED_WORKERS, scheduler
+from . import cache
+from . import policy
+from . import search
+from . import storage
+from .storage import DATABASE_DIR
+from .cache import HashingWriter, cache_key
+from . import downloads
+from . import metrics
+from . import pipeline as pipelines
+from .pipeline import STREAMING_PIPELINE, AudioPipeline
+from .progress import ProgressMessage, human_size, progress_bar, transcript_progress
 
 # added summarization logic to the bot
-from .summarizer import full_process
-
-import whisper
-import torch
-from imageio_ffmpeg import get_ffmpeg_exe
+from .summarizer import summarize
 
-# path to video processing executable
-if "ffmpeg" not in str(os.environ.get("PATH")):
-    FFMPEG_BINARY = get_ffmpeg_exe()
-    os.environ["PATH"] = os.environ["PATH"] + ";" + FFMPEG_BINARY
+from .transcriber import TranscriptWriter
+from .job_runner import async_transcribe, lookup_cached
+from .chunking import SAMPLE_RATE, SegmentMerger, stream_chunks
+from .batching import worker_model
+from .models import selected_size
 
 load_dotenv("secrets.env")
 
+logger = logging.getLogger(__name__)
 router = Router()
 
-DATABASE_DIR = os.path.abspath(
-    os.path.join(os.path.dirname(__file__), "../../data/database")
-)
-os.makedirs(DATABASE_DIR, exist_ok=True)
-
 GOOGLE_DRIVE_LINK_RE = re.compile(
     r"(https?://)?(drive\.google\.com|docs\.google\.com)/[^\s]+"
 )
 YANDEX_DISK_LINK_RE = re.compile(
     r"(https?://)?(yadi\.sk|disk\.(?:360\.)?yandex\.[^/]+)/[^\s]+"
 )
+LANGUAGE_CODE_RE = re.compile(r"auto|[a-z]{2,3}")
 MAX_BOT_FILE_SIZE = 20 * 1024 * 1024  # 20 MB
+# send transcript text while the transcription is running; only for long
+# recordings, chunking changes the output, shorter ones are transcribed whole
+INCREMENTAL_DELIVERY = os.getenv("INCREMENTAL_DELIVERY", "0") == "1"
+INCREMENTAL_MIN_SECONDS = float(os.getenv("INCREMENTAL_MIN_SECONDS", "600"))
+INCREMENTAL_FIRST_CHUNK_SECONDS = float(os.getenv("INCREMENTAL_FIRST_CHUNK_SECONDS", "30"))
+# decoding in the bot is wasted when a worker on another host transcribes
+STREAMING = STREAMING_PIPELINE and not DISTRIBUTED_WORKERS
 
 
 LANG_OPTIONS = [
@@ -82,95 +107,84 @@ class UploadStates(StatesGroup):
     waiting_for_language = State()
 
 
-pending_files = {}
-
-
-def load_audio(file: str, sr: int = 16000):
-    cmd = [
-        FFMPEG_BINARY,
-        "-nostdin",
-        "-threads",
-        "0",
-        "-i",
-        file,
-        "-f",
-        "s16le",
-        "-ac",
-        "1",
-        "-acodec",
-        "pcm_s16le",
-        "-ar",
-        str(sr),
-        "-",
-    ]
-    try:
-        out = run(cmd, capture_output=True, check=True).stdout
-    except CalledProcessError as e:
-        raise RuntimeError(f"Failed to load audio: {e.stderr.decode()}") from e
-
-    return np.frombuffer(out, np.int16).flatten().astype(np.float32) / 32768.0
-
-
-def srt_time(seconds):
-    h, m = divmod(int(seconds // 60), 60)
-    s = int(seconds % 60)
-    ms = int((seconds - int(seconds)) * 1000)
-    return f"{h:02}:{m:02}:{s:02},{ms:03}"
-
-
-def write_srt(segments, srt_path):
-    with open(srt_path, "w") as f:
-        for i, seg in enumerate(segments, 1):
-            f.write(f"{i}\n")
-            f.write(f"{srt_time(seg['start'])} - {srt_time(seg['end'])}\n")
-            f.write(seg["text"].strip() + "\n\n")
-
-
-def write_txt_with_timecodes(segments, txt_path):
-    with open(txt_path, "w", encoding="utf8") as f:
-        for seg in segments:
-            start = srt_time(seg["start"])
-            end = srt_time(seg["end"])
-            try:
-                text = seg["text"].strip()
-            except:
-                text = ""
-            f.write(f"[{start} --> {end}]  {text}\n")
-
-
-def save_transcripts(result, transcriptions_dir):
-    os.makedirs(transcriptions_dir, exist_ok=True)
-    srt_path = os.path.join(transcriptions_dir, "transcript.srt")
-    txt_path = os.path.join(transcriptions_dir, "transcript.txt")
-    write_srt(result["segments"], srt_path)
-    write_txt_with_timecodes(result["segments"], txt_path)
-    return srt_path, txt_path
-
-
-# NEW VERSION
-async def async_transcribe(file_path, transcriptions_dir, language=None):
-    loop = asyncio.get_event_loop()
-
-    def task():
-        kwargs = {}
-        mm = {6: "turbo", 5: "medium", 2: "small", 1: "base"}  # VRAM for model sizes
-
-        if language:
-            kwargs["language"] = language
-        device = "cuda:0" if torch.cuda.is_available() else "cpu"
-        if "cuda" in device:  # auto choose model size
-            tm = torch.cuda.get_device_properties().total_memory / 1e9 - 1
-            for m in mm.keys():
-                if tm > m:
-                    model_size = mm[m]
-                    break
-        else:
-            model_size = "small"  # biggest suitable for CPU imho
-        model = whisper.load_model(model_size)
-        result = model.transcribe(load_audio(file_path), **kwargs)
-        return save_transcripts(result, transcriptions_dir)
+LANGUAGE_PROMPT = "Please choose the language of the lecture (or press 'Auto' for automatic detection):"
+
+
+async def ask_language(message: Message, state: FSMContext, prompt=LANGUAGE_PROMPT):
+    # the answer goes to the user's oldest pending upload, with several of
+    # them pending the prompt names the file it is for
+    pending = await run_db(get_pending_uploads, message.from_user.id)
+    if not pending:
+        await state.clear()
+        return
+    if len(pending) > 1:
+        video_id = make_video_id(message.from_user.id, pending[0][1])
+        prompt = (
+            f"Please choose the language of <b>{video_id}</b> "
+            "(or press 'Auto' for automatic detection):"
+        )
+    await message.answer(prompt, reply_markup=language_keyboard(), parse_mode="HTML")
+    await state.set_state(UploadStates.waiting_for_language)
 
-    return await loop.run_in_executor(None, task)
+
+async def recover_pending_uploads(bot: Bot):
+    # run at startup: downloads the last shutdown cut off are failed and their
+    # users asked to send the link again; finished uploads stay pending and
+    # the persisted FSM state still routes the language answer to them
+    for user_id, idx, chat_id in await run_db(fail_interrupted_downloads):
+        try:
+            await bot.send_message(
+                chat_id or user_id,
+                f"The download of <b>{make_video_id(user_id, idx)}</b> was interrupted "
+                "by a restart, please send it again.",
+                parse_mode="HTML",
+            )
+        except Exception:
+            logger.exception("Failed to notify user %s about interrupted download", user_id)
+    pending = await run_db(get_pending_uploads)
+    if pending:
+        logger.info("%d uploads are waiting for a language", len(pending))
+
+
+async def use_incremental(job, pipeline):
+    # long recordings, and links still downloading whose length isn't known yet
+    if not INCREMENTAL_DELIVERY:
+        return False
+    duration = job.audio_seconds
+    if duration is None and pipeline is not None and not pipeline.decoding:
+        duration = pipeline.pcm.length / SAMPLE_RATE
+    if duration is None and job.file_path:
+        loop = asyncio.get_running_loop()
+        duration = await loop.run_in_executor(None, policy.media_duration, job.file_path)
+    return duration is None or duration >= INCREMENTAL_MIN_SECONDS
+
+
+async def transcribe_incremental(
+    bot, chat_id, file_path, transcriptions_dir, language=None, pipeline=None
+):
+    # segments are appended to the transcript files and shown in a progress
+    # message chunk by chunk; the first chunk is short so text appears early
+    if pipeline is None:
+        pipeline = AudioPipeline.from_file(file_path)
+    status = ProgressMessage(bot, chat_id)
+    merger = SegmentMerger()
+    position = 0.0
+    start = time.perf_counter()
+    with TranscriptWriter(transcriptions_dir) as writer:
+        async for result, bounds in stream_chunks(
+            pipeline, language, first_chunk_seconds=INCREMENTAL_FIRST_CHUNK_SECONDS
+        ):
+            with metrics.stage("write"):
+                writer.append(merger.add(result, bounds))
+            position = bounds[2] / SAMPLE_RATE
+            duration = None if pipeline.decoding else pipeline.pcm.length / SAMPLE_RATE
+            await status.update(transcript_progress(position, duration, merger.segments))
+    metrics.record_transcription(position, time.perf_counter() - start)
+    await asyncio.get_running_loop().run_in_executor(None, pipeline.save_pcm)
+    await status.update(
+        transcript_progress(position, position, merger.segments), force=True
+    )
+    return writer.srt_path, writer.txt_path
 
 
 @router.message(Command("help"))
@@ -188,33 +202,165 @@ async def help_handler(message: Message):
         "<b>Commands:</b>\n"
         "/help — Show this help and command descriptions.\n"
         "/list — List all your uploaded files and links (IDs are clickable links for link uploads).\n"
+        "/retranscribe &lt;ID&gt; &lt;language&gt; — Transcribe an uploaded file again, e.g. <code>/retranscribe 3 en</code> (auto for automatic detection).\n"
+        "/search &lt;words&gt; — Find where words were said in your transcripts.\n"
+        "/upgrade &lt;ID&gt; — Transcribe a file again with the full quality model, if a faster one was used to deliver it sooner.\n"
         "\nSend a file or link to start!",
         parse_mode="HTML",
     )
 
 
-@router.message(F.text)
-async def echo_handler(message: Message):
-    await message.answer(message.text)
-
-
 @router.message(Command("list"))
 async def list_handler(message: Message):
     user_id = message.from_user.id
-    files = get_user_files(user_id)
+    files = await run_db(get_user_files, user_id)
     if not files:
         await message.answer("You haven't uploaded any files or links yet.")
         return
     lines = []
-    for idx, video_id, video_link, video_file_path, language in files:
+    for idx, video_id, video_link, video_file_path, language, status, stored in files:
         lang_str = language if language else "auto"
+        if status == "new":
+            lang_str = "downloading"
+        elif status == "uploaded":
+            lang_str = "waiting for language"
+        elif stored == "evicted":
+            lang_str += ", recording removed"
         if video_link:
             lines.append(f'<a href="{video_link}">{video_id}</a> ({lang_str})')
         else:
             lines.append(
-                f"<b>{video_id}</b>: {os.path.basename(video_file_path)} ({lang_str})"
+                f"<b>{video_id}</b>: {os.path.basename(video_file_path or '')} ({lang_str})"
             )
-    await message.answer("Your files/links:\n" + "\n".join(lines), parse_mode="HTML")
+    usage = await storage.usage_text(user_id)
+    await message.answer(
+        "Your files/links:\n" + "\n".join(lines) + "\n\n" + usage, parse_mode="HTML"
+    )
+
+
+@router.message(Command("retranscribe"))
+async def retranscribe_handler(message: Message, command: CommandObject):
+    # another language of an earlier upload; its decoded audio is mapped from
+    # disk, so the job skips straight to the model
+    user_id = message.from_user.id
+    args = (command.args or "").split()
+    if len(args) != 2:
+        await message.answer(
+            "Usage: /retranscribe &lt;ID&gt; &lt;language&gt;, e.g. <code>/retranscribe 3 en</code>. "
+            "Use /list to see the IDs.",
+            parse_mode="HTML",
+        )
+        return
+    video_id, lang = args
+    if not LANGUAGE_CODE_RE.fullmatch(lang.lower()):
+        await message.answer(f"Unknown language {lang}, use a code like en, ru or es, or auto.")
+        return
+    # both the full ID from /list and the number after the underscore work
+    idx = video_id.rpartition("_")[2]
+    row = await run_db(get_file_by_id, user_id, int(idx)) if idx.isdigit() else None
+    if row is None or not row[2] or row[4] in ("new", "failed"):
+        await message.answer(f"No uploaded file with ID {video_id}. Use /list to see your files.")
+        return
+    video_id, _, file_path, _, _, stored, media_hash = row
+    if stored == "evicted":
+        await message.answer(
+            f"The recording of {video_id} was removed to free space, please send it again."
+        )
+        return
+    lang_code = None if lang.lower() == "auto" else lang.lower()
+    transcriptions_dir = os.path.join(
+        os.path.dirname(file_path), f"transcriptions_{lang_code or 'auto'}"
+    )
+    job, plan_note = await schedule_job(
+        message, int(idx), file_path, transcriptions_dir, lang_code, media_hash
+    )
+    position = scheduler.position(job.id)
+    queue_note = f"{position} job(s) ahead of it." if position else "It is next in the queue."
+    await message.answer(
+        f"Transcription of <b>{video_id}</b> in <b>{lang_label(lang_code)}</b> scheduled. "
+        f"{queue_note} {plan_note}",
+        parse_mode="HTML",
+    )
+
+
+@router.message(Command("upgrade"))
+async def upgrade_handler(message: Message, command: CommandObject):
+    # the last transcription of an upload again, with the full quality model
+    # the policy passed over to meet the target turnaround
+    user_id = message.from_user.id
+    video_id = (command.args or "").strip()
+    idx = video_id.rpartition("_")[2]
+    row = await run_db(get_file_by_id, user_id, int(idx)) if idx.isdigit() else None
+    last = await run_db(get_latest_job, user_id, int(idx)) if row else None
+    if last is None or not row[2]:
+        await message.answer(
+            "Usage: /upgrade &lt;ID&gt; of a transcribed file. Use /list to see the IDs.",
+            parse_mode="HTML",
+        )
+        return
+    video_id, _, file_path, _, _, stored, media_hash = row
+    transcriptions_dir, lang_code, model_size, job_hash = last
+    if stored == "evicted":
+        await message.answer(
+            f"The recording of {video_id} was removed to free space, please send it again."
+        )
+        return
+    sizes = await policy.model_sizes()
+    if not sizes or model_size in (None, sizes[-1]):
+        await message.answer(f"{video_id} was already transcribed with the full quality model.")
+        return
+    job, plan_note = await schedule_job(
+        message,
+        int(idx),
+        file_path,
+        transcriptions_dir,
+        lang_code,
+        media_hash or job_hash,
+        best=True,
+    )
+    await message.answer(
+        f"Transcription of <b>{video_id}</b> with a better model scheduled. {plan_note}",
+        parse_mode="HTML",
+    )
+
+
+async def schedule_job(
+    message: Message, idx, file_path, transcriptions_dir, lang_code, media_hash, best=False
+):
+    # queues a job with the model the policy picks for it; returns the job
+    # and a note on the model and ETA for the user
+    plan = await policy.plan_job(file_path, best)
+    job = await scheduler.submit(
+        message.from_user.id,
+        message.chat.id,
+        idx,
+        file_path,
+        transcriptions_dir,
+        lang_code,
+        media_hash,
+        plan.model_size,
+        plan.audio_seconds,
+    )
+    pipelines.hold(message.from_user.id, idx)
+    return job, policy.describe(plan, make_video_id(message.from_user.id, idx))
+
+
+@router.message(Command("search"))
+async def search_handler(message: Message, command: CommandObject):
+    text = (command.args or "").strip()
+    if not search.fts_query(text):
+        await message.answer(
+            "Usage: /search &lt;words&gt;, e.g. <code>/search gradient descent</code>",
+            parse_mode="HTML",
+        )
+        return
+    hits = await run_db(search.search, message.from_user.id, text)
+    if not hits:
+        await message.answer("Nothing found in your transcripts.")
+        return
+    await message.answer(
+        "\n\n".join(search.format_hit(*hit) for hit in hits), parse_mode="HTML"
+    )
 
 
 @router.message(Command("start"))
@@ -225,8 +371,6 @@ async def start_handler(message: Message):
 @router.message(F.video | F.audio)
 async def handle_media(message: Message, state: FSMContext):
     user_id = message.from_user.id
-    idx = get_next_index(user_id)
-    video_id = make_video_id(user_id, idx)
     file = message.video or message.audio
     file_name = file.file_name or "file"
     file_size = file.file_size
@@ -237,55 +381,42 @@ async def handle_media(message: Message, state: FSMContext):
         )
         return
 
+    idx, video_id = await run_db(allocate_file, user_id)
     user_video_dir = os.path.join(DATABASE_DIR, str(user_id), video_id)
     os.makedirs(user_video_dir, exist_ok=True)
     local_filename = os.path.join(user_video_dir, file_name)
+    # decoding runs alongside the download and while the language is picked
+    pipeline = AudioPipeline.streaming() if STREAMING else None
 
-    file_info = await message.bot.get_file(file.file_id)
-    file_path = file_info.file_path
-    await message.bot.download_file(file_path, local_filename)
+    try:
+        file_info = await message.bot.get_file(file.file_id)
+        file_path = file_info.file_path
+        with open(local_filename, "wb") as f, metrics.stage("download"):
+            writer = HashingWriter(f, sink=pipeline)
+            await message.bot.download_file(file_path, writer, seek=False)
+    except Exception as ex:
+        if pipeline:
+            pipeline.fail_input(ex)
+        await run_db(set_file_status, user_id, idx, "failed")
+        raise
+    if pipeline:
+        pipeline.finish_input(local_filename, writer.hexdigest())
+        pipelines.register(user_id, idx, pipeline)
+    await run_db(set_file_path, user_id, idx, local_filename, writer.hexdigest())
+    await run_db(storage.update_usage, user_id, idx)
 
     await message.answer(f"File saved with ID <b>{video_id}</b>.", parse_mode="HTML")
 
-    pending_files[user_id] = (
+    await run_db(
+        add_pending_upload,
+        user_id,
+        idx,
+        message.chat.id,
         local_filename,
         os.path.join(user_video_dir, "transcriptions"),
-        (user_id, idx, video_id, None, local_filename),  # We'll append lang_code later
-    )
-    await message.answer(
-        "Please choose the language of the lecture (or press 'Auto' for automatic detection):",
-        reply_markup=language_keyboard(),
-    )
-    await state.set_state(UploadStates.waiting_for_language)
-
-
-def gdrive_download(link, output_dir):
-    import gdown, requests, re
-
-    resp = requests.get(link)
-    # iterate on metadata to find filename and format
-    for i in resp.content.decode().split("meta property="):
-        if "og:title" in i:
-            filename = re.findall('".*?"', i)[1].replace('"', "")
-            break
-    return gdown.download(
-        url=link, output=os.path.join(output_dir, filename), quiet=False, fuzzy=True
+        writer.hexdigest(),
     )
-
-
-def yandex_disk_download(link, output_dir):
-    import yadisk
-
-    try:
-        y = yadisk.YaDisk()
-        public_key = link
-        meta = y.get_public_meta(public_key)
-        filename = meta["name"]
-        local_path = os.path.join(output_dir, filename)
-        y.download_public(public_key, local_path)
-        return local_path
-    except Exception as e:
-        raise RuntimeError(f"Yandex Disk download failed: {e}")
+    await ask_language(message, state)
 
 
 @router.message(
@@ -294,65 +425,86 @@ def yandex_disk_download(link, output_dir):
 )
 async def handle_disk_link(message: Message, state: FSMContext):
     user_id = message.from_user.id
-    idx = get_next_index(user_id)
-    video_id = make_video_id(user_id, idx)
     text = message.text.strip()
     gd_match = GOOGLE_DRIVE_LINK_RE.search(text)
     yd_match = YANDEX_DISK_LINK_RE.search(text)
+    link = (gd_match or yd_match)[0]
+    idx, video_id = await run_db(allocate_file, user_id, link)
 
     user_video_dir = os.path.join(DATABASE_DIR, str(user_id), video_id)
     os.makedirs(user_video_dir, exist_ok=True)
 
-    loop = asyncio.get_event_loop()
-    with concurrent.futures.ThreadPoolExecutor() as pool:
-        if gd_match:
-            link = gd_match[0]
-            await message.answer("Downloading google drive file. Please wait...")
-            try:
-                out_path = await loop.run_in_executor(
-                    pool, gdrive_download, link, user_video_dir
-                )
-                await message.answer(
-                    f'File saved with ID <a href="{link}">{video_id}</a>.',
-                    parse_mode="HTML",
-                )
-                pending_files[user_id] = (
-                    out_path,
-                    os.path.join(user_video_dir, "transcriptions"),
-                    (user_id, idx, video_id, link, out_path),
-                )
-                await message.answer(
-                    "Please choose the language of the lecture (or press 'Auto' for automatic detection):",
-                    reply_markup=language_keyboard(),
-                )
-                await state.set_state(UploadStates.waiting_for_language)
-            except Exception as ex:
-                await message.answer(f"Failed to download Google Drive file: {ex}")
-        elif yd_match:
-            link = yd_match[0]
-            await message.answer("Downloading yandex disk file. Please wait...")
-            try:
-                out_path = await loop.run_in_executor(
-                    pool, yandex_disk_download, link, user_video_dir
-                )
-                await message.answer(
-                    f'File saved with ID <a href="{link}">{video_id}</a>.',
-                    parse_mode="HTML",
-                )
-                pending_files[user_id] = (
-                    out_path,
-                    os.path.join(user_video_dir, "transcriptions"),
-                    (user_id, idx, video_id, link, out_path),
-                )
-                await message.answer(
-                    "Please choose the language of the lecture (or press 'Auto' for automatic detection):",
-                    reply_markup=language_keyboard(),
-                )
-                await state.set_state(UploadStates.waiting_for_language)
-            except Exception as ex:
-                await message.answer(f"Failed to download Yandex Disk file: {ex}")
+    if gd_match:
+        source, download = "Google Drive", downloads.gdrive_download
+    else:
+        source, download = "Yandex Disk", downloads.yandex_disk_download
+    transcriptions_dir = os.path.join(user_video_dir, "transcriptions")
+    status = ProgressMessage(message.bot, message.chat.id)
+    await status.update(f"Downloading {source} file. Please wait...")
+
+    pipeline = None
+    if STREAMING:
+        # ask for the language right away, transcription can then start on
+        # the first decoded minutes while the rest is still downloading
+        pipeline = AudioPipeline.streaming()
+        pipelines.register(user_id, idx, pipeline)
+        await run_db(
+            add_pending_upload, user_id, idx, message.chat.id, None, transcriptions_dir
+        )
+        await ask_language(
+            message,
+            state,
+            "While it downloads, please choose the language of the lecture "
+            "(or press 'Auto' for automatic detection):",
+        )
+
+    async def progress(done, total):
+        if total:
+            await status.update(
+                f"Downloading {source} file: {progress_bar(done / total)} "
+                f"{done * 100 // total}% ({human_size(done)} of {human_size(total)})"
+            )
         else:
-            await message.answer("Unrecognized link.")
+            await status.update(f"Downloading {source} file: {human_size(done)}")
+
+    try:
+        with metrics.stage("download"):
+            out_path, media_hash = await download(
+                link, user_video_dir, progress, sink=pipeline
+            )
+    except Exception as ex:
+        await run_db(set_file_status, user_id, idx, "failed")
+        await message.answer(
+            f"Failed to download {source} file: {ex}", reply_markup=ReplyKeyboardRemove()
+        )
+        if pipeline:
+            # a job already queued for it fails with the same error
+            pipeline.fail_input(ex)
+            await run_db(delete_pending_upload, user_id, idx)
+            if not await run_db(get_pending_uploads, user_id):
+                await state.clear()
+        return
+    await run_db(set_file_path, user_id, idx, out_path, media_hash)
+    await run_db(storage.update_usage, user_id, idx)
+    await status.update(f"Downloaded {human_size(os.path.getsize(out_path))}.", force=True)
+    await message.answer(
+        f'File saved with ID <a href="{link}">{video_id}</a>.',
+        parse_mode="HTML",
+    )
+    if pipeline:
+        # set_file_path gave the pending upload or the queued job its file
+        pipeline.finish_input(out_path, media_hash)
+        return
+    await run_db(
+        add_pending_upload,
+        user_id,
+        idx,
+        message.chat.id,
+        out_path,
+        transcriptions_dir,
+        media_hash,
+    )
+    await ask_language(message, state)
 
 
 @router.message(lambda m: m.text in LANG_LABELS, UploadStates.waiting_for_language)
@@ -360,42 +512,180 @@ async def language_selected(message: Message, state: FSMContext):
     user_id = message.from_user.id
     lang_label_ = message.text
     lang_code = LANG_LABEL_TO_CODE.get(lang_label_)
+    pending = await run_db(get_pending_uploads, user_id)
+    if not pending:
+        await message.answer(
+            "No file pending for transcription.", reply_markup=ReplyKeyboardRemove()
+        )
+        await state.clear()
+        return
+    _, idx, _, local_filename, transcriptions_dir, media_hash = pending[0]
+    job, plan_note = await schedule_job(
+        message, idx, local_filename, transcriptions_dir, lang_code, media_hash
+    )
+    position = scheduler.position(job.id)
+    if position:
+        queue_note = f"Your file is queued, {position} job(s) ahead of it."
+    else:
+        queue_note = "Your file is next in the queue."
     await message.answer(
-        f"Now transcribing in <b>{lang_label(lang_code)}</b>...",
-        reply_markup=ReplyKeyboardRemove(),
+        f"Transcription in <b>{lang_label(lang_code)}</b> scheduled. {queue_note} {plan_note}",
+        reply_markup=None if len(pending) > 1 else ReplyKeyboardRemove(),
         parse_mode="HTML",
     )
-    info = pending_files.pop(user_id, None)
-    if not info:
-        await message.answer("No file pending for transcription.")
+    if len(pending) > 1:
+        await ask_language(message, state)
+    else:
         await state.clear()
-        return
-    local_filename, transcriptions_dir, insert_args = info
+
+
+async def process_job(bot: Bot, job):
+    # the job's model size reaches the inference workers through this context
+    with selected_size(job.model_size):
+        await _process_job(bot, job)
+
+
+async def _process_job(bot: Bot, job):
+    chat_id = job.chat_id
+    pipeline = pipelines.take(job.user_id, job.idx)
     try:
-        insert_file(*insert_args, lang_code)
-        srt_path, txt_path = await async_transcribe(
-            local_filename, transcriptions_dir, language=lang_code
-        )
-        await message.answer_document(
-            FSInputFile(srt_path), caption="SRT (subtitles with timecodes)"
-        )
-        await message.answer_document(
-            FSInputFile(txt_path), caption="Transcript with timecodes"
-        )
-        await message.answer(
-            "Transcription done! Files also saved in your folder. Use /list to see your files."
-        )
-        transcript_path = os.path.normpath(
-            os.path.join(transcriptions_dir, "transcript.txt")
-        )
-        os.makedirs(os.path.dirname(transcript_path), exist_ok=True)
-        text = open(transcript_path, "r", encoding="utf8").read()
-        summary = full_process(text)
-        await message.answer("Summarization complete, here it is:\n" + summary)
+        if job.file_path is None:
+            # queued while downloading, set_file_path recorded the file once
+            # it was done
+            row = await run_db(get_file_by_id, job.user_id, job.idx)
+            if row is not None and row[2]:
+                job.file_path, job.media_hash = row[2], job.media_hash or row[6]
+        if job.file_path is None and pipeline is None:
+            # the download didn't survive a restart
+            raise RuntimeError("the download was interrupted, please send the link again")
+        model_size, _ = await worker_model()
+        cached = await lookup_cached(job, model_size, pipeline and pipeline.media_hash)
+        if cached:
+            # same media was already transcribed with this model and language
+            if pipeline:
+                pipeline.close()
+        else:
+            await bot.send_message(
+                chat_id,
+                f"Now transcribing in <b>{lang_label(job.language)}</b>...",
+                parse_mode="HTML",
+            )
+            if await use_incremental(job, pipeline):
+                await transcribe_incremental(
+                    bot,
+                    chat_id,
+                    job.file_path,
+                    job.transcriptions_dir,
+                    language=job.language,
+                    pipeline=pipeline,
+                )
+            else:
+                await async_transcribe(
+                    job.file_path,
+                    job.transcriptions_dir,
+                    language=job.language,
+                    pipeline=pipeline,
+                )
+            await policy.record_speed(model_size, job.audio_seconds, metrics.inference_seconds())
+        media_hash = job.media_hash or (pipeline and pipeline.media_hash)
+        await deliver_job(bot, job, cached, model_size, media_hash)
+    except Exception as ex:
+        if pipeline:
+            pipeline.close()
+        await bot.send_message(chat_id, f"Transcription failed: {ex}")
+        raise
+
 
+async def deliver_remote_job(bot: Bot, job):
+    # distributed mode: a worker left the transcripts in the job's directory
+    # on shared storage, or reported why it couldn't
+    try:
+        if job.state == "error":
+            raise RuntimeError(job.error)
+        await deliver_job(bot, job, job.state == "cached", job.model, job.media_hash)
     except Exception as ex:
-        await message.answer(f"Transcription failed: {ex}")
-    await state.clear()
+        await bot.send_message(job.chat_id, f"Transcription failed: {ex}")
+        raise
+
+
+async def deliver_job(bot: Bot, job, cached, model_size, media_hash=None):
+    await send_results(bot, job, cached, model_size, media_hash)
+    try:
+        await run_db(search.index_transcript, job.user_id, job.idx, job.transcriptions_dir)
+    except Exception:
+        logger.exception("Failed to index the transcript of job %s", job.id)
+    # the media isn't needed until the next transcription of the file; ffmpeg,
+    # so not on the db threads
+    try:
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, storage.compact, job.user_id, job.idx, job.id)
+    except Exception:
+        logger.exception("Failed to compact upload %s", make_video_id(job.user_id, job.idx))
+
+
+async def send_results(bot: Bot, job, cached, model_size, media_hash=None):
+    # sends the transcripts and their summary; a cached transcription comes
+    # with the summary made the first time
+    chat_id = job.chat_id
+    if cached:
+        metrics.set_outcome("cached")
+        await bot.send_message(chat_id, "This file was transcribed before.")
+        await send_transcripts(bot, chat_id, job.transcriptions_dir)
+        summary = open(
+            os.path.join(job.transcriptions_dir, "summary.txt"), encoding="utf8"
+        ).read()
+        await bot.send_message(chat_id, "Here is its summary:\n" + summary)
+        return
+
+    with metrics.stage("upload"):
+        await send_transcripts(bot, chat_id, job.transcriptions_dir)
+    await bot.send_message(
+        chat_id,
+        "Transcription done! Files also saved in your folder. Use /list to see your files.",
+    )
+    transcript_path = os.path.normpath(
+        os.path.join(job.transcriptions_dir, "transcript.txt")
+    )
+    os.makedirs(os.path.dirname(transcript_path), exist_ok=True)
+    text = open(transcript_path, "r", encoding="utf8").read()
+    with metrics.stage("summarize"):
+        summary = await summarize(text)
+    with open(
+        os.path.join(job.transcriptions_dir, "summary.txt"), "w", encoding="utf8"
+    ) as f:
+        f.write(summary)
+    await bot.send_message(chat_id, "Summarization complete, here it is:\n" + summary)
+    if media_hash:
+        key = cache_key(media_hash, model_size, job.language)
+        await run_db(
+            cache.store, key, media_hash, model_size, job.language, job.transcriptions_dir
+        )
+
+
+async def send_transcripts(bot: Bot, chat_id, transcriptions_dir):
+    await bot.send_document(
+        chat_id,
+        FSInputFile(os.path.join(transcriptions_dir, "transcript.srt")),
+        caption="SRT (subtitles with timecodes)",
+    )
+    await bot.send_document(
+        chat_id,
+        FSInputFile(os.path.join(transcriptions_dir, "transcript.txt")),
+        caption="Transcript with timecodes",
+    )
+
+
+@router.message(Command("stats"))
+async def stats_handler(message: Message):
+    if message.from_user.id not in metrics.ADMIN_IDS:
+        return
+    queue = f"Queue: {scheduler.queued()} waiting, {len(scheduler.running)} running\n"
+    await message.answer(queue + metrics.stats_text())
+
+
+@router.message(F.text)
+async def echo_handler(message: Message):
+    await message.answer(message.text)
 
 
 @router.message()
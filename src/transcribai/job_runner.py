@@ -0,0 +1,84 @@
+import asyncio
+import time
+
+from . import cache
+from . import engines
+from . import metrics
+from .cache import cache_key
+from .db import run_db
+from .models import current_size
+from .transcriber import cached_pcm, load_pcm, probe_duration, save_transcripts, transcribe_file
+from .chunking import (
+    LONG_AUDIO_MIN_SECONDS,
+    SAMPLE_RATE,
+    transcribe_chunked,
+    transcribe_stream,
+)
+from .workers import inference_pool
+from .batching import transcribe
+
+# the compute side of a job, media in and transcript files out, without
+# Telegram; runs in the bot process or in a distributed worker
+
+
+async def transcribe_pipeline(pipeline, transcriptions_dir, language=None):
+    loop = asyncio.get_event_loop()
+    start = time.perf_counter()
+    if pipeline.decoding:
+        # still downloading or decoding, start on the part that is ready
+        result = await transcribe_stream(pipeline, language)
+    else:
+        audio = await pipeline.audio()
+        if inference_pool.workers > 1 and len(audio) >= LONG_AUDIO_MIN_SECONDS * SAMPLE_RATE:
+            result = await transcribe_chunked(audio, language)
+        else:
+            result = await transcribe(audio, language)
+    metrics.record_transcription(pipeline.pcm.length / SAMPLE_RATE, time.perf_counter() - start)
+    await loop.run_in_executor(None, pipeline.save_pcm)
+    with metrics.stage("write"):
+        return await loop.run_in_executor(None, save_transcripts, result, transcriptions_dir)
+
+
+# NEW VERSION
+async def async_transcribe(file_path, transcriptions_dir, language=None, pipeline=None):
+    if pipeline is not None:
+        return await transcribe_pipeline(pipeline, transcriptions_dir, language)
+    loop = asyncio.get_event_loop()
+    start = time.perf_counter()
+    audio = await loop.run_in_executor(None, cached_pcm, file_path)
+    if audio is not None:
+        duration = len(audio) / SAMPLE_RATE
+    else:
+        duration = await loop.run_in_executor(None, probe_duration, file_path)
+    if inference_pool.workers > 1 and (duration or 0) >= LONG_AUDIO_MIN_SECONDS:
+        # long recording, transcribe its chunks on all workers at once
+        if audio is None:
+            with metrics.stage("decode"):
+                audio = await loop.run_in_executor(None, load_pcm, file_path)
+        result = await transcribe_chunked(audio, language)
+        paths = await loop.run_in_executor(
+            None, save_transcripts, result, transcriptions_dir
+        )
+    else:
+        paths, stats = await inference_pool.run(
+            transcribe_file,
+            file_path,
+            transcriptions_dir,
+            language,
+            engines.WHISPER_ENGINE,
+            current_size(),
+        )
+        metrics.record_worker_stats(stats)
+    metrics.record_transcription(duration or 0, time.perf_counter() - start)
+    return paths
+
+
+async def lookup_cached(job, model_size, media_hash=None, call=run_db):
+    # copies an earlier transcription of the same media, model and language
+    # into the job's directory, True if there was one; call runs the db
+    # function, workers pass the broker's
+    media_hash = job.media_hash or media_hash
+    if not media_hash:
+        return False
+    key = cache_key(media_hash, model_size, job.language)
+    return await call(cache.lookup, key, job.transcriptions_dir)
@@ -0,0 +1,58 @@
+import os
+import time
+import json
+import hashlib
+
+from .db import (
+    get_llm_response,
+    put_llm_response,
+    delete_expired_llm_responses,
+    get_llm_cache_entries_lru,
+    delete_llm_responses,
+)
+
+LLM_CACHE_TTL_HOURS = float(os.getenv("LLM_CACHE_TTL_HOURS", "720"))
+LLM_CACHE_MAX_MB = float(os.getenv("LLM_CACHE_MAX_MB", "64"))
+
+
+def prompt_key(model, temperature, system_prompt, user_prompt):
+    raw = json.dumps([model, temperature, system_prompt, user_prompt], ensure_ascii=False)
+    return hashlib.sha256(raw.encode()).hexdigest()
+
+
+class LLMCache:
+    # persistent cache of LLM responses in the bot database
+    def __init__(self, ttl_hours=LLM_CACHE_TTL_HOURS, max_mb=LLM_CACHE_MAX_MB):
+        self.ttl = ttl_hours * 3600
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        now = time.time()
+        response = get_llm_response(key, now - self.ttl, now)
+        if response is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return response
+
+    def put(self, key, response):
+        put_llm_response(key, response, len(response.encode()), time.time())
+        self.evict()
+
+    def evict(self):
+        delete_expired_llm_responses(time.time() - self.ttl)
+        entries = get_llm_cache_entries_lru()
+        total = sum(size for _, size in entries)
+        stale = []
+        for key, size in entries:
+            if total <= self.max_bytes:
+                break
+            stale.append(key)
+            total -= size
+        if stale:
+            delete_llm_responses(stale)
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses}
@@ -1,17 +1,27 @@
 import asyncio
 import logging
 import os
+from functools import partial
 from dotenv import load_dotenv
 
 load_dotenv()
 
-from .db import init_db
+from .db import init_db, batcher
 
 init_db()
 
 from aiogram import Bot, Dispatcher
-from aiogram.fsm.storage.memory import MemoryStorage
-from .handlers import router
+from .fsm import SQLiteStorage
+from .handlers import router, process_job, deliver_remote_job, recover_pending_uploads
+from .scheduler import DISTRIBUTED_WORKERS, scheduler
+from .models import PRELOAD_MODEL
+from .workers import inference_pool
+from .summarizer import close_engine
+from . import broker
+from . import downloads
+from . import metrics
+from . import search
+from . import storage
 
 logging.basicConfig(level=logging.INFO)
 TOKEN = os.getenv("BOT_TOKEN")
@@ -22,9 +32,42 @@ async def main():
         print("No BOT_TOKEN found. Please check your .env file.")
         return
     bot = Bot(token=TOKEN)
-    dp = Dispatcher(storage=MemoryStorage())
+    dp = Dispatcher(storage=SQLiteStorage())
     dp.include_router(router)
-    await dp.start_polling(bot)
+    await recover_pending_uploads(bot)
+    # logs its own failure; the reference keeps the task from being collected
+    search_backfill = asyncio.create_task(search.run_backfill())
+    broker_server = None
+    if DISTRIBUTED_WORKERS:
+        # transcription happens in `python -m transcribai.remote_worker`
+        # processes, the ones on other hosts reach the database through the broker
+        broker_server = await broker.start_server()
+        await scheduler.start(partial(deliver_remote_job, bot))
+    else:
+        if PRELOAD_MODEL:
+            # spawn workers and load models in the background so polling starts right away
+            asyncio.create_task(inference_pool.warm())
+        await scheduler.start(partial(process_job, bot))
+    metrics.add_gauge("transcribai_queue_depth", "Queued jobs", scheduler.queued)
+    metrics.add_gauge(
+        "transcribai_running_jobs", "Jobs being processed", lambda: len(scheduler.running)
+    )
+    metrics_server = await metrics.start_server()
+    storage_gc = asyncio.create_task(storage.gc_loop())
+    try:
+        await dp.start_polling(bot)
+    finally:
+        storage_gc.cancel()
+        search_backfill.cancel()
+        if metrics_server:
+            await metrics_server.cleanup()
+        if broker_server:
+            await broker_server.cleanup()
+        await scheduler.stop()
+        inference_pool.shutdown()
+        await close_engine()
+        await downloads.close()
+        batcher.flush()
 
 
 if __name__ == "__main__":
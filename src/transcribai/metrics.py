@@ -0,0 +1,333 @@
+import os
+import time
+import logging
+import resource
+import threading
+import contextvars
+from bisect import bisect_left
+from collections import deque
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Optional
+
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9108"))  # 0 disables the endpoint
+ADMIN_IDS = {int(i) for i in os.getenv("ADMIN_IDS", "").split(",") if i.strip()}
+
+# seconds, stages range from a db write to an hour long transcription
+BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+RTF_BUCKETS = (0.05, 0.1, 0.2, 0.3, 0.5, 0.75, 1, 1.5, 2, 3, 5)
+RECENT_SAMPLES = 1000  # per series, for the percentiles in /stats
+RECENT_JOBS = 20
+
+_lock = threading.Lock()
+
+
+def _labels(label_name, value):
+    return f'{{{label_name}="{value}"}}' if label_name else ""
+
+
+class Histogram:
+    # prometheus histogram with one label, plus the latest samples for percentiles
+    def __init__(self, name, help, label_name="", buckets=BUCKETS):
+        self.name = name
+        self.help = help
+        self.label_name = label_name
+        self.buckets = buckets
+        self._series = {}
+
+    def observe(self, value, label=""):
+        with _lock:
+            series = self._series.get(label)
+            if series is None:
+                series = self._series[label] = {
+                    "counts": [0] * (len(self.buckets) + 1),
+                    "sum": 0.0,
+                    "recent": deque(maxlen=RECENT_SAMPLES),
+                }
+            series["counts"][bisect_left(self.buckets, value)] += 1
+            series["sum"] += value
+            series["recent"].append(value)
+
+    def percentile(self, q, label=""):
+        with _lock:
+            series = self._series.get(label)
+            values = sorted(series["recent"]) if series else []
+        if not values:
+            return None
+        return values[min(len(values) - 1, int(q * len(values)))]
+
+    def labels(self):
+        with _lock:
+            return sorted(self._series)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with _lock:
+            for label, series in sorted(self._series.items()):
+                base = f'{self.label_name}="{label}",' if self.label_name else ""
+                total = 0
+                for bound, count in zip(self.buckets + ("+Inf",), series["counts"]):
+                    total += count
+                    lines.append(f'{self.name}_bucket{{{base}le="{bound}"}} {total}')
+                lines.append(f"{self.name}_sum{_labels(self.label_name, label)} {series['sum']}")
+                lines.append(f"{self.name}_count{_labels(self.label_name, label)} {total}")
+        return lines
+
+
+class Counter:
+    def __init__(self, name, help, label_name=""):
+        self.name = name
+        self.help = help
+        self.label_name = label_name
+        self._values = {}
+
+    def inc(self, amount=1, label=""):
+        with _lock:
+            self._values[label] = self._values.get(label, 0) + amount
+
+    def value(self, label=""):
+        with _lock:
+            return self._values.get(label, 0)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with _lock:
+            for label, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_labels(self.label_name, label)} {value}")
+        return lines
+
+
+class Gauge:
+    # value read when the metrics are scraped
+    def __init__(self, name, help, fn):
+        self.name = name
+        self.help = help
+        self.fn = fn
+
+    def render(self):
+        try:
+            value = self.fn()
+        except Exception:
+            logger.exception("Gauge %s failed", self.name)
+            return []
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge", f"{self.name} {value}"]
+
+
+def self_peak_rss():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+stage_seconds = Histogram(
+    "transcribai_stage_seconds", "Duration of job stages", label_name="stage"
+)
+real_time_factor = Histogram(
+    "transcribai_real_time_factor",
+    "Transcription wall time divided by audio duration",
+    buckets=RTF_BUCKETS,
+)
+jobs_total = Counter("transcribai_jobs_total", "Finished jobs", label_name="outcome")
+audio_seconds_total = Counter(
+    "transcribai_audio_seconds_total", "Seconds of audio transcribed"
+)
+silence_skipped_seconds_total = Counter(
+    "transcribai_silence_skipped_seconds_total",
+    "Seconds of silence cut out before inference",
+)
+llm_requests_total = Counter(
+    "transcribai_llm_requests_total", "Summarization model requests", label_name="result"
+)
+worker_peak_rss = {"value": 0}
+
+GAUGES = [
+    Gauge("transcribai_peak_rss_bytes", "Peak RSS of the bot process", self_peak_rss),
+    Gauge(
+        "transcribai_worker_peak_rss_bytes",
+        "Highest peak RSS reported by an inference worker",
+        lambda: worker_peak_rss["value"],
+    ),
+]
+METRICS = [
+    stage_seconds,
+    real_time_factor,
+    jobs_total,
+    audio_seconds_total,
+    silence_skipped_seconds_total,
+    llm_requests_total,
+]
+
+
+def add_gauge(name, help, fn):
+    GAUGES.append(Gauge(name, help, fn))
+
+
+def render():
+    lines = []
+    for metric in METRICS + GAUGES:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+@dataclass
+class JobTrace:
+    job_id: int
+    user_id: int
+    queue_wait: float = 0.0
+    audio_seconds: float = 0.0
+    transcribe_seconds: float = 0.0
+    silence_seconds: float = 0.0
+    peak_rss: int = 0  # of an inference worker during this job's calls
+    outcome: str = "running"
+    stages: dict = field(default_factory=dict)
+    started: float = field(default_factory=time.monotonic)
+    finished: Optional[float] = None
+
+    @property
+    def duration(self):
+        return (self.finished or time.monotonic()) - self.started
+
+    @property
+    def rtf(self):
+        if not self.audio_seconds or not self.transcribe_seconds:
+            return None
+        return self.transcribe_seconds / self.audio_seconds
+
+
+current_trace = contextvars.ContextVar("current_trace", default=None)
+recent_jobs = deque(maxlen=RECENT_JOBS)
+
+
+def observe(stage_name, seconds):
+    # adds to the stage histogram and to the trace of the job running in this context
+    stage_seconds.observe(seconds, stage_name)
+    trace = current_trace.get()
+    if trace is not None:
+        trace.stages[stage_name] = trace.stages.get(stage_name, 0.0) + seconds
+
+
+@contextmanager
+def stage(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start)
+
+
+def set_outcome(outcome):
+    trace = current_trace.get()
+    if trace is not None:
+        trace.outcome = outcome
+
+
+def record_worker_stats(stats):
+    # timings and peak RSS an inference worker sent back with its result
+    for name in ("decode", "vad", "model_load", "inference"):
+        if name in stats:
+            observe(name, stats[name])
+    silence_skipped_seconds_total.inc(stats.get("vad_skipped", 0))
+    peak = stats.get("peak_rss", 0)
+    with _lock:
+        worker_peak_rss["value"] = max(worker_peak_rss["value"], peak)
+    trace = current_trace.get()
+    if trace is not None:
+        trace.peak_rss = max(trace.peak_rss, peak)
+        trace.silence_seconds += stats.get("vad_skipped", 0)
+
+
+def inference_seconds():
+    # seconds inference workers spent on the current job's audio, waits for
+    # a free worker, decoding and model loads left out
+    trace = current_trace.get()
+    if trace is None:
+        return 0.0
+    return trace.stages.get("vad", 0.0) + trace.stages.get("inference", 0.0)
+
+
+def record_transcription(audio_seconds, seconds):
+    audio_seconds_total.inc(audio_seconds)
+    observe("transcribe", seconds)
+    if audio_seconds:
+        real_time_factor.observe(seconds / audio_seconds)
+    trace = current_trace.get()
+    if trace is not None:
+        trace.audio_seconds += audio_seconds
+        trace.transcribe_seconds += seconds
+
+
+@contextmanager
+def job_trace(job_id, user_id, queue_wait=0.0):
+    trace = JobTrace(job_id, user_id, queue_wait=queue_wait)
+    token = current_trace.set(trace)
+    observe("queue_wait", queue_wait)
+    recent_jobs.append(trace)
+    try:
+        yield trace
+    except BaseException:
+        trace.outcome = "failed"
+        raise
+    else:
+        if trace.outcome == "running":
+            trace.outcome = "done"
+    finally:
+        trace.finished = time.monotonic()
+        current_trace.reset(token)
+        if trace.outcome != "running":
+            jobs_total.inc(label=trace.outcome)
+            stage_seconds.observe(trace.duration, "job")
+
+
+def _fmt(seconds):
+    return "-" if seconds is None else f"{seconds:.1f}s"
+
+
+def stats_text():
+    # summary for the /stats admin command
+    done = jobs_total.value("done") + jobs_total.value("cached")
+    lines = [
+        f"Jobs: {done} done, {jobs_total.value('failed')} failed",
+        f"Audio transcribed: {audio_seconds_total.value() / 3600:.1f} h, "
+        f"{silence_skipped_seconds_total.value() / 3600:.1f} h of it silence skipped",
+        f"Peak RSS: bot {self_peak_rss() / 2**20:.0f} MB, "
+        f"worker {worker_peak_rss['value'] / 2**20:.0f} MB",
+    ]
+    rtf = real_time_factor.percentile(0.5)
+    if rtf is not None:
+        lines.append(f"Real-time factor p50 {rtf:.2f}, p95 {real_time_factor.percentile(0.95):.2f}")
+    lines.append("\nStage p50 / p95:")
+    for label in stage_seconds.labels():
+        p50 = stage_seconds.percentile(0.5, label)
+        p95 = stage_seconds.percentile(0.95, label)
+        lines.append(f"  {label}: {_fmt(p50)} / {_fmt(p95)}")
+    if recent_jobs:
+        lines.append("\nRecent jobs:")
+        for trace in list(recent_jobs)[-5:]:
+            rtf = f", RTF {trace.rtf:.2f}" if trace.rtf else ""
+            silence = f", {trace.silence_seconds:.0f}s silence" if trace.silence_seconds else ""
+            lines.append(
+                f"  #{trace.job_id} {trace.outcome} in {trace.duration:.0f}s, "
+                f"waited {trace.queue_wait:.0f}s{rtf}{silence}"
+            )
+    return "\n".join(lines)
+
+
+async def start_server(host=METRICS_HOST, port=METRICS_PORT):
+    # Prometheus text format on http://host:port/metrics, None if disabled
+    if not port:
+        return None
+
+    async def handle(request):
+        return web.Response(text=render(), content_type="text/plain", charset="utf-8")
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logger.info("Metrics on http://%s:%d/metrics", host, port)
+    return runner
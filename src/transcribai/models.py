@@ -0,0 +1,186 @@
+import os
+import logging
+import threading
+import contextvars
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from . import engines
+
+logger = logging.getLogger(__name__)
+
+# memory budget for resident models, 0 = unlimited
+MODEL_MEMORY_BUDGET_MB = int(os.getenv("WHISPER_MODEL_MEMORY_MB", "0"))
+PRELOAD_MODEL = os.getenv("WHISPER_PRELOAD", "0") == "1"
+
+# approximate parameter counts, used to make room before a model is loaded
+MODEL_PARAMS = {
+    "tiny": 39e6,
+    "base": 74e6,
+    "small": 244e6,
+    "medium": 769e6,
+    "large": 1550e6,
+    "turbo": 809e6,
+}
+
+
+def default_device():
+    import torch
+
+    return "cuda:0" if torch.cuda.is_available() else "cpu"
+
+
+def default_model_size(device):
+    mm = {6: "turbo", 5: "medium", 2: "small", 1: "base"}  # VRAM for model sizes
+    if "cuda" in device:  # auto choose model size
+        import torch
+
+        tm = torch.cuda.get_device_properties(device).total_memory / 1e9 - 1
+        for m in mm.keys():
+            if tm > m:
+                return mm[m]
+        return "tiny"
+    return "small"  # biggest suitable for CPU imho
+
+
+_selected_size = contextvars.ContextVar("model_size", default=None)
+
+
+def current_size():
+    # model size of the job running in this context, None for the device's
+    # default; passed on to the inference workers like the engine
+    return _selected_size.get()
+
+
+@contextmanager
+def selected_size(model_size):
+    if model_size is not None and model_size not in MODEL_PARAMS:
+        raise ValueError(
+            f"Unknown model size {model_size}, expected one of {', '.join(MODEL_PARAMS)}"
+        )
+    token = _selected_size.set(model_size)
+    try:
+        yield
+    finally:
+        _selected_size.reset(token)
+
+
+def estimate_model_bytes(model_size, engine="whisper"):
+    params = MODEL_PARAMS.get(model_size.split(".")[0].split("-")[0], 0)
+    return int(params * engines.get(engine).bytes_per_param)
+
+
+class _Entry:
+    def __init__(self, model, size_bytes):
+        self.model = model
+        self.size_bytes = size_bytes
+        # whisper installs kv-cache hooks on the model while decoding,
+        # so one model instance can only serve one transcription at a time
+        self.lock = threading.Lock()
+        self.users = 0
+
+
+class ModelRegistry:
+    # process-wide cache of loaded whisper models keyed by (size, device, engine),
+    # idle models are evicted in LRU order when the memory budget is exceeded
+    def __init__(self, budget_bytes=0, loader=None):
+        self.budget_bytes = budget_bytes
+        self._loader = loader or self._load
+        self._entries = OrderedDict()
+        self._loading = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _load(model_size, device, engine):
+        return engines.get(engine).load(model_size, device)
+
+    def _used_bytes(self):
+        return sum(e.size_bytes for e in self._entries.values())
+
+    def _evict(self, needed_bytes, keep=None):
+        if not self.budget_bytes:
+            return
+        evicted = False
+        for key in list(self._entries):
+            if self._used_bytes() + needed_bytes <= self.budget_bytes:
+                break
+            entry = self._entries[key]
+            if key == keep or entry.users:
+                continue
+            del self._entries[key]
+            evicted = True
+            logger.info("Evicted whisper model %s (%d MB)", key, entry.size_bytes >> 20)
+        if evicted:
+            import torch
+
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
+
+    def _get_entry(self, key):
+        while True:
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry is not None:
+                    self._entries.move_to_end(key)
+                    entry.users += 1
+                    return entry
+                loading = self._loading.get(key)
+                if loading is None:
+                    loading = self._loading[key] = threading.Event()
+                    self._evict(estimate_model_bytes(key[0], key[2]))
+                    break
+            # another thread is loading the same model, wait and retry
+            loading.wait()
+
+        try:
+            logger.info("Loading whisper model %s", key)
+            model = self._loader(*key)
+        except BaseException:
+            with self._lock:
+                del self._loading[key]
+            loading.set()
+            raise
+
+        with self._lock:
+            size_bytes = engines.get(key[2]).model_bytes(model) or estimate_model_bytes(
+                key[0], key[2]
+            )
+            entry = _Entry(model, size_bytes)
+            entry.users += 1
+            self._entries[key] = entry
+            del self._loading[key]
+            self._evict(0, keep=key)
+        loading.set()
+        return entry
+
+    def _release(self, entry):
+        with self._lock:
+            entry.users -= 1
+
+    @contextmanager
+    def use(self, model_size, device=None, engine="whisper"):
+        # yields the model for exclusive use, it can't be evicted meanwhile
+        key = (model_size, device or default_device(), engine)
+        entry = self._get_entry(key)
+        try:
+            with entry.lock:
+                yield entry.model
+        finally:
+            self._release(entry)
+
+    def preload(self, model_size, device=None, engine="whisper"):
+        with self.use(model_size, device, engine):
+            pass
+
+    def loaded(self):
+        with self._lock:
+            return [(key, e.size_bytes, e.users) for key, e in self._entries.items()]
+
+
+registry = ModelRegistry(budget_bytes=MODEL_MEMORY_BUDGET_MB * 1024 * 1024)
+
+
+def preload_default_model():
+    engine = engines.get()
+    device = engine.device(default_device())
+    registry.preload(default_model_size(device), device, engine.name)
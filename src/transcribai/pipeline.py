@@ -0,0 +1,307 @@
+import os
+import sys
+import time
+import queue
+import asyncio
+import logging
+import threading
+from subprocess import PIPE, Popen
+from tempfile import TemporaryFile
+
+import numpy as np
+
+from . import metrics
+from .transcriber import (
+    AUDIO_BLOCK_SIZE,
+    _read_block,
+    cached_pcm,
+    ffmpeg_decode_cmd,
+    load_pcm,
+    save_pcm,
+)
+
+logger = logging.getLogger(__name__)
+
+SAMPLE_RATE = 16000
+STREAMING_PIPELINE = os.getenv("STREAMING_PIPELINE", "1") == "1"
+# decoded audio of files nobody picked a language for is dropped after this
+PIPELINE_TTL = float(os.getenv("PIPELINE_TTL_MINUTES", "60")) * 60
+SPECULATIVE_DECODE_MAX_MB = int(os.getenv("SPECULATIVE_DECODE_MAX_MB", "1024"))
+INITIAL_CAPACITY_SECONDS = 600
+
+
+class DecodeError(RuntimeError):
+    pass
+
+
+def _wake(future):
+    if not future.done():
+        future.set_result(None)
+
+
+class PcmBuffer:
+    # float32 samples appended by a decoder thread and awaited on the event loop;
+    # growing allocates a new array, so views handed out earlier stay valid
+    def __init__(self, capacity):
+        self.data = np.empty(capacity, np.float32)
+        self.length = 0
+        self.done = False
+        self.error = None
+        self._lock = threading.Lock()
+        self._waiters = []
+
+    @classmethod
+    def from_array(cls, audio):
+        pcm = cls(0)
+        pcm.data = audio
+        pcm.length = len(audio)
+        pcm.done = True
+        return pcm
+
+    def append(self, block):
+        n = len(block)
+        if self.length + n > len(self.data):
+            grown = np.empty(max(2 * len(self.data), self.length + n), np.float32)
+            grown[: self.length] = self.data[: self.length]
+            self.data = grown
+        np.multiply(block, 1 / 32768.0, out=self.data[self.length : self.length + n])
+        with self._lock:
+            self.length += n
+            self._notify()
+
+    def close(self, error=None):
+        with self._lock:
+            if self.done:
+                return
+            self.done = True
+            self.error = error
+            self._notify()
+
+    def _notify(self):
+        waiting = []
+        for loop, future, samples in self._waiters:
+            if self.done or self.length >= samples:
+                loop.call_soon_threadsafe(_wake, future)
+            else:
+                waiting.append((loop, future, samples))
+        self._waiters = waiting
+
+    async def wait_for(self, samples):
+        # returns the number of decoded samples once there are `samples` of
+        # them or decoding has ended
+        with self._lock:
+            future = None
+            if not self.done and self.length < samples:
+                loop = asyncio.get_running_loop()
+                future = loop.create_future()
+                self._waiters.append((loop, future, samples))
+        if future is not None:
+            await future
+        if self.error is not None:
+            raise self.error
+        return self.length
+
+    def view(self):
+        return self.data[: self.length]
+
+
+class AudioPipeline:
+    # decodes media to PCM in the background, either from a file on disk or
+    # from bytes fed to ffmpeg while they are still being downloaded
+    def __init__(self, sr=SAMPLE_RATE):
+        self.sr = sr
+        self.pcm = PcmBuffer(INITIAL_CAPACITY_SECONDS * sr)
+        self.path = None
+        self.media_hash = None
+        self.created = time.monotonic()
+        self.saved = False  # the decoded audio is on disk next to the upload
+        self.queued = False  # a job waits for the upload, see hold
+        self._proc = None
+        self._input = None
+        self._input_error = None
+        self._input_done = asyncio.Event()
+
+    @classmethod
+    def from_file(cls, path, media_hash=None, sr=SAMPLE_RATE):
+        pipeline = cls(sr)
+        pipeline.path = path
+        pipeline.media_hash = media_hash
+        pipeline._input_done.set()
+        audio = cached_pcm(path)
+        if audio is not None:
+            # decoded before, nothing to run
+            pipeline.pcm = PcmBuffer.from_array(audio)
+            pipeline.saved = True
+        else:
+            pipeline._start(path)
+        return pipeline
+
+    @classmethod
+    def streaming(cls, sr=SAMPLE_RATE):
+        pipeline = cls(sr)
+        pipeline._input = queue.Queue()
+        pipeline._start("pipe:0")
+        return pipeline
+
+    def _start(self, source):
+        stderr = TemporaryFile()
+        stdin = PIPE if self._input is not None else None
+        self._proc = Popen(
+            ffmpeg_decode_cmd(source, self.sr), stdin=stdin, stdout=PIPE, stderr=stderr
+        )
+        if stdin:
+            threading.Thread(target=self._feed, args=(self._input,), daemon=True).start()
+        threading.Thread(target=self._decode, args=(stderr, self.pcm), daemon=True).start()
+
+    def _feed(self, chunks):
+        try:
+            while (chunk := chunks.get()) is not None:
+                self._proc.stdin.write(chunk)
+        except OSError:
+            # ffmpeg gave up on the stream, the decoder thread reports why
+            self._input = None
+        finally:
+            try:
+                self._proc.stdin.close()
+            except OSError:
+                pass
+
+    def _decode(self, stderr, pcm):
+        # pcm is bound here, drop_decode may replace self.pcm meanwhile
+        raw = np.empty(AUDIO_BLOCK_SIZE, np.int16)
+        start = time.perf_counter()
+        with stderr:
+            while n := _read_block(self._proc.stdout, raw) // 2:
+                pcm.append(raw[:n])
+            self._proc.stdout.close()
+            if self._proc.wait():
+                stderr.seek(0)
+                message = stderr.read().decode(errors="ignore")[-2000:]
+                pcm.close(DecodeError(f"Failed to decode audio: {message}"))
+            else:
+                metrics.observe("decode", time.perf_counter() - start)
+                pcm.close()
+
+    # download side
+
+    def feed(self, chunk):
+        if self._input is not None:
+            self._input.put(bytes(chunk))
+
+    def reset(self):
+        # the download restarted or resumed from an earlier partial file, the
+        # bytes fed so far don't form one stream; decode the file once it's done
+        if self._input is not None:
+            self._input, chunks = None, self._input
+            chunks.put(None)
+            self._proc.kill()
+
+    def finish_input(self, path, media_hash=None):
+        self.path = path
+        self.media_hash = media_hash
+        if self._input is not None:
+            self._input.put(None)
+        self._input_done.set()
+
+    def fail_input(self, error):
+        self._input_error = error
+        self.reset()
+        self.pcm.close(error)
+        self._input_done.set()
+
+    # consumer side
+
+    @property
+    def decoding(self):
+        return not self.pcm.done
+
+    @property
+    def input_finished(self):
+        return self._input_done.is_set()
+
+    async def audio(self):
+        # the whole decoded recording; if the streamed bytes couldn't be decoded
+        # (e.g. an mp4 with its index at the end) it is decoded from disk instead
+        try:
+            await self.pcm.wait_for(sys.maxsize)
+            return self.pcm.view()
+        except DecodeError as ex:
+            await self._input_done.wait()
+            if self._input_error is not None:
+                raise self._input_error
+            logger.info("Streaming decode failed (%s), decoding %s from disk", ex, self.path)
+            loop = asyncio.get_running_loop()
+            self.saved = True
+            return await loop.run_in_executor(None, load_pcm, self.path, self.sr)
+
+    def save_pcm(self):
+        # keeps a complete decode for later transcriptions of the same upload
+        if self.saved or self.path is None or self.decoding or self.pcm.error:
+            return
+        self.saved = True
+        save_pcm(self.path, self.pcm.view())
+
+    def drop_decode(self):
+        # frees the decoded audio of a finished download; audio() then
+        # decodes the file on disk, as after a failed streaming decode
+        if self._proc is not None and self._proc.poll() is None:
+            self._proc.kill()
+        self.pcm = PcmBuffer(0)
+        self.pcm.close(DecodeError("the decoded audio was dropped to save memory"))
+
+    @property
+    def decoded_bytes(self):
+        # memory the decode holds, capacity reserved for it isn't touched yet
+        return self.pcm.length * self.pcm.data.itemsize
+
+    def close(self):
+        self.reset()
+        if self._proc is not None and self._proc.poll() is None:
+            self._proc.kill()
+
+
+# (user_id, idx) -> pipeline started for an upload that has no job running yet
+pipelines = {}
+
+
+def register(user_id, idx, pipeline):
+    prune()
+    pipelines[(user_id, idx)] = pipeline
+
+
+def hold(user_id, idx):
+    # a job was queued for the upload: prune keeps its pipeline, which has
+    # the file path and hash even if the job was queued before they existed
+    pipeline = pipelines.get((user_id, idx))
+    if pipeline is not None:
+        pipeline.queued = True
+
+
+def take(user_id, idx):
+    # the job that transcribes the upload owns its pipeline from now on
+    return pipelines.pop((user_id, idx), None)
+
+
+def prune(now=None):
+    # drops speculative decodes that waited too long for a language, then the
+    # oldest ones while they take more memory than allowed; a pipeline still
+    # receiving its download is kept, one a queued job waits for only loses
+    # its decoded audio
+    now = time.monotonic() if now is None else now
+    budget = SPECULATIVE_DECODE_MAX_MB * 1024 * 1024
+    total = sum(p.decoded_bytes for p in pipelines.values())
+    for key, pipeline in sorted(pipelines.items(), key=lambda item: item[1].created):
+        if not pipeline.input_finished:
+            continue
+        if total <= budget and now - pipeline.created < PIPELINE_TTL:
+            continue
+        size = pipeline.decoded_bytes
+        if pipeline.queued:
+            if not size:
+                continue
+            pipeline.drop_decode()
+        else:
+            del pipelines[key]
+            pipeline.close()
+        total -= size
+        logger.info("Dropped the speculative decode of upload %s", key)
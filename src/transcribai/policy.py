@@ -0,0 +1,166 @@
+import os
+import time
+import asyncio
+from dataclasses import dataclass
+from typing import Optional
+
+from . import engines
+from .db import run_db, get_active_jobs, get_model_speeds, record_model_speed
+from .models import MODEL_PARAMS
+from .scheduler import DISTRIBUTED_WORKERS, scheduler
+from .workers import inference_pool
+from .batching import default_model
+from .transcriber import pcm_duration, probe_duration
+
+# deadline-aware model choice: a job gets the best model whose estimated
+# turnaround, the queue ahead of it included, stays within the target, and a
+# faster one when the recording is long or the queue is busy
+ADAPTIVE_MODEL = os.getenv("ADAPTIVE_MODEL", "1") == "1"
+TARGET_TURNAROUND = float(os.getenv("TARGET_TURNAROUND_MINUTES", "30")) * 60
+# model sizes to choose from, empty for every size up to the workers' default;
+# distributed mode needs them listed, the bot doesn't know the workers' device
+ADAPTIVE_MODEL_SIZES = [
+    size.strip() for size in os.getenv("ADAPTIVE_MODEL_SIZES", "").split(",") if size.strip()
+]
+# worse to better; turbo is faster than medium and close to large
+QUALITY_ORDER = ("tiny", "base", "small", "medium", "turbo", "large")
+QUALITY_TIERS = {
+    "tiny": "draft",
+    "base": "basic",
+    "small": "standard",
+    "medium": "high",
+    "turbo": "high",
+    "large": "best",
+}
+# seconds per second of audio until a model has been measured, whisper on CPU
+PRIOR_RTF = {
+    "tiny": 0.1,
+    "base": 0.2,
+    "small": 0.6,
+    "medium": 1.8,
+    "turbo": 1.2,
+    "large": 3.5,
+}
+SPEED_WEIGHT = 0.2  # of a new measurement in the moving average
+JOB_OVERHEAD_SECONDS = 30  # model load, summary and upload around the inference
+UNKNOWN_AUDIO_SECONDS = 600  # assumed for queued links still downloading
+
+for _size in ADAPTIVE_MODEL_SIZES:
+    if _size not in MODEL_PARAMS:
+        raise ValueError(f"ADAPTIVE_MODEL_SIZES: unknown model size {_size}")
+ADAPTIVE_MODEL_SIZES.sort(key=QUALITY_ORDER.index)
+
+
+@dataclass
+class Plan:
+    model_size: Optional[str]  # None for the workers' default
+    audio_seconds: Optional[float]
+    eta: Optional[float] = None  # seconds until the transcript is ready
+    upgrade: bool = False  # a better model was passed over to meet the target
+
+    @property
+    def tier(self):
+        return QUALITY_TIERS.get(self.model_size)
+
+
+def media_duration(file_path):
+    # seconds of audio, from the decoded audio if it is cached; None if unknown
+    duration = pcm_duration(file_path)
+    if duration is not None:
+        return duration
+    return probe_duration(file_path)
+
+
+async def model_sizes():
+    # sizes a job can get, worse to better, the last one is full quality
+    if ADAPTIVE_MODEL_SIZES:
+        return ADAPTIVE_MODEL_SIZES
+    if DISTRIBUTED_WORKERS:
+        return []
+    model_size, _ = await default_model()
+    if model_size not in QUALITY_ORDER:
+        return [model_size]
+    return list(QUALITY_ORDER[: QUALITY_ORDER.index(model_size) + 1])
+
+
+def rtf(model_size, speeds):
+    label = engines.model_label(model_size, engines.WHISPER_ENGINE)
+    return speeds.get(label, PRIOR_RTF.get(model_size, 1.0))
+
+
+def job_seconds(model_size, audio_seconds, speeds):
+    audio_seconds = UNKNOWN_AUDIO_SECONDS if audio_seconds is None else audio_seconds
+    return audio_seconds * rtf(model_size, speeds) + JOB_OVERHEAD_SECONDS
+
+
+def backlog(jobs, speeds, default_size, now):
+    # work left in queued and running jobs, in seconds of one worker
+    total = 0.0
+    for state, model_size, audio_seconds, updated_at in jobs:
+        seconds = job_seconds(model_size or default_size, audio_seconds, speeds)
+        if state == "running":
+            seconds = max(0.0, seconds - (now - updated_at))
+        total += seconds
+    return total
+
+
+def parallel_jobs():
+    # jobs transcribed at once: the inference pool's workers, or in
+    # distributed mode the workers holding a lease
+    return scheduler.workers if DISTRIBUTED_WORKERS else inference_pool.workers
+
+
+async def plan_job(file_path, best=False):
+    # model size and ETA for a new job on file_path; with best the full
+    # quality model regardless of the target, for /upgrade
+    duration = None
+    if file_path:
+        loop = asyncio.get_running_loop()
+        duration = await loop.run_in_executor(None, media_duration, file_path)
+    sizes = await model_sizes() if ADAPTIVE_MODEL or best else []
+    if not sizes:
+        return Plan(None, duration)
+    if duration is None:
+        # a link still downloading, nothing to go by
+        return Plan(sizes[-1], None)
+    speeds = await run_db(get_model_speeds)
+    jobs = await run_db(get_active_jobs)
+    wait = backlog(jobs, speeds, sizes[-1], time.time()) / max(1, parallel_jobs())
+    for model_size in reversed(sizes):
+        eta = wait + job_seconds(model_size, duration, speeds)
+        if best or eta <= TARGET_TURNAROUND:
+            break
+    # nothing fits, the fastest model it is
+    return Plan(model_size, duration, eta, upgrade=model_size != sizes[-1])
+
+
+async def record_speed(model, audio_seconds, seconds, call=run_db):
+    # inference seconds a job took per second of its audio, summed over the
+    # workers its chunks ran on (metrics.inference_seconds); call runs the db
+    # function, workers pass the broker's
+    if not audio_seconds or seconds <= 0:
+        return
+    await call(record_model_speed, model, seconds / audio_seconds, SPEED_WEIGHT, time.time())
+
+
+def eta_text(seconds):
+    minutes = max(1, round(seconds / 60))
+    if minutes < 90:
+        return f"~{minutes} min"
+    return f"~{minutes / 60:.1f} h"
+
+
+def describe(plan, video_id):
+    # the model, quality tier and ETA for the user, empty without a choice
+    if plan.model_size is None:
+        return ""
+    text = f"Model: <b>{plan.model_size}</b> ({plan.tier} quality)"
+    if plan.eta is not None:
+        text += f", ready in {eta_text(plan.eta)}"
+    text += "."
+    if plan.upgrade:
+        text += (
+            " The file is long or the queue is busy, so a faster model was picked; "
+            f"send <code>/upgrade {video_id}</code> afterwards for a full quality transcript."
+        )
+    return text
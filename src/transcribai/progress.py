@@ -0,0 +1,78 @@
+import time
+import logging
+
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
+
+logger = logging.getLogger(__name__)
+
+# Telegram allows roughly one edit per second per chat, stay well below it
+MIN_EDIT_INTERVAL = 3.0
+
+
+def progress_bar(fraction, width=10):
+    filled = int(round(fraction * width))
+    return "▓" * filled + "░" * (width - filled)
+
+
+def human_size(n):
+    for unit in ("B", "KB", "MB", "GB"):
+        if n < 1024 or unit == "GB":
+            return f"{n:.0f} {unit}" if unit == "B" else f"{n:.1f} {unit}"
+        n /= 1024
+
+
+class ProgressMessage:
+    # one status message that is edited in place, at most every MIN_EDIT_INTERVAL
+    def __init__(self, bot, chat_id, min_interval=MIN_EDIT_INTERVAL):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.min_interval = min_interval
+        self.message_id = None
+        self._text = None
+        self._last_edit = 0.0
+
+    async def update(self, text, force=False):
+        if text == self._text:
+            return
+        now = time.monotonic()
+        if not force and self.message_id and now - self._last_edit < self.min_interval:
+            return
+        try:
+            if self.message_id is None:
+                msg = await self.bot.send_message(self.chat_id, text)
+                self.message_id = msg.message_id
+            else:
+                await self.bot.edit_message_text(
+                    text, chat_id=self.chat_id, message_id=self.message_id
+                )
+        except TelegramRetryAfter as ex:
+            # flood control, skip updates until Telegram allows them again
+            self._last_edit = now + ex.retry_after
+            return
+        except TelegramBadRequest as ex:
+            logger.debug("Progress message not updated: %s", ex)
+        self._text = text
+        self._last_edit = now
+
+
+PREVIEW_CHARS = 500  # latest transcript text shown under the progress bar
+
+
+def clock(seconds):
+    m, s = divmod(int(seconds), 60)
+    h, m = divmod(m, 60)
+    return f"{h}:{m:02}:{s:02}" if h else f"{m}:{s:02}"
+
+
+def transcript_progress(position, duration, segments):
+    # progress text for a running transcription, duration is None while the
+    # audio is still arriving
+    if duration:
+        fraction = min(position / duration, 1.0)
+        head = f"Transcribing: {progress_bar(fraction)} {fraction * 100:.0f}% ({clock(position)} of {clock(duration)})"
+    else:
+        head = f"Transcribing: {clock(position)} done"
+    text = "".join(seg["text"] for seg in segments[-20:]).strip()
+    if len(text) > PREVIEW_CHARS:
+        text = "…" + text[-PREVIEW_CHARS:]
+    return head + ("\n\n" + text if text else "")
@@ -0,0 +1,151 @@
+import os
+import time
+import signal
+import socket
+import asyncio
+import logging
+from dotenv import load_dotenv
+
+load_dotenv()
+
+from .db import (
+    init_db,
+    claim_job,
+    renew_lease,
+    complete_job,
+    release_job,
+    batcher,
+)
+from .broker import JOB_BROKER_URL, call
+from . import broker
+
+if not JOB_BROKER_URL:
+    init_db()
+
+from . import metrics
+from .scheduler import JOB_LEASE_SECONDS, JOB_MAX_ATTEMPTS, JOB_POLL_INTERVAL, Job
+from .models import PRELOAD_MODEL, selected_size
+from .workers import inference_pool
+from .batching import worker_model
+from .job_runner import async_transcribe, lookup_cached
+from .policy import record_speed
+
+# distributed transcription worker: claims queued jobs, transcribes them into
+# their directories on shared storage and reports the result, the bot
+# delivers it; on the bot's host it uses the database directly, on other
+# hosts the bot's job broker (JOB_BROKER_URL)
+#
+#   DISTRIBUTED_WORKERS=1 python -m transcribai.remote_worker
+#   DISTRIBUTED_WORKERS=1 DATA_DIR=/mnt/transcribai JOB_BROKER_URL=http://bot:9110 \
+#     python -m transcribai.remote_worker
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+WORKER_ID = os.getenv("WORKER_ID") or f"{socket.gethostname()}-{os.getpid()}"
+WORKER_JOBS = int(os.getenv("WORKER_JOBS", "1"))  # jobs transcribed at once
+# 0 disables, every worker on a host needs its own port
+WORKER_METRICS_PORT = int(os.getenv("WORKER_METRICS_PORT", "0"))
+
+_stopping = False  # set on shutdown, a cancelled job is then handed back
+
+
+async def run_job(job):
+    with metrics.job_trace(job.id, job.user_id, time.time() - job.queued_at):
+        with selected_size(job.model_size):
+            model_size, _ = await worker_model()
+            if await lookup_cached(job, model_size, call=call):
+                metrics.set_outcome("cached")
+                return "cached", model_size
+            await async_transcribe(job.file_path, job.transcriptions_dir, job.language)
+            await record_speed(
+                model_size, job.audio_seconds, metrics.inference_seconds(), call=call
+            )
+    return "transcribed", model_size
+
+
+async def heartbeat(job, task):
+    # keeps the lease alive; if it was lost anyway the job is queued again
+    # and possibly running elsewhere, so this attempt stops
+    while True:
+        await asyncio.sleep(JOB_LEASE_SECONDS / 3)
+        try:
+            renewed = await call(renew_lease, job.id, WORKER_ID, JOB_LEASE_SECONDS)
+        except Exception:
+            # the broker may be back before the lease runs out
+            logger.exception("Renewing the lease of job %s failed", job.id)
+            continue
+        if not renewed:
+            logger.warning("Lost the lease of job %s, abandoning it", job.id)
+            task.cancel()
+            return
+
+
+async def job_loop():
+    while True:
+        try:
+            row = await call(claim_job, WORKER_ID, JOB_LEASE_SECONDS, JOB_MAX_ATTEMPTS)
+        except Exception:
+            logger.exception("Claiming a job failed")
+            row = None
+        if row is None:
+            await asyncio.sleep(JOB_POLL_INTERVAL)
+            continue
+        job = Job(*row)
+        logger.info("Claimed job %s of user %s", job.id, job.user_id)
+        task = asyncio.create_task(run_job(job))
+        beat = asyncio.create_task(heartbeat(job, task))
+        try:
+            state, model_size = await task
+        except asyncio.CancelledError:
+            if _stopping:
+                # another worker can take the job right away
+                await call(release_job, job.id, WORKER_ID)
+                raise
+            # otherwise the heartbeat lost the lease
+        except Exception as ex:
+            logger.exception("Job %s failed", job.id)
+            await call(complete_job, job.id, WORKER_ID, "error", str(ex))
+        else:
+            await call(complete_job, job.id, WORKER_ID, state, None, model_size)
+        finally:
+            beat.cancel()
+
+
+def stop(task):
+    # SIGINT/SIGTERM: jobs in progress go back to the queue
+    global _stopping
+    _stopping = True
+    task.cancel()
+
+
+async def main():
+    global _stopping
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop, asyncio.current_task())
+    logger.info("Worker %s taking up to %d jobs at once", WORKER_ID, WORKER_JOBS)
+    if PRELOAD_MODEL:
+        asyncio.create_task(inference_pool.warm())
+    metrics_server = await metrics.start_server(port=WORKER_METRICS_PORT)
+    loops = [asyncio.create_task(job_loop()) for _ in range(WORKER_JOBS)]
+    try:
+        await asyncio.gather(*loops)
+    finally:
+        _stopping = True
+        for task in loops:
+            task.cancel()
+        await asyncio.gather(*loops, return_exceptions=True)
+        if metrics_server:
+            await metrics_server.cleanup()
+        if broker.client:
+            await broker.client.close()
+        inference_pool.shutdown()
+        batcher.flush()
+
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(main())
+    except (KeyboardInterrupt, asyncio.CancelledError):
+        pass
@@ -0,0 +1,265 @@
+import os
+import time
+import asyncio
+import logging
+from collections import OrderedDict, deque
+from dataclasses import dataclass, field
+from typing import Optional
+
+from . import metrics
+from .db import (
+    run_db,
+    schedule_file,
+    set_job_state,
+    get_jobs_by_state,
+    requeue_running_jobs,
+    expire_leases,
+    get_finished_remote_jobs,
+    get_queued_job_ids,
+    count_busy_workers,
+)
+
+logger = logging.getLogger(__name__)
+
+TRANSCRIBE_WORKERS = int(os.getenv("TRANSCRIBE_WORKERS", "1"))
+# jobs are transcribed by `python -m transcribai.remote_worker` processes,
+# possibly on other hosts, instead of by the bot process
+DISTRIBUTED_WORKERS = os.getenv("DISTRIBUTED_WORKERS", "0") == "1"
+# a worker that hasn't renewed its lease for this long is considered dead
+JOB_LEASE_SECONDS = float(os.getenv("JOB_LEASE_SECONDS", "120"))
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+JOB_POLL_INTERVAL = float(os.getenv("JOB_POLL_INTERVAL", "2"))
+
+
+@dataclass
+class Job:
+    id: int
+    user_id: int
+    chat_id: int
+    idx: int
+    file_path: str
+    transcriptions_dir: str
+    language: Optional[str]
+    media_hash: Optional[str] = None
+    state: str = "queued"
+    model_size: Optional[str] = None  # None for the workers' default
+    audio_seconds: Optional[float] = None
+    # when the job was first queued, kept across restarts
+    queued_at: float = field(default_factory=time.time)
+    model: Optional[str] = None
+    error: Optional[str] = None
+
+
+class JobScheduler:
+    # persistent job queue served by a fixed number of workers,
+    # users are served round-robin so one heavy user can't starve the others
+    def __init__(self, workers=TRANSCRIBE_WORKERS):
+        self.workers = workers
+        self._queues = OrderedDict()  # user_id -> deque of jobs
+        self._cond = asyncio.Condition()
+        self._tasks = []
+        self._runner = None
+        self.running = {}  # job id -> job
+
+    def _push(self, job):
+        self._queues.setdefault(job.user_id, deque()).append(job)
+
+    def _pop(self):
+        user_id, jobs = next(iter(self._queues.items()))
+        job = jobs.popleft()
+        del self._queues[user_id]
+        if jobs:
+            # user goes to the back of the line
+            self._queues[user_id] = jobs
+        return job
+
+    def _order(self):
+        queues = [list(jobs) for jobs in self._queues.values()]
+        order = []
+        for i in range(max(map(len, queues), default=0)):
+            order.extend(jobs[i] for jobs in queues if i < len(jobs))
+        return order
+
+    def position(self, job_id):
+        # number of queued jobs that will start before this one
+        for pos, job in enumerate(self._order()):
+            if job.id == job_id:
+                return pos
+        return None
+
+    def queued(self):
+        return sum(len(jobs) for jobs in self._queues.values())
+
+    async def submit(
+        self,
+        user_id,
+        chat_id,
+        idx,
+        file_path,
+        transcriptions_dir,
+        language,
+        media_hash=None,
+        model_size=None,
+        audio_seconds=None,
+    ):
+        job_args = (
+            user_id,
+            chat_id,
+            idx,
+            file_path,
+            transcriptions_dir,
+            language,
+            media_hash,
+            model_size,
+            audio_seconds,
+        )
+        # the file row gets its language in the same transaction
+        job_id = await run_db(schedule_file, user_id, idx, language, job_args)
+        job = Job(job_id, *job_args[:-2], model_size=model_size, audio_seconds=audio_seconds)
+        async with self._cond:
+            self._push(job)
+            self._cond.notify()
+        return job
+
+    async def _next_job(self):
+        async with self._cond:
+            await self._cond.wait_for(lambda: self._queues)
+            return self._pop()
+
+    async def _worker(self):
+        while True:
+            job = await self._next_job()
+            job.state = "running"
+            await run_db(set_job_state, job.id, job.state)
+            self.running[job.id] = job
+            try:
+                with metrics.job_trace(job.id, job.user_id, time.time() - job.queued_at):
+                    await self._runner(job)
+            except asyncio.CancelledError:
+                # shutting down, the job is resumed on the next start
+                raise
+            except Exception as ex:
+                logger.exception("Job %s failed", job.id)
+                job.state = "failed"
+                await run_db(set_job_state, job.id, job.state, str(ex))
+            else:
+                job.state = "done"
+                await run_db(set_job_state, job.id, job.state)
+            finally:
+                self.running.pop(job.id, None)
+
+    async def start(self, runner):
+        # runner is a coroutine function taking a Job
+        self._runner = runner
+        resumed = await run_db(requeue_running_jobs)
+        rows = await run_db(get_jobs_by_state, "queued")
+        async with self._cond:
+            self._queues.clear()
+            for row in rows:
+                self._push(Job(*row))
+        if resumed:
+            logger.info("Resuming %d interrupted jobs", resumed)
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+
+class RemoteScheduler:
+    # the bot's side of distributed mode: jobs wait in the database until a
+    # worker claims them, the runner gets the ones workers have finished
+    # (transcribed, cached or failed) to deliver them to the user
+    def __init__(self, poll_interval=JOB_POLL_INTERVAL):
+        self.poll_interval = poll_interval
+        self._queued = []  # job ids, as of the last poll
+        self._task = None
+        self._runner = None
+        self._deliveries = set()
+        self.running = {}  # job id -> job being delivered
+        self.workers = 1  # workers holding a lease as of the last poll, at least 1
+
+    def position(self, job_id):
+        try:
+            return self._queued.index(job_id)
+        except ValueError:
+            return None
+
+    def queued(self):
+        return len(self._queued)
+
+    async def submit(
+        self,
+        user_id,
+        chat_id,
+        idx,
+        file_path,
+        transcriptions_dir,
+        language,
+        media_hash=None,
+        model_size=None,
+        audio_seconds=None,
+    ):
+        job_args = (
+            user_id,
+            chat_id,
+            idx,
+            file_path,
+            transcriptions_dir,
+            language,
+            media_hash,
+            model_size,
+            audio_seconds,
+        )
+        job_id = await run_db(schedule_file, user_id, idx, language, job_args)
+        self._queued.append(job_id)
+        return Job(job_id, *job_args[:-2], model_size=model_size, audio_seconds=audio_seconds)
+
+    async def _deliver(self, job):
+        try:
+            with metrics.job_trace(job.id, job.user_id):
+                await self._runner(job)
+        except Exception as ex:
+            logger.exception("Job %s failed", job.id)
+            await run_db(set_job_state, job.id, "failed", str(ex))
+        else:
+            await run_db(set_job_state, job.id, "done")
+        finally:
+            self.running.pop(job.id, None)
+
+    async def _poll(self):
+        while True:
+            try:
+                expired = await run_db(expire_leases, JOB_MAX_ATTEMPTS)
+                if expired:
+                    logger.warning("%d jobs lost their worker", expired)
+                self._queued = await run_db(get_queued_job_ids)
+                self.workers = max(1, await run_db(count_busy_workers, time.time()))
+                for row in await run_db(get_finished_remote_jobs):
+                    job = Job(*row)
+                    if job.id not in self.running:
+                        self.running[job.id] = job
+                        task = asyncio.create_task(self._deliver(job))
+                        self._deliveries.add(task)
+                        task.add_done_callback(self._deliveries.discard)
+            except Exception:
+                logger.exception("Polling the job queue failed")
+            await asyncio.sleep(self.poll_interval)
+
+    async def start(self, runner):
+        # runner is a coroutine function delivering a finished Job
+        self._runner = runner
+        self._task = asyncio.create_task(self._poll())
+
+    async def stop(self):
+        # interrupted deliveries are repeated on the next start
+        tasks = [self._task, *self._deliveries] if self._task else list(self._deliveries)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._task = None
+
+
+scheduler = RemoteScheduler() if DISTRIBUTED_WORKERS else JobScheduler()
@@ -0,0 +1,175 @@
+import os
+import re
+import html
+import logging
+import argparse
+from dotenv import load_dotenv
+
+load_dotenv()
+
+from .db import (
+    init_db,
+    run_db,
+    replace_transcript_segments,
+    get_indexed_transcripts,
+    get_finished_transcriptions,
+    get_file_paths,
+    make_video_id,
+    search_segments,
+)
+from .storage import DATABASE_DIR, is_transcripts
+
+logger = logging.getLogger(__name__)
+
+# full-text search over the users' transcripts: every delivered transcript is
+# split into its timecoded lines and indexed with SQLite FTS5
+#
+#   PYTHONPATH=src python -m transcribai.search --backfill
+SEARCH_RESULTS = int(os.getenv("SEARCH_RESULTS", "10"))
+
+# a transcript.txt line, see transcriber.txt_line
+TXT_LINE_RE = re.compile(
+    r"^\[(\d+):(\d{2}):(\d{2}),(\d{3}) --> (\d+):(\d{2}):(\d{2}),(\d{3})\]  (.*)$",
+    re.MULTILINE,
+)
+QUERY_WORD_RE = re.compile(r"\w+")
+MIN_PREFIX_LENGTH = 4  # shorter words match only as whole words
+
+
+def _ms(h, m, s, ms):
+    return ((int(h) * 60 + int(m)) * 60 + int(s)) * 1000 + int(ms)
+
+
+def parse_transcript(path):
+    # [(start_ms, end_ms, text)] of the non-empty lines of a transcript.txt
+    with open(path, encoding="utf8") as f:
+        text = f.read()
+    return [
+        (_ms(*m.group(1, 2, 3, 4)), _ms(*m.group(5, 6, 7, 8)), m.group(9).strip())
+        for m in TXT_LINE_RE.finditer(text)
+        if m.group(9).strip()
+    ]
+
+
+def index_transcript(user_id, idx, transcriptions_dir):
+    # (re)indexes the transcript of one job, False if there is none
+    path = os.path.join(transcriptions_dir, "transcript.txt")
+    try:
+        mtime = os.path.getmtime(path)
+    except FileNotFoundError:
+        return False
+    replace_transcript_segments(
+        user_id, idx, transcriptions_dir, parse_transcript(path), mtime
+    )
+    return True
+
+
+def _transcript_dirs(upload_dir):
+    try:
+        entries = list(os.scandir(upload_dir))
+    except (FileNotFoundError, NotADirectoryError):
+        return []
+    return [entry.path for entry in entries if entry.is_dir() and is_transcripts(entry.name)]
+
+
+def transcript_dirs():
+    # (user, idx, transcriptions_dir) of every transcript: finished jobs, then
+    # the transcriptions*/ next to each upload and under DATABASE_DIR, which
+    # also finds the ones made before jobs were recorded
+    found = {}
+    for user_id, idx, transcriptions_dir in get_finished_transcriptions():
+        found.setdefault(os.path.abspath(transcriptions_dir), (user_id, idx))
+    for user_id, idx, file_path in get_file_paths():
+        upload_dirs = [os.path.join(DATABASE_DIR, str(user_id), make_video_id(user_id, idx))]
+        if file_path:
+            upload_dirs.append(os.path.dirname(file_path))
+        for upload_dir in upload_dirs:
+            for transcriptions_dir in _transcript_dirs(upload_dir):
+                found.setdefault(os.path.abspath(transcriptions_dir), (user_id, idx))
+    return [(user_id, idx, path) for path, (user_id, idx) in found.items()]
+
+
+def backfill(rebuild=False):
+    # indexes transcripts that aren't indexed yet or changed since; returns
+    # how many were indexed
+    indexed = {} if rebuild else get_indexed_transcripts()
+    count = 0
+    for user_id, idx, transcriptions_dir in transcript_dirs():
+        path = os.path.join(transcriptions_dir, "transcript.txt")
+        try:
+            mtime = os.path.getmtime(path)
+        except FileNotFoundError:
+            continue
+        if indexed.get(transcriptions_dir) == mtime:
+            continue
+        index_transcript(user_id, idx, transcriptions_dir)
+        count += 1
+    return count
+
+
+async def run_backfill():
+    # at startup, transcripts delivered before the index existed
+    try:
+        count = await run_db(backfill)
+    except Exception:
+        logger.exception("Indexing transcripts failed")
+        return
+    if count:
+        logger.info("Indexed %d transcripts", count)
+
+
+def fts_query(text):
+    # every word of the user's text as a quoted prefix term, so FTS5 operators
+    # and punctuation in it can't break the query and inflected forms match
+    # (градиент finds градиентном); None without words
+    words = QUERY_WORD_RE.findall(text)
+    if not words:
+        return None
+    return " ".join(
+        f'"{word}"*' if len(word) >= MIN_PREFIX_LENGTH else f'"{word}"' for word in words
+    )
+
+
+def ms_timecode(ms):
+    h, rest = divmod(ms, 3600000)
+    m, rest = divmod(rest, 60000)
+    s, ms = divmod(rest, 1000)
+    return f"{h:02}:{m:02}:{s:02},{ms:03}"
+
+
+def search(user_id, text, limit=SEARCH_RESULTS):
+    # [(video_id, language of the transcript or None, start_ms, end_ms, snippet)]
+    query = fts_query(text)
+    if query is None:
+        return []
+    hits = []
+    for video_id, transcriptions_dir, start_ms, end_ms, snippet in search_segments(
+        user_id, query, limit
+    ):
+        # transcriptions_<lang> are the /retranscribe ones
+        name = os.path.basename(transcriptions_dir)
+        language = name.partition("_")[2] or None
+        hits.append((video_id, language, start_ms, end_ms, snippet))
+    return hits
+
+
+def format_hit(video_id, language, start_ms, end_ms, snippet):
+    snippet = html.escape(snippet).replace("\x02", "<b>").replace("\x03", "</b>")
+    lang = f" [{language}]" if language else ""
+    return f"<b>{video_id}</b>{lang} {ms_timecode(start_ms)} ({start_ms} ms)\n{snippet}"
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--backfill", action="store_true", help="index new transcripts")
+    parser.add_argument("--rebuild", action="store_true", help="reindex every transcript")
+    args = parser.parse_args()
+    if not args.backfill and not args.rebuild:
+        parser.error("nothing to do, pass --backfill or --rebuild")
+    logging.basicConfig(level=logging.INFO)
+    init_db()
+    logger.info("Indexed %d transcripts", backfill(rebuild=args.rebuild))
+
+
+if __name__ == "__main__":
+    main()
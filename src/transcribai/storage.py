@@ -0,0 +1,353 @@
+import os
+import time
+import shutil
+import asyncio
+import logging
+from subprocess import run
+
+from .db import (
+    DATA_DIR,
+    run_db,
+    get_file_by_id,
+    has_active_jobs,
+    get_uncompacted_files,
+    set_file_storage,
+    get_storage_usage,
+    get_eviction_candidates,
+    get_stored_files,
+    fail_abandoned_uploads,
+)
+from .transcriber import FFMPEG_BINARY, PCM_CACHE, PCM_FILE, pcm_path, pack_pcm
+
+logger = logging.getLogger(__name__)
+
+# uploads live in DATABASE_DIR/<user>/<video_id>: the media, its decoded
+# audio and transcriptions*/ directories; transcripts are never removed here
+DATABASE_DIR = os.path.join(DATA_DIR, "database")
+os.makedirs(DATABASE_DIR, exist_ok=True)
+
+# what happens to the media once it is transcribed: opus keeps a mono Opus
+# copy of the audio track, delete drops it; the decoded audio.npy stays for
+# retranscription either way
+MEDIA_COMPACTION = os.getenv("MEDIA_COMPACTION", "opus")
+COMPACT_AUDIO_BITRATE = os.getenv("COMPACT_AUDIO_BITRATE", "24k")
+# media and decoded audio per user and in total, 0 for no limit; the least
+# recently used uploads lose them first
+USER_STORAGE_QUOTA_MB = int(os.getenv("USER_STORAGE_QUOTA_MB", "2048"))
+STORAGE_QUOTA_MB = int(os.getenv("STORAGE_QUOTA_MB", "0"))
+STORAGE_GC_INTERVAL = float(os.getenv("STORAGE_GC_INTERVAL_MINUTES", "60")) * 60
+ABANDONED_UPLOAD_DAYS = float(os.getenv("ABANDONED_UPLOAD_DAYS", "7"))
+ORPHAN_MIN_AGE = 3600  # seconds, younger leftovers may belong to a running upload
+COMPACT_EXTENSION = ".opus"
+
+if MEDIA_COMPACTION not in ("opus", "delete", "off"):
+    raise ValueError("MEDIA_COMPACTION must be one of opus, delete, off")
+if MEDIA_COMPACTION == "delete" and not PCM_CACHE:
+    raise ValueError("MEDIA_COMPACTION=delete needs PCM_CACHE=1, the decoded audio is all that is kept")
+
+
+def video_dir(file_path):
+    return os.path.dirname(file_path)
+
+
+def is_transcripts(name):
+    return name.startswith("transcriptions")
+
+
+def stored_entries(path):
+    # everything in an upload's directory that isn't a transcript
+    try:
+        entries = list(os.scandir(path))
+    except FileNotFoundError:
+        return []
+    return [entry for entry in entries if not is_transcripts(entry.name)]
+
+
+def entry_bytes(entry):
+    if entry.is_dir(follow_symlinks=False):
+        return sum(
+            os.path.getsize(os.path.join(root, name))
+            for root, _, names in os.walk(entry.path)
+            for name in names
+        )
+    return entry.stat(follow_symlinks=False).st_size
+
+
+def stored_bytes(path):
+    return sum(entry_bytes(entry) for entry in stored_entries(path))
+
+
+def remove_entry(entry):
+    if entry.is_dir(follow_symlinks=False):
+        shutil.rmtree(entry.path, ignore_errors=True)
+    else:
+        try:
+            os.remove(entry.path)
+        except FileNotFoundError:
+            pass
+
+
+def update_usage(user_id, idx):
+    # run after an upload is saved: records its size, then makes room for it
+    row = get_file_by_id(user_id, idx)
+    if row is None or not row[2]:
+        return
+    set_file_storage(user_id, idx, row[5], stored_bytes(video_dir(row[2])))
+    enforce_quotas(user_id)
+
+
+def compact_audio(src, dst):
+    tmp = dst + ".tmp"
+    proc = run(
+        [
+            FFMPEG_BINARY,
+            "-nostdin",
+            "-loglevel",
+            "error",
+            "-y",
+            "-i",
+            src,
+            "-vn",
+            "-ac",
+            "1",
+            "-c:a",
+            "libopus",
+            "-b:a",
+            COMPACT_AUDIO_BITRATE,
+            "-f",
+            "opus",
+            tmp,
+        ],
+        capture_output=True,
+    )
+    if proc.returncode:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise RuntimeError(f"Failed to compact {src}: {proc.stderr.decode(errors='ignore')}")
+    os.replace(tmp, dst)
+
+
+def compact_media(path):
+    # the media of a transcribed upload, (storage, new path or None)
+    if MEDIA_COMPACTION == "delete" or not os.path.exists(path):
+        if os.path.exists(path):
+            os.remove(path)
+        if not os.path.exists(pcm_path(path)):
+            return "evicted", None
+        return "compacted", None
+    if path.endswith(COMPACT_EXTENSION):
+        return "compacted", None
+    dst = os.path.splitext(path)[0] + COMPACT_EXTENSION
+    compact_audio(path, dst)
+    if os.path.getsize(dst) >= os.path.getsize(path):
+        # already a compact audio file, e.g. a voice message
+        os.remove(dst)
+        return "compacted", None
+    os.remove(path)
+    return "compacted", dst
+
+
+def compact(user_id, idx, job_id=None):
+    # run after a job is delivered, job_id being that job: the media is only
+    # needed for another transcription, which gets by with the audio track or
+    # the decoded audio; also records the size of the decoded audio the job
+    # left behind. Runs ffmpeg, keep it off the db threads
+    row = get_file_by_id(user_id, idx)
+    if row is None or not row[2]:
+        return
+    if has_active_jobs(user_id, idx, job_id):
+        return  # the last job of the file compacts it
+    path, storage, new_path = row[2], row[5], None
+    before = stored_bytes(video_dir(path))
+    if MEDIA_COMPACTION != "off" and storage == "original":
+        storage, new_path = compact_media(path)
+    pack_pcm(path)
+    after = stored_bytes(video_dir(path))
+    set_file_storage(user_id, idx, storage, after, new_path)
+    if after != before:
+        logger.info("Compacted upload %s_%s: %d -> %d bytes", user_id, idx, before, after)
+    enforce_quotas(user_id)
+
+
+def compact_all():
+    # transcribed uploads delivery didn't compact; returns how many
+    uploads = get_uncompacted_files() if MEDIA_COMPACTION != "off" else []
+    for user_id, idx in uploads:
+        try:
+            compact(user_id, idx)
+        except Exception:
+            logger.exception("Failed to compact upload %s_%s", user_id, idx)
+    return len(uploads)
+
+
+def drop_pcm(path):
+    # the decoded audio of an upload whose media is still there, it can be
+    # decoded again; returns bytes freed
+    pcm = os.path.join(video_dir(path), PCM_FILE)
+    if not os.path.exists(path) or not os.path.exists(pcm):
+        return 0
+    size = os.path.getsize(pcm)
+    os.remove(pcm)
+    return size
+
+
+def evict(path):
+    # drops the media and decoded audio of an upload, its transcripts stay;
+    # returns bytes freed
+    freed = 0
+    for entry in stored_entries(video_dir(path)):
+        freed += entry_bytes(entry)
+        remove_entry(entry)
+    return freed
+
+
+def record_sizes(sizes):
+    for user_id, idx, storage, size in sizes:
+        set_file_storage(user_id, idx, storage, size)
+
+
+def eviction_plan(quota_mb, user_id=None):
+    # (bytes over the quota, uploads to free them from), nothing within it
+    if not quota_mb:
+        return 0, []
+    excess = get_storage_usage(user_id) - quota_mb * 1024 * 1024
+    if excess <= 0:
+        return 0, []
+    return excess, get_eviction_candidates(user_id)
+
+
+def free_space(excess, candidates):
+    # the filesystem side of a quota, (bytes freed, sizes to record)
+    freed, sizes = 0, []
+    # decoded audio goes first, the media comes back to it on the next job
+    for cand_user, cand_idx, path, storage, _ in candidates:
+        if freed >= excess:
+            return freed, sizes
+        dropped = drop_pcm(path)
+        if dropped:
+            freed += dropped
+            sizes.append((cand_user, cand_idx, storage, stored_bytes(video_dir(path))))
+    for cand_user, cand_idx, path, _, _ in candidates:
+        if freed >= excess:
+            break
+        freed += evict(path)
+        sizes.append((cand_user, cand_idx, "evicted", 0))
+        logger.info("Evicted the media of upload %s_%s", cand_user, cand_idx)
+    return freed, sizes
+
+
+def _enforce(quota_mb, user_id=None):
+    excess, candidates = eviction_plan(quota_mb, user_id)
+    if excess <= 0:
+        return 0
+    freed, sizes = free_space(excess, candidates)
+    record_sizes(sizes)
+    return freed
+
+
+def enforce_quotas(user_id=None):
+    # the user's quota if given, then the global one; returns bytes freed
+    freed = 0
+    if user_id is not None:
+        freed += _enforce(USER_STORAGE_QUOTA_MB, user_id)
+    return freed + _enforce(STORAGE_QUOTA_MB)
+
+
+async def async_enforce(quota_mb, user_id=None):
+    # _enforce with the queries on the db threads and the removal off them
+    if not quota_mb:
+        return 0
+    excess, candidates = await run_db(eviction_plan, quota_mb, user_id)
+    if excess <= 0:
+        return 0
+    loop = asyncio.get_running_loop()
+    freed, sizes = await loop.run_in_executor(None, free_space, excess, candidates)
+    await run_db(record_sizes, sizes)
+    return freed
+
+
+def _age(path, now):
+    try:
+        return now - os.stat(path).st_mtime
+    except FileNotFoundError:
+        return 0
+
+
+def stored_uploads(now):
+    # uploads by (user, idx) as (status, storage, recorded bytes), abandoned
+    # ones marked failed first
+    for user_id, idx in fail_abandoned_uploads(now - ABANDONED_UPLOAD_DAYS * 86400):
+        logger.info("Upload %s_%s waited too long for a language", user_id, idx)
+    return {(row[0], row[1]): row[2:] for row in get_stored_files()}
+
+
+def sweep_uploads(files, now):
+    # removes directories of failed and unknown uploads and leftover temporary
+    # files; returns (directories removed, bytes freed, sizes to record)
+    removed = freed = 0
+    sizes = []
+    for user_entry in os.scandir(DATABASE_DIR):
+        if not user_entry.is_dir() or not user_entry.name.isdigit():
+            continue
+        user_id = int(user_entry.name)
+        for entry in os.scandir(user_entry.path):
+            idx = entry.name.rpartition("_")[2]
+            info = files.get((user_id, int(idx))) if idx.isdigit() else None
+            if info is None or info[0] == "failed":
+                # nothing will read it; a failed upload has no transcripts
+                if entry.is_dir() and _age(entry.path, now) > ORPHAN_MIN_AGE:
+                    freed += entry_bytes(entry)
+                    shutil.rmtree(entry.path, ignore_errors=True)
+                    removed += 1
+                    if info is not None and info[2]:
+                        sizes.append((user_id, int(idx), "evicted", 0))
+                continue
+            status, storage, recorded = info
+            if status == "new":
+                continue  # still downloading
+            for item in stored_entries(entry.path):
+                if item.name.endswith((".part", ".tmp")) and _age(item.path, now) > ORPHAN_MIN_AGE:
+                    freed += entry_bytes(item)
+                    remove_entry(item)
+            size = stored_bytes(entry.path)
+            if size != recorded:
+                sizes.append((user_id, int(idx), storage, size))
+    return removed, freed, sizes
+
+
+async def collect_garbage(now=None):
+    # removes what sweep_uploads finds, corrects the recorded sizes and
+    # enforces the quotas; queries run on the db threads, the directory walks
+    # and removals in the default executor. Returns (directories removed,
+    # bytes freed)
+    now = time.time() if now is None else now
+    loop = asyncio.get_running_loop()
+    files = await run_db(stored_uploads, now)
+    removed, freed, sizes = await loop.run_in_executor(None, sweep_uploads, files, now)
+    await run_db(record_sizes, sizes)
+    for user_id in {user_id for user_id, _ in files}:
+        freed += await async_enforce(USER_STORAGE_QUOTA_MB, user_id)
+    return removed, freed + await async_enforce(STORAGE_QUOTA_MB)
+
+
+async def gc_loop(interval=STORAGE_GC_INTERVAL):
+    while True:
+        try:
+            removed, freed = await collect_garbage()
+            # ffmpeg, off the db threads
+            await asyncio.get_running_loop().run_in_executor(None, compact_all)
+            if removed or freed:
+                logger.info(
+                    "Storage cleanup removed %d directories, freed %.1f MB",
+                    removed,
+                    freed / 2**20,
+                )
+        except Exception:
+            logger.exception("Storage cleanup failed")
+        await asyncio.sleep(interval)
+
+
+async def usage_text(user_id):
+    used = await run_db(get_storage_usage, user_id)
+    quota = f" of {USER_STORAGE_QUOTA_MB} MB" if USER_STORAGE_QUOTA_MB else ""
+    return f"Storage used: {used / 2**20:.1f} MB{quota}"
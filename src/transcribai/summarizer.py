@@ -1,95 +1,277 @@
-from yandex_cloud_ml_sdk import YCloudML
 from dotenv import load_dotenv
 import re
 import os
+import asyncio
+import random
+import logging
+
+import aiohttp
+
+from .transcript_chunks import chunk_transcript, tokenizer
+from .llm_cache import LLMCache, prompt_key
+from . import metrics
+from .db import run_db
 
 load_dotenv("secrets.env")
 api_token = os.getenv("API_TOKEN")
 folder_id = os.getenv("folder_id")
 
+logger = logging.getLogger(__name__)
+
+SUMMARY_BACKEND = os.getenv("SUMMARY_BACKEND", "sdk")  # sdk | http
+SUMMARY_API_URL = os.getenv(
+    "SUMMARY_API_URL", "https://llm.api.cloud.yandex.net/foundationModels/v1/completion"
+)
+SUMMARY_MODEL = "yandexgpt"
+SUMMARY_TEMPERATURE = 0.3
+SUMMARY_CONCURRENCY = int(os.getenv("SUMMARY_CONCURRENCY", "4"))
+SUMMARY_RETRIES = int(os.getenv("SUMMARY_RETRIES", "3"))
+SUMMARY_BACKOFF = 1.0  # секунды, удваивается с каждой попыткой
+SUMMARY_CALIBRATE = os.getenv("SUMMARY_CALIBRATE", "0") == "1"
+CALIBRATION_TOKENS = 100  # размер образцов для калибровки
+SUMMARY_CHUNK_OVERLAP = int(os.getenv("SUMMARY_CHUNK_OVERLAP", "1"))  # сегменты
+
 
 # убирает ненужные мс в транскрипте
 def cut_ms(txt):
-    pattern = r"(\d{2}(?::\d{2}){1,2})\.\d{3}"
+    pattern = r"(\d{2}(?::\d{2}){1,2})[.,]\d{3}"
     replacement = r"\1"
     return re.sub(pattern, replacement, txt)
 
 
-# прогоняет промпт
-def run_prompt(api_token, folder_id, system_prompt, input_text):
+# клиент SDK создаётся один раз и переиспользуется для всех промптов
+class YandexGPTBackend:
+    def __init__(self, api_token=api_token, folder_id=folder_id):
+        self.api_token = api_token
+        self.folder_id = folder_id
+        self._model = None
 
-    messages = [
-        {"role": "system", "text": system_prompt},
-        {"role": "user", "text": input_text},
-    ]
+    def _get_model(self):
+        if self._model is None:
+            # SDK тяжёлый, импортируем при первом запросе, а не при старте бота
+            from yandex_cloud_ml_sdk import AsyncYCloudML
 
-    sdk = YCloudML(folder_id=folder_id, auth=api_token)
-    model = sdk.models.completions("yandexgpt").configure(temperature=0.3)
-    result = model.run(messages)
-    return result.alternatives[0].text
+            sdk = AsyncYCloudML(folder_id=self.folder_id, auth=self.api_token)
+            self._model = sdk.models.completions(SUMMARY_MODEL).configure(
+                temperature=SUMMARY_TEMPERATURE
+            )
+        return self._model
 
+    async def complete(self, messages):
+        result = await self._get_model().run(messages)
+        return result.alternatives[0].text
 
-# условный токенайзер))))
-def count_token(text):
-    if type(text) == str:
-        return len(text) / 4
-    else:
-        return False
+    async def count_tokens(self, text):
+        return len(await self._get_model().tokenize(text))
 
+    async def close(self):
+        self._model = None
 
-# разбивка на части для лимита по токенам
-def process_transcript(text, limit_user_prompt):
-    lines = text.split("\n")
-    splits = []
-    curr_chunk = "Входные данные:\n"
-    for line in lines:
-        if count_token(curr_chunk + line) < limit_user_prompt:
-            curr_chunk += line
-        else:
-            splits.append(curr_chunk)
-            curr_chunk = "Входные данные:\n" + line
-    if curr_chunk != "Входные данные:\n":
-        splits.append(curr_chunk)
-    return splits
 
+# REST API foundationModels/v1/completion, можно направить на локальную заглушку
+class HTTPBackend:
+    def __init__(self, url=SUMMARY_API_URL, api_token=api_token, folder_id=folder_id):
+        self.url = url
+        self.api_token = api_token
+        self.folder_id = folder_id
+        self._session = None
 
-# Суммаризация частей с учетом контекста
-def iterate_run(text):
-    system_prompt = f"""Ты программа, которая должна конспектировать транскрипцию, которая подается на входе. 
+    async def _post(self, url, payload):
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                headers={"Authorization": f"Api-Key {self.api_token}"}
+            )
+        async with self._session.post(url, json=payload) as resp:
+            resp.raise_for_status()
+            return await resp.json()
+
+    async def complete(self, messages):
+        data = await self._post(
+            self.url,
+            {
+                "modelUri": f"gpt://{self.folder_id}/{SUMMARY_MODEL}",
+                "completionOptions": {"temperature": SUMMARY_TEMPERATURE},
+                "messages": messages,
+            },
+        )
+        return data["result"]["alternatives"][0]["message"]["text"]
+
+    async def count_tokens(self, text):
+        # .../foundationModels/v1/completion -> .../foundationModels/v1/tokenize
+        url = self.url.rsplit("/", 1)[0] + "/tokenize"
+        data = await self._post(
+            url, {"modelUri": f"gpt://{self.folder_id}/{SUMMARY_MODEL}", "text": text}
+        )
+        return len(data["tokens"])
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+
+
+BACKENDS = {"sdk": YandexGPTBackend, "http": HTTPBackend}
+
+
+# разбивка на части для лимита по токенам, только по границам сегментов
+def process_transcript(text, limit_user_prompt, overlap=0):
+    chunks, _ = chunk_transcript(text, limit_user_prompt, overlap=overlap)
+    return chunks
+
+
+SYSTEM_PROMPT = """Ты программа, которая должна конспектировать транскрипцию, которая подается на входе. 
     Выдели самые важные моменты из этой записи и расскажи об их сути в 2-3 предложениях, для каждого момента укажи таймкод его начала.
 Правила:
 1. Фокусируйся только на самой важной информации. Не уходи в детали.
 2. Для каждого ключевого момента укажи таймкод, взятый из начала соответствующего фрагмента в транскрипте.
 3. Убедись, что таймкод точно соответствует началу обсуждаемого ключевого момента.
 4. Отформатируй вывод в виде списка, где каждый элемент списка – это "Ключевой момент - ТАЙМКОД". Не добавляй ничего лишнего до или после списка.
-5. Не дублируй темы, которые были недавно законспектированы.
 Пример вывода:
 - Основная проблема психологии. - 10:15
-- Предложение первого подхода решения. - 15:30
-Ты уже законспектировал:\n"""
+- Предложение первого подхода решения. - 15:30"""
 
-    context_len = int((500 - count_token(system_prompt)) * 4)
+REDUCE_PROMPT = """Ты программа, которая объединяет несколько конспектов частей одной лекции в один конспект.
+Правила:
+1. Объедини пункты, которые говорят об одной и той же теме, оставь таймкод самого раннего из них.
+2. Не придумывай новых пунктов и не меняй таймкоды.
+3. Сохрани хронологический порядок.
+4. Отформатируй вывод в виде списка, где каждый элемент списка – это "Ключевой момент - ТАЙМКОД". Не добавляй ничего лишнего до или после списка."""
+
+NAME_PROMPT = "Ты - программа, которая должна дать название предоставленному конспекту. УЧТИ специфику и тему именно данного конспекта и включи их в название. В ответе дай только название в формате `Название конспекта`"
+
+CHUNK_TOKEN_LIMIT = 1500
 
-    limit = 1500
 
-    previous_summ = ""
+# Суммаризация по схеме map-reduce: части конспектируются параллельно,
+# затем конспекты частей объединяются (иерархически, если не влезают в лимит)
+class SummaryEngine:
+    def __init__(
+        self,
+        backend=None,
+        concurrency=SUMMARY_CONCURRENCY,
+        retries=SUMMARY_RETRIES,
+        backoff=SUMMARY_BACKOFF,
+        cache=None,
+    ):
+        self.backend = backend or BACKENDS[SUMMARY_BACKEND]()
+        self.cache = LLMCache() if cache is None else cache
+        self.retries = retries
+        self.backoff = backoff
+        self._concurrency = concurrency
+        self._semaphore = None
 
-    chunks = process_transcript(text, limit)
+    # прогоняет промпт
+    async def run_prompt(self, system_prompt, input_text):
+        messages = [
+            {"role": "system", "text": system_prompt},
+            {"role": "user", "text": input_text},
+        ]
+        key = None
+        if self.cache:
+            # тот же промпт уже прогонялся (повтор, перезагрузка файла)
+            key = prompt_key(SUMMARY_MODEL, SUMMARY_TEMPERATURE, system_prompt, input_text)
+            cached = await run_db(self.cache.get, key)
+            if cached is not None:
+                metrics.llm_requests_total.inc(label="cached")
+                return cached
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self._concurrency)
+        for attempt in range(self.retries + 1):
+            try:
+                async with self._semaphore:
+                    with metrics.stage("llm"):
+                        response = await self.backend.complete(messages)
+                metrics.llm_requests_total.inc(label="ok")
+                break
+            except Exception:
+                metrics.llm_requests_total.inc(label="error")
+                if attempt == self.retries:
+                    raise
+                delay = self.backoff * 2**attempt * (1 + random.random())
+                logger.warning("LLM request failed, retrying in %.1f s", delay)
+                await asyncio.sleep(delay)
+        if key:
+            await run_db(self.cache.put, key, response)
+        return response
 
-    for chunk in chunks:
-        system_prompt_context = system_prompt + previous_summ[-context_len:]
-        previous_summ += (
-            run_prompt(api_token, folder_id, system_prompt_context, chunk) + "\n"
+    async def summarize_chunks(self, chunks):
+        return await asyncio.gather(
+            *(self.run_prompt(SYSTEM_PROMPT, chunk) for chunk in chunks)
         )
-    return previous_summ
 
+    async def reduce(self, summaries, limit=CHUNK_TOKEN_LIMIT):
+        if len(summaries) == 1:
+            return summaries[0]
+        groups = process_transcript("\n".join(summaries), limit)
+        merged = await asyncio.gather(
+            *(self.run_prompt(REDUCE_PROMPT, group) for group in groups)
+        )
+        if len(merged) == 1:
+            return merged[0]
+        if len(merged) >= len(summaries):
+            # объединение больше не сокращает текст, отдаем как есть
+            return "\n".join(merged)
+        return await self.reduce(merged, limit)
 
-# Название из конспекта
-def get_name(summary):
-    system_prompt = "Ты - программа, которая должна дать название предоставленному конспекту. УЧТИ специфику и тему именно данного конспекта и включи их в название. В ответе дай только название в формате `Название конспекта`"
-    user_prompt = "Входные данные:\n" + summary
-    sum_name = run_prompt(api_token, folder_id, system_prompt, user_prompt)
-    return sum_name
+    # подгоняет оценку токенов под настоящий токенайзер модели
+    async def calibrate(self, texts):
+        counts = await asyncio.gather(*(self.backend.count_tokens(t) for t in texts))
+        tokenizer.fit(texts, counts)
+        logger.info("Tokenizer calibrated: %s", tokenizer.chars_per_token)
+
+    # Название из конспекта
+    async def get_name(self, summary):
+        return await self.run_prompt(NAME_PROMPT, "Входные данные:\n" + summary)
+
+    async def full_process(self, text):
+        text = cut_ms(text)
+        chunks, stats = chunk_transcript(
+            text, CHUNK_TOKEN_LIMIT, overlap=SUMMARY_CHUNK_OVERLAP
+        )
+        logger.info(
+            "Transcript split into %d chunks (%d segments, %d repeated, "
+            "%.0f mean / %.0f max tokens, %d oversized)",
+            stats.chunks,
+            stats.segments,
+            stats.overlap_segments,
+            stats.mean_tokens,
+            stats.max_tokens,
+            stats.oversized,
+        )
+        summaries = await self.summarize_chunks(chunks)
+        # название по конспектам частей, параллельно с объединением
+        summary, name = await asyncio.gather(
+            self.reduce(summaries),
+            self.get_name("\n".join(summaries)[: CHUNK_TOKEN_LIMIT * 4]),
+        )
+        if self.cache:
+            logger.info("LLM cache: %(hits)d hits, %(misses)d misses", self.cache.stats())
+        return name + "\n" + summary
+
+    async def close(self):
+        await self.backend.close()
+
+
+engine = None
+
+
+# Ну и типа общая логика
+async def summarize(text):
+    global engine
+    if engine is None:
+        engine = SummaryEngine()
+        if SUMMARY_CALIBRATE:
+            try:
+                await engine.calibrate(
+                    chunk_transcript(cut_ms(text), CALIBRATION_TOKENS)[0][:20]
+                )
+            except Exception:
+                logger.exception("Tokenizer calibration failed, keeping defaults")
+    return await engine.full_process(text)
+
+
+async def close_engine():
+    if engine is not None:
+        await engine.close()
 
 
 # Починка таймкодов вида 01:07 -> 00:01:07
@@ -104,9 +286,17 @@ def extract_timecodes(text):
     return "\n".join(text_no_tc)
 
 
-# Ну и типа общая логика
+# синхронные обертки над SummaryEngine для скриптов
+def iterate_run(text):
+    # конспекты частей подряд, как раньше, но части идут параллельно
+    chunks = process_transcript(text, CHUNK_TOKEN_LIMIT, overlap=SUMMARY_CHUNK_OVERLAP)
+    summaries = asyncio.run(SummaryEngine().summarize_chunks(chunks))
+    return "".join(summary + "\n" for summary in summaries)
+
+
+def get_name(summary):
+    return asyncio.run(SummaryEngine().get_name(summary))
+
+
 def full_process(text):
-    text = cut_ms(text)
-    summary = iterate_run(text)
-    name = get_name(text)
-    return name + "\n" + summary
+    return asyncio.run(SummaryEngine().full_process(text))
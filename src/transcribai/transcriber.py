@@ -0,0 +1,518 @@
+import os
+import re
+import time
+import shutil
+import resource
+from subprocess import PIPE, Popen, run
+from tempfile import TemporaryFile
+import numpy as np
+
+from imageio_ffmpeg import get_ffmpeg_exe
+
+from . import engines
+from . import vad
+from .models import registry, default_device, default_model_size
+
+# path to video processing executable
+FFMPEG_BINARY = shutil.which("ffmpeg") or get_ffmpeg_exe()
+
+AUDIO_BLOCK_SIZE = 1 << 20  # samples read from ffmpeg at once
+# whisper's fixed input layout, torch and whisper are only imported by the
+# inference workers, the bot process never loads them
+N_SAMPLES = 480000  # 30 s window at 16 kHz
+N_FRAMES = 3000  # mel frames per window
+FRAME_SECONDS = 0.01  # 160 samples hop per mel frame
+DURATION_RE = re.compile(r"Duration: (\d+):(\d+):(\d+(?:\.\d+)?)")
+# decoded audio is kept next to the upload as int16, repeat transcriptions
+# map it instead of running ffmpeg again
+PCM_CACHE = os.getenv("PCM_CACHE", "1") == "1"
+PCM_FILE = "audio.npy"
+
+
+def ffmpeg_decode_cmd(file, sr):
+    return [
+        FFMPEG_BINARY,
+        "-nostdin",
+        "-threads",
+        "0",
+        "-i",
+        file,
+        "-f",
+        "s16le",
+        "-ac",
+        "1",
+        "-acodec",
+        "pcm_s16le",
+        "-ar",
+        str(sr),
+        "-",
+    ]
+
+
+def probe_duration(file):
+    # media duration in seconds from the ffmpeg header dump, None if unknown
+    proc = run([FFMPEG_BINARY, "-nostdin", "-hide_banner", "-i", file], capture_output=True)
+    match = DURATION_RE.search(proc.stderr.decode(errors="ignore"))
+    if not match:
+        return None
+    h, m, s = match.groups()
+    return int(h) * 3600 + int(m) * 60 + float(s)
+
+
+def _read_block(stream, buf):
+    # fills buf from the pipe, returns the number of bytes read (< len only at EOF)
+    view = memoryview(buf).cast("B")
+    pos = 0
+    while pos < len(view):
+        n = stream.readinto(view[pos:])
+        if not n:
+            break
+        pos += n
+    return pos
+
+
+def decode_blocks(file, sr=16000, block_size=AUDIO_BLOCK_SIZE):
+    # yields int16 views of one reused block buffer while ffmpeg is decoding
+    raw = np.empty(block_size, np.int16)
+    n = 0
+    with TemporaryFile() as stderr:
+        proc = Popen(ffmpeg_decode_cmd(file, sr), stdout=PIPE, stderr=stderr)
+        try:
+            while True:
+                n = _read_block(proc.stdout, raw) // 2
+                if n:
+                    yield raw[:n]
+                if n < block_size:
+                    break
+        finally:
+            # the consumer may stop early, ffmpeg is not needed anymore then
+            if proc.poll() is None and n == block_size:
+                proc.kill()
+            proc.stdout.close()
+            returncode = proc.wait()
+        if returncode:
+            stderr.seek(0)
+            raise RuntimeError(f"Failed to load audio: {stderr.read().decode()}")
+
+
+def iter_audio(file, sr=16000, block_size=AUDIO_BLOCK_SIZE):
+    # streaming mode: float32 windows of block_size samples as they are decoded
+    for block in decode_blocks(file, sr, block_size):
+        window = np.empty(len(block), np.float32)
+        np.multiply(block, 1 / 32768.0, out=window)
+        yield window
+
+
+def load_audio(file: str, sr: int = 16000):
+    # decodes into one preallocated float32 buffer, scaling block by block,
+    # so peak memory is the decoded audio plus a single block
+    duration = probe_duration(file)
+    capacity = int(duration * sr) + sr if duration else 600 * sr
+    audio = np.empty(capacity, np.float32)
+    pos = 0
+    for block in decode_blocks(file, sr):
+        if pos + len(block) > len(audio):
+            audio.resize(max(2 * len(audio), pos + len(block)), refcheck=False)
+        np.multiply(block, 1 / 32768.0, out=audio[pos : pos + len(block)])
+        pos += len(block)
+    audio.resize(pos, refcheck=False)
+    return audio
+
+
+def pcm_path(file_path):
+    return os.path.join(os.path.dirname(file_path), PCM_FILE)
+
+
+def cached_pcm(file_path):
+    # the decoded recording memory-mapped, None if not decoded yet; int16
+    # samples, vad.as_float converts the parts that are used as they are used
+    path = pcm_path(file_path)
+    if not PCM_CACHE or not os.path.exists(path):
+        return None
+    return np.load(path, mmap_mode="r")
+
+
+def pcm_duration(file_path, sr=16000):
+    # seconds of the decoded recording from the file header, None if not decoded
+    path = pcm_path(file_path)
+    if not PCM_CACHE or not os.path.exists(path):
+        return None
+    return len(np.load(path, mmap_mode="r")) / sr
+
+
+def _write_pcm(path, audio, block_size=1 << 20):
+    # int16, half the size of float32 and exact for what ffmpeg decodes;
+    # block by block to keep memory flat, under a temporary name so a reader
+    # never maps half a file
+    tmp = f"{path}.{os.getpid()}.tmp"
+    packed = np.lib.format.open_memmap(tmp, mode="w+", dtype=np.int16, shape=(len(audio),))
+    for start in range(0, len(audio), block_size):
+        block = audio[start : start + block_size]
+        if block.dtype != np.int16:
+            block = np.clip(np.rint(block * 32768.0), -32768, 32767)
+        packed[start : start + block_size] = block
+    packed.flush()
+    del packed
+    os.replace(tmp, path)
+
+
+def save_pcm(file_path, audio):
+    if not PCM_CACHE:
+        return
+    _write_pcm(pcm_path(file_path), audio)
+
+
+def pack_pcm(file_path):
+    # rewrites a decoded recording cached as float32 by earlier versions
+    path = pcm_path(file_path)
+    if not os.path.exists(path):
+        return
+    audio = np.load(path, mmap_mode="r")
+    if audio.dtype != np.int16:
+        _write_pcm(path, audio)
+
+
+def load_pcm(file_path, sr=16000):
+    # load_audio that decodes a file only once
+    audio = cached_pcm(file_path)
+    if audio is None:
+        audio = load_audio(file_path, sr)
+        save_pcm(file_path, audio)
+    return audio
+
+
+def srt_time(seconds):
+    h, m = divmod(int(seconds // 60), 60)
+    s = int(seconds % 60)
+    ms = int((seconds - int(seconds)) * 1000)
+    return f"{h:02}:{m:02}:{s:02},{ms:03}"
+
+
+def srt_entry(i, seg):
+    return f"{i}\n{srt_time(seg['start'])} - {srt_time(seg['end'])}\n{seg['text'].strip()}\n\n"
+
+
+def txt_line(seg):
+    start = srt_time(seg["start"])
+    end = srt_time(seg["end"])
+    try:
+        text = seg["text"].strip()
+    except:
+        text = ""
+    return f"[{start} --> {end}]  {text}\n"
+
+
+def write_srt(segments, srt_path):
+    with open(srt_path, "w") as f:
+        for i, seg in enumerate(segments, 1):
+            f.write(srt_entry(i, seg))
+
+
+def write_txt_with_timecodes(segments, txt_path):
+    with open(txt_path, "w", encoding="utf8") as f:
+        for seg in segments:
+            f.write(txt_line(seg))
+
+
+class TranscriptWriter:
+    # incremental counterpart of save_transcripts, appends segments to both
+    # files as they are produced so a partial transcript is always on disk
+    def __init__(self, transcriptions_dir):
+        os.makedirs(transcriptions_dir, exist_ok=True)
+        self.srt_path = os.path.join(transcriptions_dir, "transcript.srt")
+        self.txt_path = os.path.join(transcriptions_dir, "transcript.txt")
+        self.srt = open(self.srt_path, "w")
+        self.txt = open(self.txt_path, "w", encoding="utf8")
+        self.count = 0
+
+    def append(self, segments):
+        for seg in segments:
+            self.count += 1
+            self.srt.write(srt_entry(self.count, seg))
+            self.txt.write(txt_line(seg))
+        self.srt.flush()
+        self.txt.flush()
+
+    def close(self):
+        self.srt.close()
+        self.txt.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def save_transcripts(result, transcriptions_dir):
+    os.makedirs(transcriptions_dir, exist_ok=True)
+    srt_path = os.path.join(transcriptions_dir, "transcript.srt")
+    txt_path = os.path.join(transcriptions_dir, "transcript.txt")
+    write_srt(result["segments"], srt_path)
+    write_txt_with_timecodes(result["segments"], txt_path)
+    return srt_path, txt_path
+
+
+def current_model(engine=None, model_size=None):
+    # (model size, device, engine) of the registry entry a job uses
+    engine = engines.get(engine)
+    device = engine.device(default_device())
+    return model_size or default_model_size(device), device, engine.name
+
+
+# the functions below run inside inference worker processes,
+# where the model stays resident between jobs
+def reset_peak_rss():
+    # restarts the kernel's high-water mark (VmHWM) from the current RSS, so
+    # the peak read after a call is that call's; Linux only
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+def peak_rss():
+    # since the last reset_peak_rss, the process's lifetime peak where the
+    # kernel doesn't allow a reset
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def worker_stats(start, loaded):
+    # timings and memory sent back with a result, metrics are kept in the bot process
+    return {
+        "model_load": loaded - start,
+        "inference": time.perf_counter() - loaded,
+        "peak_rss": peak_rss(),
+    }
+
+
+def vad_stats(audio, speech, seconds):
+    return {"vad": seconds, "vad_skipped": (len(audio) - len(speech)) / 16000}
+
+
+def no_speech(language):
+    return {"text": "", "segments": [], "language": language}
+
+
+def transcribe_audio(audio, language=None, engine=None, model_size=None):
+    key = current_model(engine, model_size)
+    reset_peak_rss()
+    start = time.perf_counter()
+    speech, offsets = vad.skip_silence(audio)
+    stats = vad_stats(audio, speech, time.perf_counter() - start)
+    start = time.perf_counter()
+    with registry.use(*key) as model:
+        loaded = time.perf_counter()
+        if len(speech):
+            result = engines.get(key[2]).transcribe(model, speech, language)
+        else:
+            result = no_speech(language)
+    result["stats"] = dict(worker_stats(start, loaded), **stats)
+    return vad.restore_timestamps(result, offsets)
+
+
+def transcribe_file(
+    file_path, transcriptions_dir, language=None, engine=None, model_size=None
+):
+    # (transcript paths, stats); a decode is timed only if there was one
+    decoded = cached_pcm(file_path) is None
+    start = time.perf_counter()
+    audio = load_pcm(file_path)
+    decode = time.perf_counter() - start
+    result = transcribe_audio(audio, language, engine, model_size)
+    stats = result.pop("stats")
+    if decoded:
+        stats["decode"] = decode
+    return save_transcripts(result, transcriptions_dir), stats
+
+
+def detect_language(audio, engine=None, model_size=None):
+    # on the speech in audio, dead air before the speaker starts says nothing
+    key = current_model(engine, model_size)
+    speech, _ = vad.skip_silence(audio)
+    with registry.use(*key) as model:
+        return engines.get(key[2]).detect_language(
+            model, speech if len(speech) else vad.as_float(audio)
+        )
+
+
+# decoding fallback of the batched path, same thresholds as model.transcribe
+BATCH_TEMPERATURES = (0.0, 0.2, 0.4, 0.6, 0.8, 1.0)
+COMPRESSION_RATIO_THRESHOLD = 2.4
+LOGPROB_THRESHOLD = -1.0
+NO_SPEECH_THRESHOLD = 0.6
+TIME_PRECISION = 0.02  # seconds per timestamp token
+INPUT_STRIDE = 2  # mel frames per audio context position
+
+
+def _needs_fallback(result):
+    if result.no_speech_prob > NO_SPEECH_THRESHOLD:
+        return False
+    return (
+        result.compression_ratio > COMPRESSION_RATIO_THRESHOLD
+        or result.avg_logprob < LOGPROB_THRESHOLD
+    )
+
+
+def decode_windows(model, mels, language=None):
+    # one batched greedy decode of 30 s mel windows; windows that look like
+    # hallucinations are decoded again one by one at higher temperatures,
+    # whisper's best_of sampling doesn't work on batches
+    import torch
+    import whisper
+
+    fp16 = next(model.parameters()).dtype == torch.float16
+    options = whisper.DecodingOptions(language=language, temperature=0.0, fp16=fp16)
+    results = whisper.decode(model, mels, options)
+    for i, result in enumerate(results):
+        for temperature in BATCH_TEMPERATURES[1:]:
+            if not _needs_fallback(result):
+                break
+            options = whisper.DecodingOptions(
+                language=language, temperature=temperature, best_of=5, fp16=fp16
+            )
+            result = whisper.decode(model, mels[i], options)
+        results[i] = result
+    return results
+
+
+class _Stream:
+    # one recording in a batch, keeps its position the way model.transcribe does
+    def __init__(self, model, audio, language):
+        import whisper
+
+        self.model = model
+        self.mel = whisper.log_mel_spectrogram(
+            audio, model.dims.n_mels, padding=N_SAMPLES
+        ).to(model.device)
+        self.frames = self.mel.shape[-1] - N_FRAMES
+        self.language = language
+        self.seek = 0
+        self.segment_size = 0
+        self.segments = []
+
+    @property
+    def done(self):
+        return self.seek >= self.frames
+
+    def window(self):
+        import whisper
+
+        self.segment_size = min(N_FRAMES, self.frames - self.seek)
+        mel = self.mel[:, self.seek : self.seek + self.segment_size]
+        return whisper.pad_or_trim(mel, N_FRAMES)
+
+    def _add_segment(self, tokenizer, start, end, tokens, result):
+        text = tokenizer.decode([t for t in tokens if t < tokenizer.eot])
+        if not text.strip() or end <= start:
+            return
+        self.segments.append(
+            {
+                "id": len(self.segments),
+                "seek": self.seek,
+                "start": start,
+                "end": end,
+                "text": text,
+                "tokens": tokens,
+                "temperature": result.temperature,
+                "avg_logprob": result.avg_logprob,
+                "compression_ratio": result.compression_ratio,
+                "no_speech_prob": result.no_speech_prob,
+            }
+        )
+
+    def consume(self, result):
+        # turns the timestamp tokens of one decoded window into segments and
+        # moves to the next window
+        import torch
+        from whisper.tokenizer import get_tokenizer
+
+        if self.language is None:
+            self.language = result.language
+        if result.no_speech_prob > NO_SPEECH_THRESHOLD and result.avg_logprob < LOGPROB_THRESHOLD:
+            self.seek += self.segment_size
+            return
+        tokenizer = get_tokenizer(
+            self.model.is_multilingual,
+            num_languages=self.model.num_languages,
+            language=self.language,
+            task="transcribe",
+        )
+        offset = self.seek * FRAME_SECONDS
+        tokens = torch.tensor(result.tokens)
+        is_timestamp = tokens.ge(tokenizer.timestamp_begin)
+        single_ending = is_timestamp[-2:].tolist() == [False, True]
+        consecutive = (torch.where(is_timestamp[:-1] & is_timestamp[1:])[0] + 1).tolist()
+        if consecutive:
+            if single_ending:
+                consecutive.append(len(tokens))
+            last = 0
+            for current in consecutive:
+                sliced = tokens[last:current]
+                start = (sliced[0].item() - tokenizer.timestamp_begin) * TIME_PRECISION
+                end = (sliced[-1].item() - tokenizer.timestamp_begin) * TIME_PRECISION
+                self._add_segment(
+                    tokenizer, offset + start, offset + end, sliced.tolist(), result
+                )
+                last = current
+            if single_ending:
+                self.seek += self.segment_size
+            else:
+                position = tokens[last - 1].item() - tokenizer.timestamp_begin
+                self.seek += position * INPUT_STRIDE or self.segment_size
+        else:
+            duration = self.segment_size * FRAME_SECONDS
+            timestamps = tokens[is_timestamp]
+            if len(timestamps) and timestamps[-1].item() != tokenizer.timestamp_begin:
+                duration = (timestamps[-1].item() - tokenizer.timestamp_begin) * TIME_PRECISION
+            self._add_segment(tokenizer, offset, offset + duration, result.tokens, result)
+            self.seek += self.segment_size
+
+    def result(self):
+        return {
+            "text": "".join(seg["text"] for seg in self.segments),
+            "segments": self.segments,
+            "language": self.language,
+        }
+
+
+def transcribe_batch(items):
+    # batched counterpart of transcribe_audio for [(audio, language), ...]:
+    # the current 30 s window of every recording goes through the encoder and
+    # greedy decoding together; windows are not conditioned on the previous
+    # text, the decoder takes one prompt per batch; uses the deployment's
+    # engine, which has to be a whisper model
+    import torch
+
+    reset_peak_rss()
+    start = time.perf_counter()
+    skipped = [vad.skip_silence(audio) for audio, _ in items]
+    vad_seconds = (time.perf_counter() - start) / len(items)
+    start = time.perf_counter()
+    with registry.use(*current_model()) as model:
+        loaded = time.perf_counter()
+        streams = [
+            _Stream(model, speech, language) for (speech, _), (_, language) in zip(skipped, items)
+        ]
+        while active := [stream for stream in streams if not stream.done]:
+            groups = {}
+            for stream in active:
+                groups.setdefault(stream.language, []).append(stream)
+            for language, group in groups.items():
+                mels = torch.stack([stream.window() for stream in group])
+                for stream, result in zip(group, decode_windows(model, mels, language)):
+                    stream.consume(result)
+        results = [stream.result() for stream in streams]
+    stats = worker_stats(start, loaded)
+    for result, (audio, _), (speech, offsets) in zip(results, items, skipped):
+        result["stats"] = dict(stats, **vad_stats(audio, speech, vad_seconds))
+        vad.restore_timestamps(result, offsets)
+    return results
@@ -0,0 +1,157 @@
+import re
+from dataclasses import dataclass, field
+
+import numpy as np
+
+CHUNK_HEADER = "Входные данные:\n"
+
+# lines of transcript.txt start with "[00:00:00,000 --> 00:00:05,000]"
+TIMECODE_LINE_RE = re.compile(r"^\s*\[\d{1,2}:\d{2}")
+TIMECODE_RE = re.compile(TIMECODE_LINE_RE.pattern, re.MULTILINE)
+
+# character classes the tokenizer estimate is built from
+CHAR_CLASSES = ("cyrillic", "latin", "digit", "space", "other")
+CLASS_TABLE_SIZE = 0x500  # everything above the cyrillic block is "other"
+
+
+def _class_table():
+    table = np.full(CLASS_TABLE_SIZE, CHAR_CLASSES.index("other"), np.int8)
+    table[0x400:0x500] = CHAR_CLASSES.index("cyrillic")
+    table[ord("A") : ord("Z") + 1] = CHAR_CLASSES.index("latin")
+    table[ord("a") : ord("z") + 1] = CHAR_CLASSES.index("latin")
+    table[ord("0") : ord("9") + 1] = CHAR_CLASSES.index("digit")
+    table[[9, 10, 11, 12, 13, 32, 0xA0]] = CHAR_CLASSES.index("space")
+    return table
+
+
+CLASS_TABLE = _class_table()
+
+
+def _char_classes(text):
+    cp = np.frombuffer(text.encode("utf-32-le"), np.uint32)
+    return np.where(
+        cp < CLASS_TABLE_SIZE,
+        CLASS_TABLE[np.minimum(cp, CLASS_TABLE_SIZE - 1)],
+        CHAR_CLASSES.index("other"),
+    )
+
+
+# characters per token, rough defaults for SentencePiece-style vocabularies,
+# CalibratedTokenizer.fit refines them against a real tokenizer
+DEFAULT_CHARS_PER_TOKEN = {
+    "cyrillic": 2.6,
+    "latin": 3.8,
+    "digit": 1.6,
+    "space": 8.0,
+    "other": 1.3,
+}
+
+
+class CalibratedTokenizer:
+    # token count estimated as a weighted sum of character class counts
+    def __init__(self, chars_per_token=None):
+        self.chars_per_token = dict(chars_per_token or DEFAULT_CHARS_PER_TOKEN)
+
+    @staticmethod
+    def class_counts(text):
+        counts = np.bincount(_char_classes(text), minlength=len(CHAR_CLASSES))
+        return {name: int(n) for name, n in zip(CHAR_CLASSES, counts)}
+
+    def count(self, text):
+        counts = self.class_counts(text)
+        return sum(n / self.chars_per_token[name] for name, n in counts.items())
+
+    def count_many(self, texts):
+        # token estimates for many texts from one vectorized pass over all of them
+        weights = np.array([1 / self.chars_per_token[name] for name in CHAR_CLASSES])
+        totals = np.concatenate(([0.0], np.cumsum(weights[_char_classes("".join(texts))])))
+        bounds = np.cumsum([0] + [len(t) for t in texts])
+        return (totals[bounds[1:]] - totals[bounds[:-1]]).tolist()
+
+    def fit(self, texts, token_counts):
+        # least squares fit of tokens-per-char for every class against real
+        # token counts, e.g. from the completion API tokenize endpoint
+        names = list(CHAR_CLASSES)
+        x = np.array([[self.class_counts(t)[n] for n in names] for t in texts], float)
+        y = np.array(token_counts, float)
+        weights, *_ = np.linalg.lstsq(x, y, rcond=None)
+        for name, weight, column in zip(names, weights, x.T):
+            if weight > 0 and column.any():
+                self.chars_per_token[name] = float(1 / weight)
+        return self
+
+
+tokenizer = CalibratedTokenizer()
+
+
+@dataclass
+class ChunkStats:
+    chunks: int = 0
+    segments: int = 0
+    overlap_segments: int = 0
+    oversized: int = 0  # single segments that don't fit the limit alone
+    tokens: list = field(default_factory=list)
+
+    @property
+    def max_tokens(self):
+        return max(self.tokens, default=0)
+
+    @property
+    def mean_tokens(self):
+        return sum(self.tokens) / len(self.tokens) if self.tokens else 0
+
+
+def _segments(text):
+    # groups lines into segments, a line without a timecode continues the last
+    # one; text without any timecodes is split line by line
+    lines = [line for line in text.split("\n") if line.strip()]
+    timecoded = TIMECODE_RE.search(text) is not None
+    if not timecoded:
+        return lines
+    segments = []
+    for line in lines:
+        if segments and not TIMECODE_LINE_RE.match(line):
+            segments[-1] += "\n" + line
+        else:
+            segments.append(line)
+    return segments
+
+
+def chunk_transcript(text, limit, tokenizer=tokenizer, overlap=0, header=CHUNK_HEADER):
+    # single pass over the segments: every segment is counted once and chunks
+    # are only cut between segments; the last `overlap` segments of a chunk
+    # are repeated at the start of the next one for context
+    stats = ChunkStats()
+    chunks = []
+    header_tokens = tokenizer.count(header)
+    budget = limit - header_tokens
+    current, current_tokens = [], []
+    total = 0.0
+
+    def emit():
+        chunks.append(header + "\n".join(current))
+        stats.tokens.append(total + header_tokens)
+
+    segments = _segments(text)
+    stats.segments = len(segments)
+    for segment, tokens in zip(segments, tokenizer.count_many(segments)):
+        tokens += 1  # the newline joining segments
+        if current and total + tokens > budget:
+            emit()
+            keep = min(overlap, len(current))
+            # context must leave room for new segments
+            while keep and sum(current_tokens[-keep:]) + tokens > budget / 2:
+                keep -= 1
+            current = current[len(current) - keep :]
+            current_tokens = current_tokens[len(current_tokens) - keep :]
+            total = sum(current_tokens)
+            stats.overlap_segments += keep
+        if tokens > budget:
+            stats.oversized += 1
+        current.append(segment)
+        current_tokens.append(tokens)
+        total += tokens
+    if current:
+        emit()
+    stats.chunks = len(chunks)
+    return chunks, stats
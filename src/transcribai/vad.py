@@ -0,0 +1,104 @@
+import os
+from bisect import bisect_right
+
+import numpy as np
+
+# energy-based voice activity detection: long silences are cut out before
+# inference and segment timestamps are mapped back to the recording's timeline
+VAD_FILTER = os.getenv("VAD_FILTER", "1") == "1"
+# only pauses at least this long are cut, shorter ones stay in the audio
+VAD_MIN_SILENCE_SECONDS = float(os.getenv("VAD_MIN_SILENCE_SECONDS", "2"))
+VAD_PAD_SECONDS = float(os.getenv("VAD_PAD_SECONDS", "0.4"))  # kept around speech
+VAD_MARGIN_DB = float(os.getenv("VAD_MARGIN_DB", "10"))
+VAD_FLOOR_DB = -60.0  # digital silence and hiss below this is never speech
+VAD_FRAME_SECONDS = 0.02
+VAD_MIN_SKIP = 0.05  # not worth copying the audio for less
+BLOCK_FRAMES = 1 << 14  # converted at a time, ~5 min at 20 ms
+
+SAMPLE_RATE = 16000
+
+
+def as_float(audio):
+    # float32 samples as the models take them; the decoded-audio cache keeps
+    # int16, which is converted here, one block or region at a time
+    if audio.dtype == np.float32:
+        return audio
+    out = np.empty(len(audio), np.float32)
+    np.multiply(audio, 1 / 32768.0, out=out)
+    return out
+
+
+def frame_db(audio, frame):
+    n = len(audio) // frame
+    energy = np.empty(n, np.float32)
+    for i in range(0, n, BLOCK_FRAMES):
+        m = min(BLOCK_FRAMES, n - i)
+        frames = as_float(audio[i * frame : (i + m) * frame]).reshape(m, frame)
+        energy[i : i + m] = np.einsum("ij,ij->i", frames, frames) / frame
+    return 10 * np.log10(energy + 1e-10)
+
+
+def speech_regions(audio, sr=SAMPLE_RATE):
+    # (start, end) sample ranges with speech; a frame is voiced when it is
+    # VAD_MARGIN_DB above the noise floor, capped below the loud parts so a
+    # recording without pauses keeps everything
+    frame = int(sr * VAD_FRAME_SECONDS)
+    if len(audio) < frame:
+        return [(0, len(audio))] if len(audio) else []
+    db = frame_db(audio, frame)
+    noise, loud = np.percentile(db, [10, 95])
+    threshold = max(VAD_FLOOR_DB, min(noise + VAD_MARGIN_DB, loud - VAD_MARGIN_DB))
+    voiced = np.concatenate(([0], (db > threshold).view(np.int8), [0]))
+    edges = np.flatnonzero(np.diff(voiced)) * frame
+    if len(edges) and edges[-1] == len(db) * frame:
+        edges[-1] = len(audio)  # the partial last frame goes with the speech
+    pad = int(sr * VAD_PAD_SECONDS)
+    gap = int(sr * VAD_MIN_SILENCE_SECONDS)
+    regions = []
+    for start, end in zip(edges[::2].tolist(), edges[1::2].tolist()):
+        start, end = max(0, start - pad), min(len(audio), end + pad)
+        if regions and start - regions[-1][1] < gap:
+            regions[-1] = (regions[-1][0], end)
+        else:
+            regions.append((start, end))
+    return regions
+
+
+def skip_silence(audio, sr=SAMPLE_RATE):
+    # (speech audio, offsets) with offsets as [(position in speech, position in
+    # audio)] per kept region; offsets is None when the audio is used as is
+    if not VAD_FILTER:
+        return as_float(audio), None
+    regions = speech_regions(audio, sr)
+    kept = sum(end - start for start, end in regions)
+    if kept > len(audio) * (1 - VAD_MIN_SKIP):
+        return as_float(audio), None
+    speech = np.empty(kept, np.float32)
+    offsets, pos = [], 0
+    for start, end in regions:
+        speech[pos : pos + end - start] = as_float(audio[start:end])
+        offsets.append((pos, start))
+        pos += end - start
+    return speech, offsets
+
+
+def to_original(seconds, offsets, sr=SAMPLE_RATE, end=False):
+    # a time in the speech audio on the original timeline; an end time on a
+    # region boundary stays with the region it ends
+    sample = seconds * sr
+    positions = [pos for pos, _ in offsets]
+    i = bisect_right(positions, sample - (1 if end else 0)) - 1
+    pos, start = offsets[max(i, 0)]
+    return (start + sample - pos) / sr
+
+
+def restore_timestamps(result, offsets, sr=SAMPLE_RATE):
+    if not offsets:
+        return result
+    for seg in result["segments"]:
+        seg["start"] = to_original(seg["start"], offsets, sr)
+        seg["end"] = to_original(seg["end"], offsets, sr, end=True)
+        for word in seg.get("words") or ():
+            word["start"] = to_original(word["start"], offsets, sr)
+            word["end"] = to_original(word["end"], offsets, sr, end=True)
+    return result
@@ -0,0 +1,97 @@
+import os
+import asyncio
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+logger = logging.getLogger(__name__)
+
+INFERENCE_WORKERS = int(os.getenv("INFERENCE_WORKERS", "1"))
+
+
+def available_cores():
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def core_slices(workers, cores=None):
+    # split the cores into disjoint equal slices, one per worker
+    cores = cores if cores is not None else available_cores()
+    per_worker = max(1, len(cores) // workers)
+    slices = []
+    for i in range(workers):
+        part = cores[i * per_worker : (i + 1) * per_worker]
+        slices.append(part or cores[i % len(cores) :][:1])
+    return slices
+
+
+def _init_worker(slots):
+    # every worker process takes one core slice when it starts
+    cores = slots.get()
+    if hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cores)
+    import torch
+
+    torch.set_num_threads(len(cores))
+    torch.set_num_interop_threads(1)
+
+    from .models import PRELOAD_MODEL, preload_default_model
+
+    if PRELOAD_MODEL:
+        preload_default_model()
+    logger.info("Inference worker %d started on cores %s", os.getpid(), cores)
+
+
+def _noop():
+    return os.getpid()
+
+
+class InferencePool:
+    # long-lived worker processes for whisper inference, each pinned to its own
+    # slice of cores with a matching number of torch threads
+    def __init__(self, workers=INFERENCE_WORKERS):
+        self.workers = workers
+        self._executor = None
+
+    def _create_executor(self):
+        ctx = multiprocessing.get_context("spawn")
+        slots = ctx.Queue()
+        for cores in core_slices(self.workers):
+            slots.put(cores)
+        return ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=ctx,
+            initializer=_init_worker,
+            initargs=(slots,),
+        )
+
+    @property
+    def executor(self):
+        if self._executor is None:
+            self._executor = self._create_executor()
+        return self._executor
+
+    async def run(self, fn, *args):
+        # fn and its arguments are pickled to a worker, result or error comes back
+        loop = asyncio.get_running_loop()
+        try:
+            return await loop.run_in_executor(self.executor, fn, *args)
+        except BrokenProcessPool:
+            # a worker died (e.g. killed for memory), start a fresh pool
+            logger.exception("Inference pool broken, restarting it")
+            self.shutdown()
+            raise RuntimeError("Inference worker crashed, please try again later")
+
+    async def warm(self):
+        # spawns every worker so models are preloaded before the first job
+        await asyncio.gather(*(self.run(_noop) for _ in range(self.workers)))
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+
+inference_pool = InferencePool()
@@ -0,0 +1,19 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+# the package reads DATA_DIR on import, keep the checkout's data/ out of tests
+os.environ["DATA_DIR"] = tempfile.mkdtemp(prefix="transcribai-tests-")
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+
+@pytest.fixture
+def fresh_db(tmp_path, monkeypatch):
+    # an empty database of the test's own, for tests that read every row
+    from transcribai import db
+
+    monkeypatch.setattr(db, "DATA_DB_PATH", str(tmp_path / "database.db"))
+    db.init_db()
+    return db
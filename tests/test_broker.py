@@ -0,0 +1,99 @@
+import os
+import socket
+import asyncio
+
+import pytest
+
+from transcribai import broker, db
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+async def serve(token="secret"):
+    port = free_port()
+    runner = await broker.start_server("127.0.0.1", port, token)
+    return runner, f"http://127.0.0.1:{port}"
+
+
+@pytest.fixture(autouse=True)
+def database():
+    db.init_db()
+
+
+def test_round_trip():
+    async def run():
+        runner, url = await serve()
+        client = broker.BrokerClient(url, "secret")
+        try:
+            await client.call("record_model_speed", "broker-test", 0.5, 0.2, 1.0)
+            claimed = await client.call("claim_job", "w1", 60, 3)
+        finally:
+            await client.close()
+            await runner.cleanup()
+        return claimed
+
+    assert asyncio.run(run()) is None
+    assert db.get_model_speeds()["broker-test"] == pytest.approx(0.5)
+
+
+def test_rejects_bad_token():
+    async def run():
+        runner, url = await serve()
+        client = broker.BrokerClient(url, "wrong")
+        try:
+            with pytest.raises(broker.BrokerError, match="bad token"):
+                await client.call("claim_job", "w1", 60, 3)
+            client.token = "secret"
+            await client.close()
+            with pytest.raises(broker.BrokerError, match="unknown operation"):
+                await client.call("init_db")
+        finally:
+            await client.close()
+            await runner.cleanup()
+
+    asyncio.run(run())
+
+
+def test_retries_until_reachable(monkeypatch):
+    monkeypatch.setattr(broker, "BROKER_BACKOFF", 0)
+    monkeypatch.setattr(broker, "BROKER_RETRIES", 2)
+
+    async def run():
+        client = broker.BrokerClient(f"http://127.0.0.1:{free_port()}", "")
+        try:
+            with pytest.raises(broker.BrokerError, match="unreachable"):
+                await client.call("claim_job", "w1", 60, 3)
+        finally:
+            await client.close()
+
+    asyncio.run(run())
+
+
+def test_needs_a_token_off_loopback():
+    async def run():
+        with pytest.raises(ValueError, match="JOB_BROKER_TOKEN"):
+            await broker.start_server("0.0.0.0", free_port(), "")
+        runner = await broker.start_server("127.0.0.1", free_port(), "")
+        await runner.cleanup()
+
+    asyncio.run(run())
+
+
+def test_copies_cached_transcripts_only_into_data_dir(tmp_path):
+    async def run():
+        runner, url = await serve()
+        client = broker.BrokerClient(url, "secret")
+        try:
+            with pytest.raises(broker.BrokerError, match="outside DATA_DIR"):
+                await client.call("lookup_cache", "key", str(tmp_path / "elsewhere"))
+            inside = os.path.join(db.DATA_DIR, "database", "1", "1_1", "transcriptions")
+            assert await client.call("lookup_cache", "key", inside) is False
+        finally:
+            await client.close()
+            await runner.cleanup()
+
+    asyncio.run(run())
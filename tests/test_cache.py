@@ -0,0 +1,34 @@
+import asyncio
+import hashlib
+
+from aiogram import Bot
+
+from transcribai.cache import HashingWriter
+
+
+class Sink:
+    def __init__(self):
+        self.data = b""
+
+    def feed(self, data):
+        self.data += data
+
+
+def test_download_file_through_hashing_writer(tmp_path):
+    chunks = [b"a" * 65536, b"b" * 65536, b"tail"]
+    bot = Bot("42:TEST")
+
+    async def stream_content(**kwargs):
+        for chunk in chunks:
+            yield chunk
+
+    bot.session.stream_content = stream_content
+    sink = Sink()
+    path = tmp_path / "media"
+    with open(path, "wb") as f:
+        writer = HashingWriter(f, sink=sink)
+        asyncio.run(bot.download_file("videos/file_1.mp4", writer, seek=False))
+    data = b"".join(chunks)
+    assert path.read_bytes() == data
+    assert sink.data == data
+    assert writer.hexdigest() == hashlib.sha256(data).hexdigest()
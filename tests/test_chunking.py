@@ -0,0 +1,77 @@
+from transcribai.chunking import (
+    SAMPLE_RATE,
+    SegmentMerger,
+    _seam_overlap,
+    _strip_leading_words,
+    merge_chunk_results,
+)
+
+SR = SAMPLE_RATE
+
+
+def seg(start, end, text):
+    return {"start": start, "end": end, "text": text}
+
+
+def result(*segments, language="en"):
+    return {"segments": list(segments), "language": language}
+
+
+def test_seam_overlap_finds_longest_repeated_words():
+    assert _seam_overlap(" so the gradient is", " The gradient is zero here") == 3
+    assert _seam_overlap(" so the gradient is", " something else") == 0
+    assert _seam_overlap("", " anything") == 0
+
+
+def test_strip_leading_words_keeps_the_rest_as_written():
+    assert _strip_leading_words(" The gradient, is zero here.", 3) == " zero here."
+    assert _strip_leading_words(" the gradient", 5) == ""
+
+
+def test_merger_shifts_chunks_to_the_timeline():
+    bounds = [(0, 0, 10 * SR), (9 * SR, 10 * SR, 20 * SR)]
+    results = [
+        result(seg(0.0, 4.0, " First part."), seg(4.0, 9.5, " Second part.")),
+        result(seg(1.5, 6.0, " Third part.")),
+    ]
+    merged = merge_chunk_results(results, bounds)
+    assert [(s["start"], s["end"], s["text"]) for s in merged["segments"]] == [
+        (0.0, 4.0, " First part."),
+        (4.0, 9.5, " Second part."),
+        (10.5, 15.0, " Third part."),
+    ]
+    assert [s["id"] for s in merged["segments"]] == [0, 1, 2]
+    assert merged["language"] == "en"
+
+
+def test_merger_drops_segments_said_in_the_overlap():
+    merger = SegmentMerger()
+    merger.add(result(seg(0.0, 9.8, " words before the seam")), (0, 0, 10 * SR))
+    added = merger.add(
+        result(seg(0.0, 0.8, " the seam"), seg(1.0, 4.0, " after it")),
+        (9 * SR, 10 * SR, 20 * SR),
+    )
+    assert [s["text"] for s in added] == [" after it"]
+    assert added[0]["start"] == 10.0
+
+
+def test_merger_strips_words_repeated_across_the_seam():
+    merger = SegmentMerger()
+    merger.add(result(seg(0.0, 10.0, " and then the gradient is")), (0, 0, 10 * SR))
+    added = merger.add(
+        result(seg(0.5, 3.0, " the gradient is zero")), (9 * SR, 10 * SR, 20 * SR)
+    )
+    assert added[0]["text"] == " zero"
+    # starts where the previous segment ends, not inside it
+    assert added[0]["start"] == 10.0
+
+
+def test_merger_drops_a_segment_that_only_repeats():
+    merger = SegmentMerger()
+    merger.add(result(seg(0.0, 10.0, " the gradient is")), (0, 0, 10 * SR))
+    added = merger.add(
+        result(seg(0.5, 2.0, " gradient is"), seg(2.0, 4.0, " zero")),
+        (9 * SR, 10 * SR, 20 * SR),
+    )
+    assert [s["text"] for s in added] == [" zero"]
+    assert [s["id"] for s in merger.segments] == [0, 1]
@@ -0,0 +1,45 @@
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+
+from transcribai import db
+
+
+def columns(conn, table):
+    return {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+
+
+def test_migrates_a_database_from_before_versioning(tmp_path, monkeypatch):
+    path = str(tmp_path / "database.db")
+    conn = sqlite3.connect(path)
+    conn.execute(
+        "CREATE TABLE files (user_telegram_id INTEGER, idx INTEGER, video_id TEXT, video_link TEXT, video_file_path TEXT, language TEXT, PRIMARY KEY(user_telegram_id, idx))"
+    )
+    conn.execute(
+        "CREATE TABLE jobs (id INTEGER PRIMARY KEY AUTOINCREMENT, user_telegram_id INTEGER, chat_id INTEGER, idx INTEGER, file_path TEXT, transcriptions_dir TEXT, language TEXT, state TEXT, error TEXT, created_at REAL, updated_at REAL)"
+    )
+    conn.execute("INSERT INTO files VALUES (1, 1, '1_1', NULL, '/media/1_1.mp4', 'en')")
+    conn.commit()
+    monkeypatch.setattr(db, "DATA_DB_PATH", path)
+    db.init_db()
+    db.init_db()  # applied migrations are not repeated
+
+    assert conn.execute("PRAGMA user_version").fetchone()[0] == len(db.MIGRATIONS)
+    assert {"status", "storage", "stored_bytes", "last_used"} <= columns(conn, "files")
+    assert {"media_hash", "worker_id", "attempts", "model_size"} <= columns(conn, "jobs")
+    # rows from before the upload status existed count as scheduled
+    assert db.get_file_by_id(1, 1) == ("1_1", None, "/media/1_1.mp4", "en", "scheduled", "original", None)
+    conn.close()
+
+
+def test_allocates_increasing_ids_per_user(fresh_db):
+    assert db.allocate_file(1) == (1, "1_1")
+    assert db.allocate_file(1, "https://example.com/v") == (2, "1_2")
+    assert db.allocate_file(2) == (1, "2_1")
+    assert db.get_file_by_id(1, 2)[1] == "https://example.com/v"
+    assert db.get_file_by_id(1, 2)[4] == "new"
+
+
+def test_concurrent_allocations_get_distinct_ids(fresh_db):
+    with ThreadPoolExecutor(8) as pool:
+        ids = list(pool.map(lambda _: db.allocate_file(3)[0], range(40)))
+    assert sorted(ids) == list(range(1, 41))
@@ -0,0 +1,163 @@
+import asyncio
+import hashlib
+
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from transcribai import downloads
+
+
+async def serve(statuses, body=b"media" * 1000):
+    # answers with the given statuses in turn, then with the file
+    requests = []
+
+    async def handler(request):
+        requests.append(request)
+        if len(requests) <= len(statuses):
+            return web.Response(status=statuses[len(requests) - 1])
+        return web.Response(body=body, content_type="application/octet-stream")
+
+    app = web.Application()
+    app.router.add_get("/file", handler)
+    server = TestServer(app)
+    await server.start_server()
+    return server, requests
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(downloads, "DOWNLOAD_BACKOFF", 0)
+    monkeypatch.setattr(downloads, "DOWNLOAD_RETRIES", 3)
+
+
+@pytest.mark.parametrize("statuses", [[503], [429], [500, 502]])
+def test_retries_server_errors(tmp_path, statuses):
+    async def run():
+        server, requests = await serve(statuses)
+        try:
+            path, _ = await downloads.fetch(str(server.make_url("/file")), tmp_path, "f.mp4")
+        finally:
+            await downloads.close()
+            await server.close()
+        return path, requests
+
+    path, requests = asyncio.run(run())
+    assert open(path, "rb").read() == b"media" * 1000
+    assert len(requests) == len(statuses) + 1
+
+
+def test_client_errors_fail_at_once(tmp_path):
+    async def run():
+        server, requests = await serve([404])
+        try:
+            with pytest.raises(downloads.DownloadError, match="HTTP 404"):
+                await downloads.fetch(str(server.make_url("/file")), tmp_path, "f.mp4")
+        finally:
+            await downloads.close()
+            await server.close()
+        return requests
+
+    assert len(asyncio.run(run())) == 1
+
+
+def test_gives_up_after_retries(tmp_path):
+    async def run():
+        server, requests = await serve([503] * 10)
+        try:
+            with pytest.raises(downloads.DownloadError, match="503"):
+                await downloads.fetch(str(server.make_url("/file")), tmp_path, "f.mp4")
+        finally:
+            await downloads.close()
+            await server.close()
+        return requests
+
+    assert len(asyncio.run(run())) == 4
+
+
+async def serve_ranges(body, cut_at=None, honor_range=True):
+    # serves body, the first response is cut off after cut_at bytes
+    requests = []
+
+    async def handler(request):
+        requests.append(request.headers.get("Range"))
+        start = 0
+        if honor_range and request.headers.get("Range"):
+            start = int(request.headers["Range"][len("bytes=") : -1])
+        resp = web.StreamResponse(status=206 if start else 200)
+        resp.content_type = "application/octet-stream"
+        resp.content_length = len(body) - start
+        await resp.prepare(request)
+        if cut_at is not None and len(requests) == 1:
+            await resp.write(body[start:cut_at])
+            # the client reads what arrived before it sees the connection drop
+            await asyncio.sleep(0.2)
+            request.transport.close()
+            return resp
+        await resp.write(body[start:])
+        return resp
+
+    app = web.Application()
+    app.router.add_get("/file", handler)
+    server = TestServer(app)
+    await server.start_server()
+    return server, requests
+
+
+def fetch_from(server_args, tmp_path, sink=None):
+    async def run():
+        server, requests = await serve_ranges(*server_args)
+        try:
+            result = await downloads.fetch(str(server.make_url("/file")), tmp_path, "f.mp4", sink=sink)
+        finally:
+            await downloads.close()
+            await server.close()
+        return result, requests
+
+    return asyncio.run(run())
+
+
+BODY = bytes(range(256)) * 4096
+
+
+class Sink:
+    def __init__(self):
+        self.data = b""
+
+    def feed(self, data):
+        self.data += data
+
+    def reset(self):
+        self.data = b""
+
+
+def test_resumes_a_cut_transfer_with_a_range_request(tmp_path, monkeypatch):
+    monkeypatch.setattr(downloads, "DOWNLOAD_CHUNK_SIZE", 1 << 16)
+    sink = Sink()
+    (path, digest), requests = fetch_from((BODY, 300_000), tmp_path, sink)
+    assert requests[0] is None and requests[1].startswith("bytes=")
+    assert 0 < int(requests[1][len("bytes=") : -1]) <= 300_000
+    assert open(path, "rb").read() == BODY
+    assert digest == hashlib.sha256(BODY).hexdigest()
+    assert sink.data == BODY
+
+
+def test_resumes_a_partial_file_of_an_earlier_attempt(tmp_path):
+    (tmp_path / "f.mp4.part").write_bytes(BODY[:100_000])
+    sink = Sink()
+    (path, digest), requests = fetch_from((BODY,), tmp_path, sink)
+    assert requests[-1] == "bytes=100000-"
+    assert open(path, "rb").read() == BODY
+    assert digest == hashlib.sha256(BODY).hexdigest()
+    # the sink is reset and only sees the bytes fetched this time
+    assert sink.data == BODY[100_000:]
+
+
+def test_starts_over_when_the_server_ignores_the_range(tmp_path):
+    (tmp_path / "f.mp4.part").write_bytes(b"stale" * 1000)
+    sink = Sink()
+    (path, digest), requests = fetch_from((BODY, None, False), tmp_path, sink)
+    assert requests[-1] == "bytes=5000-"
+    assert open(path, "rb").read() == BODY
+    assert digest == hashlib.sha256(BODY).hexdigest()
+    assert sink.data == BODY
@@ -0,0 +1,74 @@
+import asyncio
+
+from aiogram.fsm.state import State, StatesGroup
+from aiogram.fsm.storage.base import StorageKey
+
+from transcribai.fsm import SQLiteStorage
+
+
+class Form(StatesGroup):
+    language = State()
+
+
+def key(user_id):
+    return StorageKey(bot_id=42, chat_id=user_id, user_id=user_id)
+
+
+def test_state_and_data_survive_a_restart(fresh_db):
+    async def run():
+        storage = SQLiteStorage()
+        await storage.set_state(key(1), Form.language)
+        await storage.set_data(key(1), {"idx": 3, "link": "https://example.com/v"})
+        await storage.close()
+        # a new process reads it back from the database
+        restarted = SQLiteStorage()
+        return (
+            await restarted.get_state(key(1)),
+            await restarted.get_data(key(1)),
+            await restarted.get_state(key(2)),
+            await restarted.get_data(key(2)),
+        )
+
+    assert asyncio.run(run()) == (
+        Form.language.state,
+        {"idx": 3, "link": "https://example.com/v"},
+        None,
+        {},
+    )
+
+
+def test_cleared_state_leaves_no_row(fresh_db):
+    async def run():
+        storage = SQLiteStorage()
+        await storage.set_state(key(1), Form.language)
+        await storage.set_data(key(1), {"idx": 3})
+        await storage.set_state(key(1), None)
+        await storage.set_data(key(1), {})
+
+    asyncio.run(run())
+    assert fresh_db.get_connection().execute("SELECT COUNT(*) FROM fsm_state").fetchone()[0] == 0
+
+
+def test_returned_data_is_a_copy(fresh_db):
+    async def run():
+        storage = SQLiteStorage()
+        await storage.set_data(key(1), {"idx": 3})
+        data = await storage.get_data(key(1))
+        data["idx"] = 4
+        return await storage.get_data(key(1))
+
+    assert asyncio.run(run()) == {"idx": 3}
+
+
+def test_cache_keeps_recent_conversations_only(fresh_db):
+    async def run():
+        storage = SQLiteStorage(cache_size=2)
+        for user_id in range(1, 4):
+            await storage.set_state(key(user_id), Form.language)
+        cached = len(storage._cache)
+        await storage.set_state(key(3), None)
+        await storage.set_data(key(3), {})
+        # the evicted conversation is read back from the database
+        return cached, len(storage._cache), await storage.get_state(key(1))
+
+    assert asyncio.run(run()) == (2, 1, Form.language.state)
@@ -0,0 +1,46 @@
+import asyncio
+import os
+
+from transcribai import db, handlers
+from transcribai.scheduler import Job
+
+
+class FakeBot:
+    def __init__(self):
+        self.sent = []
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.sent.append(text)
+
+
+def test_job_queued_during_download_gets_the_file(tmp_path, monkeypatch):
+    # the language was chosen while the link downloaded, the job was queued
+    # without a path and its pipeline is gone by the time it runs
+    db.init_db()
+    idx, _ = db.allocate_file(301, "https://disk.yandex.ru/d/x")
+    media = str(tmp_path / "media.mp4")
+    args = (301, 301, idx, None, str(tmp_path / "transcriptions"), "en", None)
+    job = Job(db.schedule_file(301, idx, "en", args), *args)
+    db.set_file_path(301, idx, media, "hash")
+    transcribed = []
+
+    async def worker_model():
+        return "small", "cpu"
+
+    async def lookup_cached(job, model_size, media_hash=None):
+        return False
+
+    async def async_transcribe(file_path, transcriptions_dir, language=None, pipeline=None):
+        transcribed.append(file_path)
+
+    async def deliver_job(bot, job, cached, model_size, media_hash=None):
+        transcribed.append(media_hash)
+
+    monkeypatch.setattr(handlers, "worker_model", worker_model)
+    monkeypatch.setattr(handlers, "lookup_cached", lookup_cached)
+    monkeypatch.setattr(handlers, "async_transcribe", async_transcribe)
+    monkeypatch.setattr(handlers, "deliver_job", deliver_job)
+    monkeypatch.setattr(handlers, "INCREMENTAL_DELIVERY", False)
+    asyncio.run(handlers._process_job(FakeBot(), job))
+    assert transcribed == [media, "hash"]
+    assert os.path.basename(job.file_path) == "media.mp4"
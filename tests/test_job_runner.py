@@ -0,0 +1,37 @@
+import asyncio
+
+from transcribai import job_runner, metrics
+
+
+def test_file_path_records_worker_stats(tmp_path, monkeypatch):
+    # a job transcribed whole by an inference worker, as in distributed
+    # workers, /retranscribe and resumed jobs
+    stats = {
+        "decode": 1.5,
+        "vad": 0.25,
+        "model_load": 2.0,
+        "inference": 30.0,
+        "vad_skipped": 12.0,
+        "peak_rss": 3 * 2**30,
+    }
+
+    async def run(fn, *args):
+        assert fn is job_runner.transcribe_file
+        return ("transcript.srt", "transcript.txt"), dict(stats)
+
+    monkeypatch.setattr(job_runner.inference_pool, "run", run)
+    monkeypatch.setattr(job_runner, "probe_duration", lambda path: 60.0)
+
+    async def job():
+        with metrics.job_trace(1, 1) as trace:
+            paths = await job_runner.async_transcribe(
+                str(tmp_path / "video.mp4"), str(tmp_path / "transcriptions")
+            )
+        return paths, trace
+
+    paths, trace = asyncio.run(job())
+    assert paths == ("transcript.srt", "transcript.txt")
+    assert trace.stages["decode"] == 1.5
+    assert trace.stages["inference"] == 30.0
+    assert trace.peak_rss == 3 * 2**30
+    assert trace.silence_seconds == 12.0
@@ -0,0 +1,58 @@
+import asyncio
+
+import numpy as np
+
+from transcribai import pipeline as pipelines
+from transcribai.pipeline import PIPELINE_TTL, AudioPipeline
+from transcribai.transcriber import save_pcm
+from transcribai.vad import as_float
+
+
+def finished(path, seconds=5):
+    # a pipeline whose download is done and fully decoded
+    p = AudioPipeline()
+    p.pcm.append(np.zeros(16000 * seconds, np.int16))
+    p.pcm.close()
+    p.finish_input(str(path))
+    return p
+
+
+def test_prune_keeps_pipelines_of_queued_jobs(tmp_path):
+    async def run():
+        media = tmp_path / "video.mp4"
+        media.write_bytes(b"media")
+        audio = np.full(16000, 0.25, np.float32)
+        save_pcm(str(media), audio)
+        queued = finished(media)
+        idle = finished(tmp_path / "other.mp4")
+        pipelines.register(1, 1, queued)
+        pipelines.register(1, 2, idle)
+        pipelines.hold(1, 1)
+        try:
+            pipelines.prune(now=queued.created + PIPELINE_TTL + 1)
+            assert (1, 2) not in pipelines.pipelines
+            # the decode is gone, the job still gets its pipeline and audio
+            assert pipelines.take(1, 1) is queued
+            assert queued.decoded_bytes == 0
+            assert np.array_equal(as_float(await queued.audio()), audio)
+        finally:
+            pipelines.pipelines.clear()
+
+    asyncio.run(run())
+
+
+def test_budget_counts_decoded_audio_only(tmp_path, monkeypatch):
+    monkeypatch.setattr(pipelines, "SPECULATIVE_DECODE_MAX_MB", 1)
+
+    async def run():
+        # 10 minutes of capacity are reserved, 5 seconds decoded
+        p = finished(tmp_path / "video.mp4")
+        assert p.pcm.data.nbytes > 2**20
+        pipelines.register(1, 3, p)
+        try:
+            pipelines.prune()
+            assert pipelines.pipelines.get((1, 3)) is p
+        finally:
+            pipelines.pipelines.clear()
+
+    asyncio.run(run())
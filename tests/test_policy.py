@@ -0,0 +1,75 @@
+import asyncio
+
+import pytest
+
+from transcribai import metrics, policy
+from transcribai.workers import inference_pool
+
+
+@pytest.fixture(autouse=True)
+def sizes(fresh_db, monkeypatch):
+    # ten minutes of audio, tiny takes ~1 min, small ~6 min and large ~35 min
+    monkeypatch.setattr(policy, "ADAPTIVE_MODEL", True)
+    monkeypatch.setattr(policy, "ADAPTIVE_MODEL_SIZES", ["tiny", "small", "large"])
+    monkeypatch.setattr(policy, "TARGET_TURNAROUND", 1800)
+    monkeypatch.setattr(policy, "media_duration", lambda file_path: 600.0)
+
+
+def queue_job(db, model_size, audio_seconds):
+    idx, _ = db.allocate_file(1)
+    args = (1, 1, idx, "/media/queued.mp4", "/transcriptions", None, None, model_size, audio_seconds)
+    return db.schedule_file(1, idx, None, args)
+
+
+def plan(best=False, file_path="/media/new.mp4"):
+    return asyncio.run(policy.plan_job(file_path, best))
+
+
+def test_picks_the_best_model_within_the_target():
+    p = plan()
+    assert (p.model_size, p.audio_seconds, p.upgrade) == ("small", 600.0, True)
+    assert p.eta == pytest.approx(600 * 0.6 + policy.JOB_OVERHEAD_SECONDS)
+
+
+def test_best_ignores_the_target():
+    p = plan(best=True)
+    assert (p.model_size, p.upgrade) == ("large", False)
+    assert p.eta > policy.TARGET_TURNAROUND
+
+
+def test_busy_queue_gets_the_fastest_model(fresh_db, monkeypatch):
+    queue_job(fresh_db, "small", 3000)
+    p = plan()
+    assert (p.model_size, p.upgrade) == ("tiny", True)
+    # the same backlog shared by two inference workers leaves room for small
+    monkeypatch.setattr(inference_pool, "workers", 2)
+    assert plan().model_size == "small"
+
+
+def test_measured_speed_replaces_the_prior(fresh_db):
+    fresh_db.record_model_speed("large", 1.0, policy.SPEED_WEIGHT, 0)
+    p = plan()
+    assert (p.model_size, p.upgrade) == ("large", False)
+    assert p.eta == pytest.approx(600 + policy.JOB_OVERHEAD_SECONDS)
+
+
+def test_links_still_downloading_get_full_quality():
+    p = plan(file_path=None)
+    assert (p.model_size, p.audio_seconds, p.eta) == ("large", None, None)
+
+
+def test_record_speed_keeps_a_moving_average(fresh_db):
+    asyncio.run(policy.record_speed("small", 100, 50))
+    asyncio.run(policy.record_speed("small", 100, 70))
+    assert fresh_db.get_model_speeds()["small"] == pytest.approx(0.6)
+
+
+def test_speed_counts_inference_only():
+    with metrics.job_trace(1, 1, queue_wait=60):
+        metrics.observe("decode", 20)
+        metrics.observe("model_load", 5)
+        # two chunks on two workers, with voice detection before each
+        for _ in range(2):
+            metrics.record_worker_stats({"vad": 1.0, "inference": 30.0})
+        assert metrics.inference_seconds() == 62.0
+    assert metrics.inference_seconds() == 0.0
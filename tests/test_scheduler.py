@@ -0,0 +1,62 @@
+import asyncio
+
+from transcribai.scheduler import Job, JobScheduler
+
+
+def queue(db, user_id, jobs=1):
+    # an upload of user_id with its jobs queued, returns the job ids
+    idx, _ = db.allocate_file(user_id)
+    args = (user_id, user_id, idx, f"/media/{user_id}_{idx}.mp4", f"/transcriptions/{idx}", None, None)
+    return [db.schedule_file(user_id, idx, None, args) for _ in range(jobs)]
+
+
+def test_users_take_turns():
+    scheduler = JobScheduler(workers=0)
+    for job_id, user_id in enumerate([1, 1, 1, 2, 3, 3]):
+        scheduler._push(Job(job_id, user_id, user_id, job_id, None, None, None))
+    # one job of every user per round, users in the order they first queued
+    assert [job.id for job in scheduler._order()] == [0, 3, 4, 1, 5, 2]
+    assert [scheduler._pop().id for _ in range(6)] == [0, 3, 4, 1, 5, 2]
+    assert scheduler.queued() == 0
+
+
+def test_position_counts_jobs_started_before(fresh_db):
+    async def run():
+        scheduler = JobScheduler(workers=0)
+        first = [await scheduler.submit(11, 11, i, None, None, None) for i in range(3)]
+        other = await scheduler.submit(12, 12, 1, None, None, None)
+        return scheduler, first, other
+
+    scheduler, first, other = asyncio.run(run())
+    assert [scheduler.position(job.id) for job in first] == [0, 2, 3]
+    assert scheduler.position(other.id) == 1
+    assert scheduler.position(-1) is None
+    assert scheduler.queued() == 4
+
+
+def test_resumes_jobs_after_restart(fresh_db):
+    db = fresh_db
+    interrupted, queued = queue(db, 21, jobs=2)
+    (other,) = queue(db, 22)
+    db.set_job_state(interrupted, "running")
+    ran = []
+
+    async def runner(job):
+        ran.append(job.id)
+
+    async def run():
+        scheduler = JobScheduler(workers=1)
+        await scheduler.start(runner)
+        try:
+            for _ in range(500):
+                if len(await db.run_db(db.get_jobs_by_state, "done")) == 3:
+                    break
+                await asyncio.sleep(0.01)
+        finally:
+            await scheduler.stop()
+
+    asyncio.run(run())
+    # the interrupted job runs again, first as it was queued first
+    assert ran == [interrupted, other, queued]
+    assert db.get_jobs_by_state("queued") == [] and db.get_jobs_by_state("running") == []
+    assert [row[0] for row in db.get_jobs_by_state("done")] == [interrupted, queued, other]
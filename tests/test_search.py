@@ -0,0 +1,29 @@
+import os
+
+from transcribai import db, search, storage
+
+
+def write_transcript(transcriptions_dir, text):
+    os.makedirs(transcriptions_dir)
+    with open(os.path.join(transcriptions_dir, "transcript.txt"), "w", encoding="utf8") as f:
+        f.write(f"[00:00:01,000 --> 00:00:04,500]  {text}\n")
+
+
+def test_backfill_finds_transcripts_without_jobs():
+    db.init_db()
+    # an upload from before jobs were recorded, with its media path
+    idx, video_id = db.allocate_file(201)
+    upload_dir = os.path.join(storage.DATABASE_DIR, "201", video_id)
+    db.set_file_path(201, idx, os.path.join(upload_dir, "video.mp4"))
+    write_transcript(os.path.join(upload_dir, "transcriptions"), "градиентный спуск")
+    # and one that only has its directory and a retranscription
+    idx2, video_id2 = db.allocate_file(201)
+    write_transcript(
+        os.path.join(storage.DATABASE_DIR, "201", video_id2, "transcriptions_en"),
+        "gradient descent",
+    )
+
+    assert search.backfill() == 2
+    assert search.backfill() == 0
+    assert [hit[:3] for hit in search.search(201, "градиентный")] == [(video_id, None, 1000)]
+    assert [hit[:3] for hit in search.search(201, "descent")] == [(video_id2, "en", 1000)]
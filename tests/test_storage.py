@@ -0,0 +1,112 @@
+import os
+import time
+import asyncio
+
+import numpy as np
+import pytest
+
+from transcribai import db, storage
+from transcribai.transcriber import cached_pcm, pcm_path, save_pcm
+from transcribai.vad import as_float, skip_silence
+
+
+@pytest.fixture(autouse=True)
+def delete_mode(monkeypatch):
+    db.init_db()
+    monkeypatch.setattr(storage, "MEDIA_COMPACTION", "delete")
+
+
+def upload(user_id, jobs=1):
+    # a scheduled upload with decoded audio and its jobs, queued
+    idx, video_id = db.allocate_file(user_id)
+    directory = os.path.join(storage.DATABASE_DIR, str(user_id), video_id)
+    os.makedirs(directory)
+    path = os.path.join(directory, "video.mp4")
+    with open(path, "wb") as f:
+        f.write(os.urandom(200_000))
+    audio = np.sin(np.arange(16000 * 5, dtype=np.float32) / 10) * 0.5
+    save_pcm(path, audio)
+    db.set_file_path(user_id, idx, path)
+    args = (user_id, user_id, idx, path, os.path.join(directory, "transcriptions"), None, None)
+    job_ids = [db.schedule_file(user_id, idx, None, args) for _ in range(jobs)]
+    return idx, path, audio, job_ids
+
+
+def test_compacts_while_the_delivered_job_is_running():
+    idx, path, audio, (job_id,) = upload(101)
+    db.set_job_state(job_id, "running")
+    storage.compact(101, idx, job_id)
+    assert not os.path.exists(path)
+    assert db.get_file_by_id(101, idx)[5] == "compacted"
+    # the decoded audio stays for retranscription, recorded in the usage
+    assert db.get_storage_usage(101) == os.path.getsize(pcm_path(path))
+    restored = cached_pcm(path)
+    assert isinstance(restored, np.memmap) and restored.dtype == np.int16
+    assert np.abs(as_float(restored) - audio).max() < 1e-4
+
+
+def test_waits_for_other_jobs_of_the_file():
+    idx, path, _, (job_id, _) = upload(102, jobs=2)
+    db.set_job_state(job_id, "running")
+    storage.compact(102, idx, job_id)
+    assert os.path.exists(path)
+    assert db.get_file_by_id(102, idx)[5] == "original"
+
+
+def test_gc_compacts_what_delivery_left():
+    idx, path, _, (job_id,) = upload(103)
+    db.set_job_state(job_id, "done")
+    assert storage.compact_all() >= 1
+    assert not os.path.exists(path)
+    assert db.get_file_by_id(103, idx)[5] == "compacted"
+
+
+def test_opus_mode_keeps_the_decoded_audio(monkeypatch):
+    monkeypatch.setattr(storage, "MEDIA_COMPACTION", "opus")
+    monkeypatch.setattr(storage, "compact_audio", lambda src, dst: open(dst, "wb").close())
+    idx, path, _, (job_id,) = upload(104)
+    db.set_job_state(job_id, "running")
+    storage.compact(104, idx, job_id)
+    assert os.path.exists(os.path.splitext(path)[0] + storage.COMPACT_EXTENSION)
+    assert cached_pcm(path) is not None
+
+
+def test_packs_float32_audio_of_earlier_versions():
+    idx, path, audio, (job_id,) = upload(105)
+    np.save(pcm_path(path), audio)
+    db.set_job_state(job_id, "done")
+    storage.compact(105, idx)
+    assert cached_pcm(path).dtype == np.int16
+
+
+def test_vad_takes_cached_int16():
+    audio = np.zeros(16000 * 20, np.float32)
+    audio[16000 * 8 : 16000 * 12] = np.sin(np.arange(16000 * 4) / 5) * 0.3
+    packed = np.rint(audio * 32768).astype(np.int16)
+    speech, offsets = skip_silence(audio)
+    packed_speech, packed_offsets = skip_silence(packed)
+    assert packed_speech.dtype == np.float32
+    assert packed_offsets == offsets
+    assert np.abs(packed_speech - speech).max() < 1e-4
+
+
+def test_gc_sweeps_leftovers_and_enforces_quotas(monkeypatch):
+    monkeypatch.setattr(storage, "USER_STORAGE_QUOTA_MB", 0.3)
+    idx, path, _, (job_id,) = upload(106)
+    db.set_job_state(job_id, "done")
+    directory = os.path.dirname(path)
+    orphan = os.path.join(storage.DATABASE_DIR, "106", "106_99")
+    os.makedirs(orphan)
+    with open(os.path.join(orphan, "video.mp4"), "wb") as f:
+        f.write(b"x" * 1000)
+    with open(os.path.join(directory, "video.mp4.part"), "wb") as f:
+        f.write(b"x" * 1000)
+
+    later = time.time() + 2 * storage.ORPHAN_MIN_AGE
+    removed, freed = asyncio.run(storage.collect_garbage(now=later))
+    assert removed >= 1 and not os.path.exists(orphan)
+    assert not os.path.exists(os.path.join(directory, "video.mp4.part"))
+    # 360 KB of media and decoded audio against 300 KB, the decoded audio goes
+    assert os.path.exists(path) and cached_pcm(path) is None
+    assert freed >= 2000 + 160_000
+    assert db.get_storage_usage(106) == os.path.getsize(path)
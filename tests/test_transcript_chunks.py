@@ -0,0 +1,62 @@
+from transcribai.transcript_chunks import CHAR_CLASSES, CalibratedTokenizer, chunk_transcript
+
+# a token per character, so limits can be counted by hand
+CHARS = CalibratedTokenizer({name: 1.0 for name in CHAR_CLASSES})
+
+
+def transcript(n):
+    return "\n".join(f"[00:{i:02}:00,000 --> 00:{i:02}:05,000]  line {i:02}" for i in range(n))
+
+
+def segments(chunk):
+    return chunk.split("\n")
+
+
+def test_chunks_stay_within_the_limit():
+    text = transcript(20)
+    chunks, stats = chunk_transcript(text, 200, CHARS, header="")
+    assert len(chunks) > 1 and stats.chunks == len(chunks)
+    assert stats.max_tokens <= 200
+    # every segment once, in order, cut only between segments
+    assert "\n".join(chunks) == text
+    assert stats.segments == 20 and stats.oversized == 0
+
+
+def test_overlap_repeats_the_last_segments():
+    chunks, stats = chunk_transcript(transcript(30), 400, CHARS, overlap=2, header="")
+    for previous, chunk in zip(chunks, chunks[1:]):
+        assert segments(chunk)[:2] == segments(previous)[-2:]
+    assert len(chunks) > 2 and stats.overlap_segments == 2 * (len(chunks) - 1)
+    assert stats.max_tokens <= 400
+
+
+def test_overlap_leaves_room_for_new_segments():
+    # half the budget at most goes to repeated context
+    chunks, stats = chunk_transcript(transcript(20), 200, CHARS, overlap=10, header="")
+    for previous, chunk in zip(chunks, chunks[1:]):
+        assert sum(len(s) + 1 for s in segments(chunk) if s in previous) <= 100
+    assert stats.overlap_segments < 10 * (len(chunks) - 1)
+
+
+def test_header_counts_towards_the_limit():
+    header = "Входные данные:\n"
+    chunks, stats = chunk_transcript(transcript(20), 200, CHARS, header=header)
+    assert all(chunk.startswith(header) for chunk in chunks)
+    assert stats.max_tokens <= 200
+    assert all(len(chunk) <= 200 for chunk in chunks)
+
+
+def test_oversized_segment_gets_a_chunk_of_its_own():
+    long_line = "[00:01:00,000 --> 00:01:05,000]  " + "x" * 300
+    text = "\n".join([transcript(2), long_line, transcript(1)])
+    chunks, stats = chunk_transcript(text, 200, CHARS, header="")
+    assert stats.oversized == 1
+    assert long_line in chunks
+    assert stats.max_tokens > 200
+
+
+def test_continuation_lines_stay_with_their_segment():
+    text = "[00:00:00,000 --> 00:00:05,000]  first\nstill first\n[00:00:05,000 --> 00:00:09,000]  second"
+    chunks, stats = chunk_transcript(text, 55, CHARS, header="")
+    assert stats.segments == 2
+    assert chunks[0].endswith("still first")
@@ -0,0 +1,44 @@
+import numpy as np
+import pytest
+
+from transcribai.vad import SAMPLE_RATE, restore_timestamps, skip_silence
+
+SR = SAMPLE_RATE
+
+
+def test_restores_segments_and_words_to_the_recording():
+    # speech regions at 0-1 s and, after 2 s of cut silence, from 3 s on
+    offsets = [(0, 0), (SR, 3 * SR)]
+    result = {
+        "segments": [
+            {"start": 0.5, "end": 1.0, "words": [{"start": 0.5, "end": 1.0}]},
+            {"start": 1.0, "end": 1.5, "words": [{"start": 1.2, "end": 1.5}]},
+        ]
+    }
+    restore_timestamps(result, offsets)
+    first, second = result["segments"]
+    # an end on the region boundary stays with the region it ends
+    assert (first["start"], first["end"]) == (0.5, 1.0)
+    assert (first["words"][0]["start"], first["words"][0]["end"]) == (0.5, 1.0)
+    assert (second["start"], second["end"]) == (3.0, 3.5)
+    assert (second["words"][0]["start"], second["words"][0]["end"]) == (3.2, 3.5)
+
+
+def test_leaves_uncut_audio_alone():
+    result = {"segments": [{"start": 1.0, "end": 2.0}]}
+    assert restore_timestamps(result, None) == {"segments": [{"start": 1.0, "end": 2.0}]}
+
+
+def test_round_trip_through_skip_silence():
+    audio = np.zeros(SR * 20, np.float32)
+    tone = np.sin(np.arange(SR * 2) / 5).astype(np.float32) * 0.3
+    audio[SR * 2 : SR * 4] = tone
+    audio[SR * 14 : SR * 16] = tone
+    speech, offsets = skip_silence(audio)
+    assert offsets is not None and len(speech) < len(audio) / 2
+    # half a second into the second region of the speech audio
+    (_, first), (pos, second) = offsets
+    assert first <= SR * 2 and SR * 13 < second <= SR * 14
+    start = pos / SR + 0.5
+    result = restore_timestamps({"segments": [{"start": start, "end": start + 1}]}, offsets)
+    assert result["segments"][0]["start"] == pytest.approx(second / SR + 0.5)